@@ -60,6 +60,7 @@ fpunet_group.add_argument("--bf16-unet", action="store_true", help="Run the UNET
 fpunet_group.add_argument("--fp16-unet", action="store_true", help="Store unet weights in fp16.")
 fpunet_group.add_argument("--fp8_e4m3fn-unet", action="store_true", help="Store unet weights in fp8_e4m3fn.")
 fpunet_group.add_argument("--fp8_e5m2-unet", action="store_true", help="Store unet weights in fp8_e5m2.")
+fpunet_group.add_argument("--int8-unet", action="store_true", help="Store the linear and conv weights of the unet and controlnets in int8 with a scale per output channel, dequantized on the fly. Mostly useful to fit more models in memory when running on the CPU.")
 
 fpvae_group = parser.add_mutually_exclusive_group()
 fpvae_group.add_argument("--fp16-vae", action="store_true", help="Run the VAE in fp16, might cause black images.")
@@ -73,6 +74,7 @@ fpte_group.add_argument("--fp8_e4m3fn-text-enc", action="store_true", help="Stor
 fpte_group.add_argument("--fp8_e5m2-text-enc", action="store_true", help="Store text encoder weights in fp8 (e5m2 variant).")
 fpte_group.add_argument("--fp16-text-enc", action="store_true", help="Store text encoder weights in fp16.")
 fpte_group.add_argument("--fp32-text-enc", action="store_true", help="Store text encoder weights in fp32.")
+fpte_group.add_argument("--int8-text-enc", action="store_true", help="Store the linear weights of the text encoders in int8 with a scale per output channel, dequantized on the fly.")
 
 
 parser.add_argument("--directml", type=int, nargs="?", metavar="DIRECTML_DEVICE", const=-1, help="Use torch-directml.")
@@ -101,7 +103,25 @@ vram_group.add_argument("--normalvram", action="store_true", help="Used to force
 vram_group.add_argument("--lowvram", action="store_true", help="Split the unet in parts to use less vram.")
 vram_group.add_argument("--novram", action="store_true", help="When lowvram isn't enough.")
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
-
+parser.add_argument("--lowvram-prefetch", type=int, default=2, metavar="COUNT", help="In lowvram mode, copy the weights of this many offloaded modules to the GPU on a side stream ahead of their forward. 0 disables it.")
+
+
+parser.add_argument("--clip-cache-directory", type=str, default=None, metavar="PATH", help="Cache the text encoder outputs of CLIPTextEncode as safetensors files in this directory so they are reused after a restart.")
+parser.add_argument("--clip-cache-size", type=float, default=1024, metavar="MB", help="Maximum size of the files in --clip-cache-directory, the least recently used are deleted first.")
+parser.add_argument("--model-index-directory", type=str, default=None, metavar="PATH", help="Directory where the keys and shapes read from the headers of safetensors model files are cached, used to detect the model type without loading the weights. Defaults to the model_index folder in the user directory.")
+parser.add_argument("--node-cache-size", type=int, default=64, metavar="COUNT", help="Maximum number of node results kept in the cache that is shared between prompts and workflows. 0 disables it.")
+parser.add_argument("--node-cache-ram", type=float, default=None, metavar="MB", help="Maximum amount of RAM used by the tensors and model weights in the shared node result cache. Defaults to half of the total RAM.")
+parser.add_argument("--patched-weights-cache-ram", type=float, default=2048, metavar="MB", help="Maximum amount of RAM used to keep model weights with loras applied so switching back to a previous lora combination doesn't recalculate them. 0 disables it.")
+parser.add_argument("--image-cache-ram", type=float, default=512, metavar="MB", help="Maximum amount of RAM used to keep images decoded by LoadImage so loading the same unchanged file again doesn't decode it.")
+parser.add_argument("--image-writer-threads", type=int, default=2, metavar="COUNT", help="Number of threads encoding and writing the images of SaveImage so the next prompt can start before they are on disk. 0 saves them in the node.")
+parser.add_argument("--downscale-uploads", action="store_true", help="Downscale the images uploaded to /digital-painting so their longest side is at most the latent resolution of the style workflow.")
+parser.add_argument("--memory-result-ttl", type=float, default=600, metavar="SECONDS", help="How long the uploads and results of the server extension are kept in memory or in the input and output folders after the prompt is done if they are not fetched.")
+parser.add_argument("--memory-result-ram", type=float, default=1024, metavar="MB", help="Maximum amount of RAM used by the results of the server extension kept in memory, the oldest are dropped first. The uploads of queued prompts are always kept.")
+parser.add_argument("--coalesce-prompts", type=int, default=1, metavar="COUNT", help="Merge up to COUNT queued prompts that run the same workflow and only differ in their image or seed inputs into a single execution.")
+parser.add_argument("--warmup-config", type=str, default=None, metavar="PATH", help="Load a yaml or json file listing workflows and model files that are executed before the server reports itself as ready on /health. The loaded models are pinned in memory.")
+parser.add_argument("--prompt-workers", type=int, default=1, metavar="COUNT", help="Number of threads executing prompts from the queue. Nodes that use the torch device are still run one at a time.")
+
+parser.add_argument("--disable-mmap", action="store_true", help="Read whole .safetensors files into memory when loading them instead of memory mapping them.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
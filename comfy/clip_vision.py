@@ -79,7 +79,7 @@ def convert_to_transformers(sd, prefix):
             sd['visual_projection.weight'] = sd.pop("{}proj".format(prefix)).transpose(0, 1)
 
         sd = transformers_convert(sd, prefix, "vision_model.", 48)
-    else:
+    elif prefix != "":
         replace_prefix = {prefix: ""}
         sd = state_dict_prefix_replace(sd, replace_prefix)
     return sd
@@ -384,8 +384,7 @@ def load_controlnet(ckpt_path, model=None):
         controlnet_config = comfy.model_detection.model_config_from_unet(controlnet_data, prefix, unet_dtype, True).unet_config
     load_device = comfy.model_management.get_torch_device()
     manual_cast_dtype = comfy.model_management.unet_manual_cast(unet_dtype, load_device)
-    if manual_cast_dtype is not None:
-        controlnet_config["operations"] = comfy.ops.manual_cast
+    controlnet_config["operations"] = comfy.model_management.unet_operations(manual_cast_dtype)
     controlnet_config.pop("out_channels")
     controlnet_config["hint_channels"] = controlnet_data["{}input_hint_block.0.weight".format(prefix)].shape[1]
     control_model = comfy.cldm.cldm.ControlNet(**controlnet_config)
@@ -420,6 +419,7 @@ def load_controlnet(ckpt_path, model=None):
         global_average_pooling = True
 
     control = ControlNet(control_model, global_average_pooling=global_average_pooling, load_device=load_device, manual_cast_dtype=manual_cast_dtype)
+    comfy.model_management.set_model_source(control.control_model_wrapped, ckpt_path)
     return control
 
 class T2IAdapter(ControlBase):
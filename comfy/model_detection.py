@@ -1,26 +1,27 @@
 import comfy.supported_models
 import comfy.supported_models_base
+import comfy.utils
 
 def count_blocks(state_dict_keys, prefix_string):
+    if not isinstance(state_dict_keys, comfy.utils.KeyTrie):
+        state_dict_keys = comfy.utils.KeyTrie(state_dict_keys)
     count = 0
-    while True:
-        c = False
-        for k in state_dict_keys:
-            if k.startswith(prefix_string.format(count)):
-                c = True
-                break
-        if c == False:
-            break
+    while state_dict_keys.has_prefix(prefix_string.format(count)):
         count += 1
     return count
 
+def key_trie(state_dict):
+    #model metadata read from a safetensors header already has one
+    if isinstance(state_dict, comfy.utils.ModelMetadata):
+        return state_dict.key_trie
+    return comfy.utils.KeyTrie(state_dict.keys())
+
 def calculate_transformer_depth(prefix, state_dict_keys, state_dict):
     context_dim = None
     use_linear_in_transformer = False
 
     transformer_prefix = prefix + "1.transformer_blocks."
-    transformer_keys = sorted(list(filter(lambda a: a.startswith(transformer_prefix), state_dict_keys)))
-    if len(transformer_keys) > 0:
+    if state_dict_keys.has_prefix(transformer_prefix):
         last_transformer_depth = count_blocks(state_dict_keys, transformer_prefix + '{}')
         context_dim = state_dict['{}0.attn2.to_k.weight'.format(transformer_prefix)].shape[1]
         use_linear_in_transformer = len(state_dict['{}1.proj_in.weight'.format(prefix)].shape) == 2
@@ -29,7 +30,7 @@ def calculate_transformer_depth(prefix, state_dict_keys, state_dict):
     return None
 
 def detect_unet_config(state_dict, key_prefix, dtype):
-    state_dict_keys = list(state_dict.keys())
+    state_dict_keys = key_trie(state_dict)
 
     unet_config = {
         "use_checkpoint": False,
@@ -76,11 +77,11 @@ def detect_unet_config(state_dict, key_prefix, dtype):
         prefix = '{}input_blocks.{}.'.format(key_prefix, count)
         prefix_output = '{}output_blocks.{}.'.format(key_prefix, input_block_count - count - 1)
 
-        block_keys = sorted(list(filter(lambda a: a.startswith(prefix), state_dict_keys)))
+        block_keys = state_dict_keys.keys_with_prefix(prefix)
         if len(block_keys) == 0:
             break
 
-        block_keys_output = sorted(list(filter(lambda a: a.startswith(prefix_output), state_dict_keys)))
+        block_keys_output = state_dict_keys.keys_with_prefix(prefix_output)
 
         if "{}0.op.weight".format(prefix) in block_keys: #new layer
             num_res_blocks.append(last_res_blocks)
@@ -211,11 +212,12 @@ def unet_config_from_diffusers_unet(state_dict, dtype):
     transformer_depth = []
 
     attn_res = 1
-    down_blocks = count_blocks(state_dict, "down_blocks.{}")
+    state_dict_keys = key_trie(state_dict)
+    down_blocks = count_blocks(state_dict_keys, "down_blocks.{}")
     for i in range(down_blocks):
-        attn_blocks = count_blocks(state_dict, "down_blocks.{}.attentions.".format(i) + '{}')
+        attn_blocks = count_blocks(state_dict_keys, "down_blocks.{}.attentions.".format(i) + '{}')
         for ab in range(attn_blocks):
-            transformer_count = count_blocks(state_dict, "down_blocks.{}.attentions.{}.transformer_blocks.".format(i, ab) + '{}')
+            transformer_count = count_blocks(state_dict_keys, "down_blocks.{}.attentions.{}.transformer_blocks.".format(i, ab) + '{}')
             transformer_depth.append(transformer_count)
             if transformer_count > 0:
                 match["context_dim"] = state_dict["down_blocks.{}.attentions.{}.transformer_blocks.0.attn2.to_k.weight".format(i, ab)].shape[1]
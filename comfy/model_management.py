@@ -2,8 +2,12 @@ import psutil
 from enum import Enum
 from comfy.cli_args import args
 import comfy.utils
+import comfy.ops
 import torch
 import sys
+import os
+import time
+import weakref
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -262,6 +266,85 @@ print("VAE dtype:", VAE_DTYPE)
 
 current_loaded_models = []
 
+#models that free_memory never unloads, see pin_model()
+pinned_models = []
+
+def pin_model(model):
+    #refuses to pin models that don't fit in the memory of their device next to the other pinned ones
+    #since free_memory would have nothing left to unload.
+    #a pin only protects against free_memory: loading a clone of a pinned model (e.g. with a lora) still
+    #unloads it in unload_model_clones since both patch the weights of the same module
+    if is_model_pinned(model):
+        return True
+    device = model.load_device
+    if not is_device_cpu(device):
+        pinned_size = model.model_size() + sum(m.model_size() for m in pinned_models if m.load_device == device)
+        loaded_size = sum(m.model_memory() for m in current_loaded_models if m.device == device)
+        available = get_free_memory(device) + loaded_size - minimum_inference_memory()
+        if pinned_size > available:
+            print("Not pinning {}: the pinned models would need {:.0f} MB but only {:.0f} MB can be used for models on {}".format(model.model.__class__.__name__, pinned_size / (1024 * 1024), available / (1024 * 1024), device))
+            return False
+    pinned_models.append(model)
+    return True
+
+def is_model_pinned(model):
+    for m in pinned_models:
+        if m is model:
+            return True
+    return False
+
+#the time it took to load each model to its device and the file it comes from, keyed by the torch module
+#so the clones of a model patcher share them
+model_load_times = weakref.WeakKeyDictionary()
+model_sources = weakref.WeakKeyDictionary()
+
+#returns the sets of string inputs of the running and queued prompts in the order they will run, set by the prompt queue
+upcoming_inputs_callback = None
+
+def torch_module(model):
+    return getattr(model, "model", model)
+
+def set_model_source(model, path):
+    model_sources[torch_module(model)] = os.path.normpath(os.path.abspath(path))
+
+def set_upcoming_inputs_callback(callback):
+    global upcoming_inputs_callback
+    upcoming_inputs_callback = callback
+
+def model_next_use(model, upcoming):
+    #index of the first upcoming prompt that has the file of the model as input, None if none of them does
+    path = model_sources.get(torch_module(model), None)
+    if path is None:
+        return None
+    for i, values in enumerate(upcoming):
+        for v in values:
+            if len(v) > 0 and (path == v or path.endswith(os.sep + os.path.normpath(v))):
+                return i
+    return None
+
+def eviction_order(loaded_models):
+    #models that no upcoming prompt uses go first, least recently used first, then the ones that can't be predicted
+    #the models that are needed again go last, the ones that are quick to reload compared to their size and are needed later first
+    upcoming = []
+    if upcoming_inputs_callback is not None:
+        try:
+            upcoming = upcoming_inputs_callback()
+        except Exception as e:
+            print("Could not get the upcoming prompts:", e)
+
+    def key(x):
+        recency, loaded_model = x
+        if torch_module(loaded_model.model) not in model_sources:
+            return (1, -recency)
+        next_use = model_next_use(loaded_model.model, upcoming)
+        if next_use is None:
+            return (0, -recency)
+        size = max(loaded_model.model_memory(), 1)
+        reload_time = model_load_times.get(torch_module(loaded_model.model), size / (1024 * 1024 * 1024))
+        return (2, reload_time / (size * (next_use + 1)))
+
+    return [m for _, m in sorted(enumerate(loaded_models), key=key)]
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -270,10 +353,103 @@ def module_size(module):
         module_mem += t.nelement() * t.element_size()
     return module_mem
 
+class WeightPrefetcher:
+    #streams the weights of the modules left on the offload device in lowvram mode to the gpu
+    #the weights of the next modules are copied from pinned host memory on a side stream while the current module computes.
+    #the order the modules run in is recorded during the first step, until then they are assumed to run in the order they were registered
+    def __init__(self, modules, device, count):
+        self.device = device
+        self.count = count
+        self.stream = torch.cuda.Stream(device)
+        self.modules = modules
+        self.module_index = {m: i for i, m in enumerate(modules)}
+        self.order = []
+        self.position = {}
+        self.recorded = False
+        self.pending = {}
+        self.registered = {}
+        for m in modules:
+            for t in (m.weight, m.bias):
+                if t is not None:
+                    self.pin(t)
+            m.weight_streamer = self
+
+    def pin(self, t):
+        #page locks the memory the weights are already in instead of making pinned copies, which would need twice the host ram while loading
+        storage = t.untyped_storage()
+        ptr = storage.data_ptr()
+        if ptr in self.registered or t.device.type != "cpu" or t.is_pinned():
+            return
+        cudart = torch.cuda.cudart()
+        if cudart.cudaHostRegister(ptr, storage.nbytes(), 0) != cudart.cudaError.success:
+            #e.g. read only memory mapped files, their weights are copied from pageable memory
+            print("lowvram: could not pin the weights of size", storage.nbytes())
+            return
+        self.registered[ptr] = storage #keeps the memory alive until it is unregistered
+
+    def copy(self, m):
+        with torch.cuda.stream(self.stream):
+            weight = m.weight.to(self.device, non_blocking=True)
+            bias = m.bias.to(self.device, non_blocking=True) if m.bias is not None else None
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return weight, bias, event
+
+    def next_modules(self, m, index):
+        if self.recorded:
+            return self.order[index + 1:index + 1 + self.count]
+        i = self.module_index[m]
+        return self.modules[i + 1:i + 1 + self.count]
+
+    def get(self, m, device):
+        if device != self.device:
+            return m.weight, m.bias
+
+        index = self.position.get(m, None)
+        if index is None:
+            index = len(self.order)
+            self.position[m] = index
+            self.order.append(m)
+        elif index == 0:
+            self.recorded = True
+
+        prefetched = self.pending.pop(m, None)
+        #only the copies of the next modules are kept, the last module of a step releases all of them
+        upcoming = self.next_modules(m, index)
+        for n in list(self.pending.keys()):
+            if not any(n is x for x in upcoming):
+                del self.pending[n]
+        for n in upcoming:
+            if n is not m and n not in self.pending:
+                self.pending[n] = self.copy(n)
+
+        if prefetched is None:
+            return m.weight.to(device, non_blocking=True), (m.bias.to(device, non_blocking=True) if m.bias is not None else None)
+
+        weight, bias, event = prefetched
+        stream = torch.cuda.current_stream(device)
+        stream.wait_event(event)
+        weight.record_stream(stream) #the memory was allocated on the side stream
+        if bias is not None:
+            bias.record_stream(stream)
+        return weight, bias
+
+    def detach(self):
+        self.stream.synchronize()
+        self.pending = {}
+        for m in self.modules:
+            if getattr(m, "weight_streamer", None) is self:
+                del m.weight_streamer
+        #page locked memory is scarce, the weights of an unloaded model go back to pageable memory
+        for ptr in self.registered:
+            torch.cuda.cudart().cudaHostUnregister(ptr)
+        self.registered = {}
+
 class LoadedModel:
     def __init__(self, model):
         self.model = model
         self.model_accelerated = False
+        self.weight_prefetcher = None
         self.device = model.load_device
 
     def model_memory(self):
@@ -303,6 +479,7 @@ class LoadedModel:
         if lowvram_model_memory > 0:
             print("loading in lowvram mode", lowvram_model_memory/(1024 * 1024))
             mem_counter = 0
+            offloaded = []
             for m in self.real_model.modules():
                 if hasattr(m, "comfy_cast_weights"):
                     m.prev_comfy_cast_weights = m.comfy_cast_weights
@@ -311,11 +488,15 @@ class LoadedModel:
                     if mem_counter + module_mem < lowvram_model_memory:
                         m.to(self.device)
                         mem_counter += module_mem
+                    elif getattr(m, "weight", None) is not None:
+                        offloaded.append(m)
                 elif hasattr(m, "weight"): #only modules with comfy_cast_weights can be set to lowvram mode
                     m.to(self.device)
                     mem_counter += module_size(m)
                     print("lowvram: loaded module regularly", m)
 
+            if args.lowvram_prefetch > 0 and self.device.type == "cuda" and len(offloaded) > 0:
+                self.weight_prefetcher = WeightPrefetcher(offloaded, self.device, args.lowvram_prefetch)
             self.model_accelerated = True
 
         if is_intel_xpu() and not args.disable_ipex_optimize:
@@ -324,6 +505,10 @@ class LoadedModel:
         return self.real_model
 
     def model_unload(self):
+        if self.weight_prefetcher is not None:
+            self.weight_prefetcher.detach()
+            self.weight_prefetcher = None
+
         if self.model_accelerated:
             for m in self.real_model.modules():
                 if hasattr(m, "prev_comfy_cast_weights"):
@@ -348,22 +533,22 @@ def unload_model_clones(model):
             to_unload = [i] + to_unload
 
     for i in to_unload:
+        #pinned models are unloaded too, their clone uses the same weights
         print("unload clone", i)
         current_loaded_models.pop(i).model_unload()
 
 def free_memory(memory_required, device, keep_loaded=[]):
     unloaded_model = False
-    for i in range(len(current_loaded_models) -1, -1, -1):
+    candidates = [m for m in current_loaded_models if m.device == device and m not in keep_loaded and not is_model_pinned(m.model)]
+    if len(candidates) > 0 and (DISABLE_SMART_MEMORY or get_free_memory(device) <= memory_required):
+        candidates = eviction_order(candidates)
+    for shift_model in candidates:
         if not DISABLE_SMART_MEMORY:
             if get_free_memory(device) > memory_required:
                 break
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded:
-                m = current_loaded_models.pop(i)
-                m.model_unload()
-                del m
-                unloaded_model = True
+        current_loaded_models.remove(shift_model)
+        shift_model.model_unload()
+        unloaded_model = True
 
     if unloaded_model:
         soft_empty_cache()
@@ -431,7 +616,9 @@ def load_models_gpu(models, memory_required=0):
         if vram_set_state == VRAMState.NO_VRAM:
             lowvram_model_memory = 64 * 1024 * 1024
 
+        load_start = time.perf_counter()
         cur_loaded_model = loaded_model.model_load(lowvram_model_memory)
+        model_load_times[torch_module(model)] = time.perf_counter() - load_start
         current_loaded_models.insert(0, loaded_model)
     return
 
@@ -500,6 +687,15 @@ def unet_dtype(device=None, model_params=0):
         return torch.float16
     return torch.float32
 
+def unet_operations(manual_cast_dtype):
+    if args.int8_unet:
+        if manual_cast_dtype is not None:
+            return comfy.ops.int8_manual_cast
+        return comfy.ops.int8_weights
+    if manual_cast_dtype is not None:
+        return comfy.ops.manual_cast
+    return comfy.ops.disable_weight_init
+
 # None means no manual cast
 def unet_manual_cast(weight_dtype, inference_device):
     if weight_dtype == torch.float32:
@@ -551,6 +747,11 @@ def text_encoder_dtype(device=None):
     else:
         return torch.float32
 
+def text_encoder_operations():
+    if args.int8_text_enc:
+        return comfy.ops.int8_manual_cast
+    return comfy.ops.manual_cast
+
 def intermediate_device():
     if args.gpu_only:
         return get_torch_device()
@@ -782,23 +983,43 @@ class InterruptProcessingException(Exception):
 
 interrupt_processing_mutex = threading.RLock()
 
-interrupt_processing = False
-def interrupt_current_processing(value=True):
-    global interrupt_processing
-    global interrupt_processing_mutex
+#interrupts are per prompt so that stopping one prompt doesn't stop the ones run by the other prompt workers
+interrupted_prompts = set()
+running_prompts = {} #thread ident -> ids of the prompts executed by that thread
+
+def set_running_prompts(prompt_ids):
+    #registers the prompts executed by the current thread, earlier interrupts of them or of the previous ones are dropped
     with interrupt_processing_mutex:
-        interrupt_processing = value
+        ident = threading.get_ident()
+        interrupted_prompts.difference_update(running_prompts.pop(ident, []))
+        interrupted_prompts.difference_update(prompt_ids)
+        if len(prompt_ids) > 0:
+            running_prompts[ident] = list(prompt_ids)
+
+def interrupt_current_processing(value=True, prompt_ids=None):
+    #without prompt ids interrupting stops every running prompt and resetting only affects the ones of the current thread
+    with interrupt_processing_mutex:
+        if prompt_ids is None:
+            if value:
+                prompt_ids = [x for ids in running_prompts.values() for x in ids]
+            else:
+                prompt_ids = running_prompts.get(threading.get_ident(), [])
+        if value:
+            interrupted_prompts.update(prompt_ids)
+        else:
+            interrupted_prompts.difference_update(prompt_ids)
 
-def processing_interrupted():
-    global interrupt_processing
-    global interrupt_processing_mutex
+def interrupted_prompt_ids():
+    #the prompts of the current thread that were interrupted
     with interrupt_processing_mutex:
-        return interrupt_processing
+        return [x for x in running_prompts.get(threading.get_ident(), []) if x in interrupted_prompts]
+
+def processing_interrupted():
+    return len(interrupted_prompt_ids()) > 0
 
 def throw_exception_if_processing_interrupted():
-    global interrupt_processing
-    global interrupt_processing_mutex
-    with interrupt_processing_mutex:
-        if interrupt_processing:
-            interrupt_processing = False
-            raise InterruptProcessingException()
+    if processing_interrupted():
+        raise InterruptProcessingException()
+
+#held while a node runs on the torch device so that multiple prompt workers don't load or use models at the same time
+device_mutex = threading.RLock()
@@ -1,9 +1,91 @@
 import torch
 import copy
 import inspect
+import time
+import collections
+import threading
+import weakref
+import logging
 
 import comfy.utils
 import comfy.model_management
+import comfy.ops
+from comfy.cli_args import args
+
+class PatchedWeightsCache:
+    #LRU of fully patched weight sets kept in cpu ram so that going back to a previous lora combination doesn't recalculate them
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.total_bytes = 0
+        self.mutex = threading.Lock()
+
+    def get(self, key, model):
+        with self.mutex:
+            entry = self.cache.get(key, None)
+            if entry is None:
+                return None
+            if entry[0]() is not model: #the base model was freed and its id reused
+                self.total_bytes -= self.cache.pop(key)[3]
+                return None
+            self.cache.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, model, patches, weights):
+        size = sum(w.nelement() * w.element_size() for w in weights.values())
+        if size > self.max_bytes:
+            return
+        with self.mutex:
+            if key in self.cache:
+                self.total_bytes -= self.cache.pop(key)[3]
+            #the patches are kept so that the ids of their tensors in the key stay valid
+            self.cache[key] = (weakref.ref(model), patches, weights, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.cache.popitem(last=False)[1][3]
+
+    def clear(self):
+        with self.mutex:
+            self.cache.clear()
+            self.total_bytes = 0
+
+patched_weights_cache = PatchedWeightsCache(args.patched_weights_cache_ram * 1024 * 1024)
+
+def patched_weights_size(patches, model_sd):
+    #bytes of the patched weights, int8 weights are patched in the dtype of their scale
+    size = 0
+    for key in patches:
+        if key not in model_sd:
+            continue
+        weight = model_sd[key]
+        element_size = weight.element_size()
+        if weight.dtype == torch.int8 and key + "_scale" in model_sd:
+            element_size = model_sd[key + "_scale"].element_size()
+        size += weight.nelement() * element_size
+    return size
+
+#maximum size of the float32 weights stacked together by calculate_weights_batched
+BATCHED_PATCH_BYTES = 256 * 1024 * 1024
+
+def lora_batch_group(weight, patches):
+    #keys only patched with plain loras can be batched with the keys that have the same shapes
+    if weight.dtype == torch.int8: #quantized weights are dequantized one by one
+        return None
+    group = [tuple(weight.shape)]
+    for p in patches:
+        v = p[1]
+        if p[2] != 1.0 or not isinstance(v, tuple) or len(v) != 2 or v[0] != "lora" or v[1][3] is not None:
+            return None
+        mat1, mat2 = v[1][0], v[1][1]
+        group.append((tuple(mat1.shape), tuple(mat2.shape), mat1.dtype, mat2.dtype))
+    return tuple(group)
+
+def patch_id(v):
+    if isinstance(v, (list, tuple)):
+        return tuple(map(patch_id, v))
+    if isinstance(v, torch.Tensor):
+        return id(v)
+    return v
 
 class ModelPatcher:
     def __init__(self, model, load_device, offload_device, size=0, current_device=None, weight_inplace_update=False):
@@ -165,6 +247,9 @@ class ModelPatcher:
                 p[k] = (model_sd[k],)
         return p
 
+    def patches_key(self):
+        return (id(self.model), tuple((k, patch_id(self.patches[k])) for k in sorted(self.patches)))
+
     def model_state_dict(self, filter_prefix=None):
         sd = self.model.state_dict()
         keys = list(sd.keys())
@@ -183,28 +268,64 @@ class ModelPatcher:
 
         if patch_weights:
             model_sd = self.model_state_dict()
+            cache_key = None
+            cached_weights = None
+            if patched_weights_cache.max_bytes > 0 and len(self.patches) > 0:
+                cache_key = self.patches_key()
+                cached_weights = patched_weights_cache.get(cache_key, self.model)
+                #weight sets that can't be cached aren't copied to the cpu
+                if cached_weights is None and patched_weights_size(self.patches, model_sd) > patched_weights_cache.max_bytes:
+                    cache_key = None
+            patched_weights = {}
+            batched_weights = {}
+            patch_start_time = time.perf_counter()
+            if cached_weights is None and len(self.patches) > 0:
+                batched_weights = self.calculate_weights_batched([k for k in self.patches if k in model_sd], model_sd, device_to if device_to is not None else self.current_device)
+
             for key in self.patches:
                 if key not in model_sd:
                     print("could not patch. key doesn't exist in model:", key)
                     continue
 
                 weight = model_sd[key]
+                weight_scale = None
+                if weight.dtype == torch.int8:
+                    weight_scale = model_sd.get(key + "_scale", None)
 
-                inplace_update = self.weight_inplace_update
+                #patched int8 weights are stored unquantized in the dtype of their scale until they are unpatched
+                inplace_update = self.weight_inplace_update and weight_scale is None
 
                 if key not in self.backup:
                     self.backup[key] = weight.to(device=self.offload_device, copy=inplace_update)
 
-                if device_to is not None:
-                    temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+                if cached_weights is not None and key in cached_weights:
+                    out_weight = cached_weights[key].to(device=weight.device if device_to is None else device_to, copy=True)
+                elif key in batched_weights:
+                    out_weight = batched_weights.pop(key)
+                    if cache_key is not None:
+                        patched_weights[key] = out_weight.to(device="cpu", copy=True)
                 else:
-                    temp_weight = weight.to(torch.float32, copy=True)
-                out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+                    if weight_scale is not None:
+                        temp_weight = comfy.ops.dequantize_weight(weight, weight_scale, torch.float32, device=device_to)
+                    elif device_to is not None:
+                        temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+                    else:
+                        temp_weight = weight.to(torch.float32, copy=True)
+                    out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype if weight_scale is None else weight_scale.dtype)
+                    del temp_weight
+                    if cache_key is not None:
+                        patched_weights[key] = out_weight.to(device="cpu", copy=True)
+
                 if inplace_update:
                     comfy.utils.copy_to_param(self.model, key, out_weight)
                 else:
                     comfy.utils.set_attr(self.model, key, out_weight)
-                del temp_weight
+
+            if cache_key is not None and cached_weights is None:
+                patched_weights_cache.set(cache_key, self.model, {k: self.patches[k][:] for k in self.patches}, patched_weights)
+
+            if len(self.patches) > 0:
+                logging.debug("Patched {} weights in {:.2f} seconds{}".format(len(self.patches), time.perf_counter() - patch_start_time, " (cached)" if cached_weights is not None else ""))
 
             if device_to is not None:
                 self.model.to(device_to)
@@ -212,6 +333,40 @@ class ModelPatcher:
 
         return self.model
 
+    def calculate_weights_batched(self, keys, model_sd, device):
+        groups = {}
+        for key in keys:
+            group = lora_batch_group(model_sd[key], self.patches[key])
+            if group is not None:
+                groups.setdefault(group, []).append(key)
+
+        out = {}
+        for group, group_keys in groups.items():
+            if len(group_keys) < 2:
+                continue
+            chunk_size = max(1, BATCHED_PATCH_BYTES // (model_sd[group_keys[0]].nelement() * 4))
+            for c in range(0, len(group_keys), chunk_size):
+                chunk = group_keys[c:c + chunk_size]
+                weights = comfy.model_management.cast_to_device(torch.stack([model_sd[k] for k in chunk]), device, torch.float32, copy=True)
+                for i in range(len(group) - 1):
+                    #the lora factors are stacked on their own device and moved once per chunk
+                    mat1 = comfy.model_management.cast_to_device(torch.stack([self.patches[k][i][1][1][0].flatten(start_dim=1) for k in chunk]), device, torch.float32)
+                    mat2 = comfy.model_management.cast_to_device(torch.stack([self.patches[k][i][1][1][1].flatten(start_dim=1) for k in chunk]), device, torch.float32)
+                    alpha = []
+                    for k in chunk:
+                        p = self.patches[k][i]
+                        a = p[0]
+                        if p[1][1][2] is not None:
+                            a *= p[1][1][2] / mat2.shape[1]
+                        alpha.append(a)
+                    alpha = torch.tensor(alpha, device=device, dtype=torch.float32).view(-1, 1, 1)
+                    weights += (alpha * torch.bmm(mat1, mat2)).reshape(weights.shape)
+                    del mat1, mat2
+                for j, k in enumerate(chunk):
+                    out[k] = weights[j].to(model_sd[k].dtype, copy=True)
+                del weights
+        return out
+
     def calculate_weight(self, patches, weight, key):
         for p in patches:
             alpha = p[0]
@@ -339,7 +494,10 @@ class ModelPatcher:
 
         if self.weight_inplace_update:
             for k in keys:
-                comfy.utils.copy_to_param(self.model, k, self.backup[k])
+                if self.backup[k].dtype == torch.int8: #quantized weights were replaced when they were patched
+                    comfy.utils.set_attr(self.model, k, self.backup[k])
+                else:
+                    comfy.utils.copy_to_param(self.model, k, self.backup[k])
         else:
             for k in keys:
                 comfy.utils.set_attr(self.model, k, self.backup[k])
@@ -1,12 +1,20 @@
 import torch
 import comfy.model_management
 
+def module_weights(s, device):
+    #modules offloaded in lowvram mode can have their weights prefetched to the device ahead of their forward
+    streamer = getattr(s, "weight_streamer", None)
+    if streamer is not None:
+        return streamer.get(s, device)
+    return s.weight, s.bias
+
 def cast_bias_weight(s, input):
     bias = None
     non_blocking = comfy.model_management.device_supports_non_blocking(input.device)
-    if s.bias is not None:
-        bias = s.bias.to(device=input.device, dtype=input.dtype, non_blocking=non_blocking)
-    weight = s.weight.to(device=input.device, dtype=input.dtype, non_blocking=non_blocking)
+    weight, s_bias = module_weights(s, input.device)
+    if s_bias is not None:
+        bias = s_bias.to(device=input.device, dtype=input.dtype, non_blocking=non_blocking)
+    weight = weight.to(device=input.device, dtype=input.dtype, non_blocking=non_blocking)
     return weight, bias
 
 
@@ -112,3 +120,64 @@ class manual_cast(disable_weight_init):
 
     class LayerNorm(disable_weight_init.LayerNorm):
         comfy_cast_weights = True
+
+
+def quantize_weight(weight):
+    #symmetric int8 quantization with one scale for each output channel
+    w = weight.float()
+    scale = w.reshape(w.shape[0], -1).abs().amax(dim=1).clamp(min=1e-12) / 127.0
+    q = torch.round(w / scale.reshape(-1, *([1] * (w.ndim - 1)))).clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+def dequantize_weight(weight, scale, dtype, device=None, non_blocking=False):
+    weight = weight.to(device=device, non_blocking=non_blocking)
+    scale = scale.to(device=weight.device, dtype=dtype, non_blocking=non_blocking)
+    return weight.to(dtype) * scale.reshape(-1, *([1] * (weight.ndim - 1)))
+
+def cast_quantized_bias_weight(s, input):
+    if s.weight.dtype != torch.int8: #weights patched with a lora are stored unquantized until they are unpatched
+        return cast_bias_weight(s, input)
+    bias = None
+    non_blocking = comfy.model_management.device_supports_non_blocking(input.device)
+    weight, s_bias = module_weights(s, input.device)
+    if s_bias is not None:
+        bias = s_bias.to(device=input.device, dtype=input.dtype, non_blocking=non_blocking)
+    weight = dequantize_weight(weight, s.weight_scale, input.dtype, device=input.device, non_blocking=non_blocking)
+    return weight, bias
+
+
+class QuantizedWeight:
+    #keeps the weight in int8 with a per output channel scale, the float weights are quantized once when they are loaded
+    comfy_cast_weights = True
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        dtype = self.weight.dtype if self.weight.dtype.is_floating_point and self.weight.element_size() > 1 else torch.float32
+        self.weight_scale = torch.nn.Parameter(torch.ones(self.weight.shape[0], device=self.weight.device, dtype=dtype), requires_grad=False)
+        self.weight = torch.nn.Parameter(torch.empty(self.weight.shape, device=self.weight.device, dtype=torch.int8), requires_grad=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        weight = state_dict.get(prefix + "weight", None)
+        if weight is not None and weight.dtype != torch.int8:
+            weight, scale = quantize_weight(weight)
+            state_dict[prefix + "weight"] = weight
+            state_dict[prefix + "weight_scale"] = scale
+        return super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+
+class int8_weights(disable_weight_init):
+    #only the quantized layers cast their weights, the other layers are used as stored
+    class Linear(QuantizedWeight, manual_cast.Linear):
+        def forward_comfy_cast_weights(self, input):
+            weight, bias = cast_quantized_bias_weight(self, input)
+            return torch.nn.functional.linear(input, weight, bias)
+
+    class Conv2d(QuantizedWeight, manual_cast.Conv2d):
+        def forward_comfy_cast_weights(self, input):
+            weight, bias = cast_quantized_bias_weight(self, input)
+            return self._conv_forward(input, weight, bias)
+
+
+class int8_manual_cast(manual_cast):
+    #for weights stored in a different dtype than the one used for inference
+    Linear = int8_weights.Linear
+    Conv2d = int8_weights.Conv2d
@@ -1,10 +1,16 @@
 import torch
+import os
+import hashlib
+import threading
+import collections
 
 from comfy import model_management
+from comfy.cli_args import args
 from .ldm.models.autoencoder import AutoencoderKL, AutoencodingEngine
 import yaml
 
 import comfy.utils
+import safetensors.torch
 
 from . import clip_vision
 from . import gligen
@@ -52,7 +58,7 @@ def load_clip_weights(model, sd):
     return load_model_weights(model, sd)
 
 
-def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
+def load_lora_for_models(model, clip, lora, strength_model, strength_clip, lora_path=None):
     key_map = {}
     if model is not None:
         key_map = comfy.lora.model_lora_keys_unet(model.model, key_map)
@@ -69,7 +75,8 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
 
     if clip is not None:
         new_clip = clip.clone()
-        k1 = new_clip.add_patches(loaded, strength_clip)
+        source = comfy.utils.file_stat_key(lora_path) if lora_path is not None else None
+        k1 = new_clip.add_patches(loaded, strength_clip, source=source)
     else:
         k1 = ()
         new_clip = None
@@ -82,6 +89,61 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
     return (new_modelpatcher, new_clip)
 
 
+class ConditioningFileCache:
+    #LRU index of the files in --clip-cache-directory, the least recently used ones are deleted once they take more than max_bytes.
+    #the mtime of a file is set when it is used so the order is kept after a restart
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.files = None
+        self.total_bytes = 0
+        self.mutex = threading.Lock()
+
+    def load_index(self):
+        self.files = collections.OrderedDict()
+        self.total_bytes = 0
+        entries = []
+        try:
+            for entry in os.scandir(args.clip_cache_directory):
+                if entry.is_file() and entry.name.endswith(".safetensors"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        except OSError:
+            pass
+        for _, path, size in sorted(entries):
+            self.files[path] = size
+            self.total_bytes += size
+
+    def used(self, path):
+        with self.mutex:
+            if self.files is None:
+                self.load_index()
+            if path in self.files:
+                self.files.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, path):
+        with self.mutex:
+            if self.files is None:
+                self.load_index()
+            self.total_bytes -= self.files.pop(path, 0)
+            try:
+                self.files[path] = os.path.getsize(path)
+            except OSError:
+                return
+            self.total_bytes += self.files[path]
+            while self.total_bytes > self.max_bytes and len(self.files) > 1:
+                old_path, size = self.files.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+conditioning_file_cache = ConditioningFileCache(args.clip_cache_size * 1024 * 1024)
+
 class CLIP:
     def __init__(self, target=None, embedding_directory=None, no_init=False):
         if no_init:
@@ -100,6 +162,9 @@ class CLIP:
         self.tokenizer = tokenizer(embedding_directory=embedding_directory)
         self.patcher = comfy.model_patcher.ModelPatcher(self.cond_stage_model, load_device=load_device, offload_device=offload_device)
         self.layer_idx = None
+        self.weights_fingerprint = None #set by the loaders from the files the weights come from, see comfy.utils.file_fingerprint
+        self.patches_fingerprint = None
+        self.patches_sources = [] #file the patches come from and strengths of each add_patches, None when unknown
 
     def clone(self):
         n = CLIP(no_init=True)
@@ -107,9 +172,16 @@ class CLIP:
         n.cond_stage_model = self.cond_stage_model
         n.tokenizer = self.tokenizer
         n.layer_idx = self.layer_idx
+        n.weights_fingerprint = self.weights_fingerprint
+        n.patches_fingerprint = self.patches_fingerprint
+        n.patches_sources = self.patches_sources[:]
         return n
 
-    def add_patches(self, patches, strength_patch=1.0, strength_model=1.0):
+    def add_patches(self, patches, strength_patch=1.0, strength_model=1.0, source=None):
+        self.patches_fingerprint = None
+        if source is not None:
+            source = [source, strength_patch, strength_model]
+        self.patches_sources.append(source)
         return self.patcher.add_patches(patches, strength_patch, strength_model)
 
     def clip_layer(self, layer_idx):
@@ -118,7 +190,50 @@ class CLIP:
     def tokenize(self, text, return_word_ids=False):
         return self.tokenizer.tokenize_with_weights(text, return_word_ids)
 
+    def get_patches_fingerprint(self):
+        if self.patches_fingerprint is None:
+            m = hashlib.sha256()
+            if None in self.patches_sources:
+                comfy.utils.hash_update(m, self.patcher.patches)
+            else:
+                #loras loaded from files and weights merged from other clips are identified by where they come from instead of hashing their tensors
+                comfy.utils.hash_update(m, self.patches_sources)
+            self.patches_fingerprint = m.hexdigest()
+        return self.patches_fingerprint
+
+    def fingerprint(self):
+        #identifies the weights with the patches applied, None when the files the weights come from aren't known
+        if self.weights_fingerprint is None:
+            return None
+        return [self.weights_fingerprint, self.get_patches_fingerprint()]
+
+    def conditioning_cache_file(self, tokens):
+        if args.clip_cache_directory is None or self.weights_fingerprint is None:
+            return None
+
+        m = hashlib.sha256()
+        load_device = self.patcher.load_device
+        comfy.utils.hash_update(m, [self.weights_fingerprint, self.get_patches_fingerprint(), self.layer_idx, str(load_device), str(model_management.text_encoder_dtype(load_device)), model_management.text_encoder_operations().__name__, tokens])
+        return os.path.join(args.clip_cache_directory, "{}.safetensors".format(m.hexdigest()))
+
     def encode_from_tokens(self, tokens, return_pooled=False):
+        cache_file = self.conditioning_cache_file(tokens)
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                #read into memory instead of mapping the file, ConditioningFileCache may delete or replace it (which fails on windows while it is mapped)
+                with open(cache_file, "rb") as f:
+                    sd = safetensors.torch.load(f.read())
+                conditioning_file_cache.used(cache_file)
+                cond = sd["cond"].to(model_management.intermediate_device())
+                pooled = sd.get("pooled", None)
+                if pooled is not None:
+                    pooled = pooled.to(model_management.intermediate_device())
+                if return_pooled:
+                    return cond, pooled
+                return cond
+            except Exception as e:
+                print("Could not load cached conditioning", cache_file, e)
+
         if self.layer_idx is not None:
             self.cond_stage_model.clip_layer(self.layer_idx)
         else:
@@ -126,6 +241,20 @@ class CLIP:
 
         self.load_model()
         cond, pooled = self.cond_stage_model.encode_token_weights(tokens)
+
+        if cache_file is not None:
+            sd = {"cond": cond.cpu().contiguous()}
+            if pooled is not None:
+                sd["pooled"] = pooled.cpu().contiguous()
+            try:
+                os.makedirs(args.clip_cache_directory, exist_ok=True)
+                temp_file = "{}.{}.{}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+                comfy.utils.save_torch_file(sd, temp_file)
+                os.replace(temp_file, cache_file)
+                conditioning_file_cache.added(cache_file)
+            except Exception as e:
+                print("Could not cache conditioning", cache_file, e)
+
         if return_pooled:
             return cond, pooled
         return cond
@@ -201,31 +330,50 @@ class VAE:
         self.patcher = comfy.model_patcher.ModelPatcher(self.first_stage_model, load_device=self.device, offload_device=offload_device)
 
     def decode_tiled_(self, samples, tile_x=64, tile_y=64, overlap = 16):
-        steps = samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x, tile_y, overlap)
-        steps += samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x * 2, tile_y // 2, overlap)
-        pbar = comfy.utils.ProgressBar(steps)
+        #the three tile shapes have the same area so they can use the same number of tiles per batch
+        memory_used = self.memory_used_decode((1, samples.shape[1], tile_y, tile_x), self.vae_dtype)
+        tile_batch = max(1, min(16, int(model_management.get_free_memory(self.device) / memory_used)))
 
         decode_fn = lambda a: (self.first_stage_model.decode(a.to(self.vae_dtype).to(self.device)) + 1.0).float()
-        output = torch.clamp((
-            (comfy.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar) +
-            comfy.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar) +
-             comfy.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar))
-            / 3.0) / 2.0, min=0.0, max=1.0)
-        return output
+        while True:
+            try:
+                steps = samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x, tile_y, overlap)
+                steps += samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x // 2, tile_y * 2, overlap)
+                steps += samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x * 2, tile_y // 2, overlap)
+                pbar = comfy.utils.ProgressBar(steps)
+
+                output = torch.clamp((
+                    (comfy.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar, tile_batch = tile_batch) +
+                    comfy.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar, tile_batch = tile_batch) +
+                     comfy.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.downscale_ratio, output_device=self.output_device, pbar = pbar, tile_batch = tile_batch))
+                    / 3.0) / 2.0, min=0.0, max=1.0)
+                return output
+            except model_management.OOM_EXCEPTION as e:
+                if tile_batch == 1:
+                    raise e
+                tile_batch //= 2
 
     def encode_tiled_(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64):
-        steps = pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x, tile_y, overlap)
-        steps += pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x * 2, tile_y // 2, overlap)
-        pbar = comfy.utils.ProgressBar(steps)
+        memory_used = self.memory_used_encode((1, pixel_samples.shape[1], tile_y, tile_x), self.vae_dtype)
+        tile_batch = max(1, min(16, int(model_management.get_free_memory(self.device) / memory_used)))
 
         encode_fn = lambda a: self.first_stage_model.encode((2. * a - 1.).to(self.vae_dtype).to(self.device)).float()
-        samples = comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples /= 3.0
-        return samples
+        while True:
+            try:
+                steps = pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x, tile_y, overlap)
+                steps += pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x // 2, tile_y * 2, overlap)
+                steps += pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x * 2, tile_y // 2, overlap)
+                pbar = comfy.utils.ProgressBar(steps)
+
+                samples = comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, tile_batch=tile_batch)
+                samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, tile_batch=tile_batch)
+                samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, tile_batch=tile_batch)
+                samples /= 3.0
+                return samples
+            except model_management.OOM_EXCEPTION as e:
+                if tile_batch == 1:
+                    raise e
+                tile_batch //= 2
 
     def decode(self, samples_in):
         try:
@@ -327,6 +475,7 @@ def load_clip(ckpt_paths, embedding_directory=None):
         clip_target.tokenizer = sdxl_clip.SDXLTokenizer
 
     clip = CLIP(clip_target, embedding_directory=embedding_directory)
+    clip.weights_fingerprint = "".join(map(comfy.utils.file_fingerprint, ckpt_paths))
     for c in clip_data:
         m, u = clip.load_sd(c)
         if len(m) > 0:
@@ -428,8 +577,12 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
     return (comfy.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae)
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True):
-    sd = comfy.utils.load_torch_file(ckpt_path)
-    sd_keys = sd.keys()
+    #the model type is detected from the keys and shapes in the safetensors header before any weight is loaded
+    metadata = comfy.utils.load_model_metadata(ckpt_path)
+    sd = None
+    if metadata is None:
+        sd = comfy.utils.load_torch_file(ckpt_path)
+        metadata = sd
     clip = None
     clipvision = None
     vae = None
@@ -437,7 +590,7 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     model_patcher = None
     clip_target = None
 
-    parameters = comfy.utils.calculate_parameters(sd, "model.diffusion_model.")
+    parameters = comfy.utils.calculate_parameters(metadata, "model.diffusion_model.")
     unet_dtype = model_management.unet_dtype(model_params=parameters)
     load_device = model_management.get_torch_device()
     manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device)
@@ -445,32 +598,43 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     class WeightsLoader(torch.nn.Module):
         pass
 
-    model_config = model_detection.model_config_from_unet(sd, "model.diffusion_model.", unet_dtype)
-    model_config.set_manual_cast(manual_cast_dtype)
-
+    model_config = model_detection.model_config_from_unet(metadata, "model.diffusion_model.", unet_dtype)
     if model_config is None:
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(ckpt_path))
 
-    if model_config.clip_vision_prefix is not None:
-        if output_clipvision:
-            clipvision = clip_vision.load_clipvision_from_sd(sd, model_config.clip_vision_prefix, True)
+    model_config.set_manual_cast(manual_cast_dtype)
+    if sd is None:
+        sd = comfy.utils.load_torch_file(ckpt_path)
 
     if output_model:
         inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
         offload_device = model_management.unet_offload_device()
         model = model_config.get_model(sd, "model.diffusion_model.", device=inital_load_device)
-        model.load_model_weights(sd, "model.diffusion_model.")
+
+    #split the checkpoint into its parts in a single pass over the keys, the components that aren't needed are dropped
+    components = {"unet": ["model.diffusion_model."], "vae": model_config.vae_key_prefix}
+    if model_config.clip_vision_prefix is not None:
+        components["clip_vision"] = [model_config.clip_vision_prefix]
+    parts = comfy.utils.split_state_dict(sd, components)
+    sd = parts[None]
+
+    if output_clipvision and "clip_vision" in parts:
+        clipvision = clip_vision.load_clipvision_from_sd(parts.pop("clip_vision"), "", True)
+
+    if output_model:
+        model.load_model_weights(parts.pop("unet"), "")
 
     if output_vae:
-        vae_sd = comfy.utils.state_dict_prefix_replace(sd, {k: "" for k in model_config.vae_key_prefix}, filter_keys=True)
-        vae_sd = model_config.process_vae_state_dict(vae_sd)
+        vae_sd = model_config.process_vae_state_dict(parts.pop("vae"))
         vae = VAE(sd=vae_sd)
+    del parts
 
     if output_clip:
         w = WeightsLoader()
         clip_target = model_config.clip_target()
         if clip_target is not None:
             clip = CLIP(clip_target, embedding_directory=embedding_directory)
+            clip.weights_fingerprint = comfy.utils.file_fingerprint(ckpt_path)
             w.cond_stage_model = clip.cond_stage_model
             sd = model_config.process_clip_state_dict(sd)
             load_model_weights(w, sd)
@@ -479,8 +643,13 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     if len(left_over) > 0:
         print("left over keys:", left_over)
 
+    for m in (clip, vae, clipvision):
+        if m is not None:
+            model_management.set_model_source(m.patcher, ckpt_path)
+
     if output_model:
         model_patcher = comfy.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
+        model_management.set_model_source(model_patcher, ckpt_path)
         if inital_load_device != torch.device("cpu"):
             print("loaded straight to GPU")
             model_management.load_model_gpu(model_patcher)
@@ -529,6 +698,7 @@ def load_unet(unet_path):
     if model is None:
         print("ERROR UNSUPPORTED UNET", unet_path)
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(unet_path))
+    model_management.set_model_source(model, unet_path)
     return model
 
 def save_checkpoint(output_path, model, clip=None, vae=None, clip_vision=None, metadata=None):
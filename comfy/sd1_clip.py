@@ -77,7 +77,7 @@ class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
         with open(textmodel_json_config) as f:
             config = json.load(f)
 
-        self.transformer = model_class(config, dtype, device, comfy.ops.manual_cast)
+        self.transformer = model_class(config, dtype, device, model_management.text_encoder_operations())
         self.num_layers = self.transformer.num_layers
 
         self.max_length = max_length
@@ -1,16 +1,81 @@
 import torch
+import os
+import sys
+import json
+import mmap
 import math
 import struct
+import hashlib
+import threading
+import concurrent.futures
 import comfy.checkpoint_pickle
 import safetensors.torch
 import numpy as np
 from PIL import Image
+from comfy.cli_args import args
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+def load_safetensors_mmap(ckpt, device=None, threads=8):
+    #the tensors are views of a copy on write mmap of the file so nothing is read until a tensor is used
+    #and the pages can be dropped by the OS once the weights have been copied into the model
+    with open(ckpt, "rb") as f:
+        length_of_header = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length_of_header))
+        data_start = 8 + length_of_header
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    sd = {}
+    for k in header:
+        if k == "__metadata__":
+            continue
+        info = header[k]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            sd[k] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+            sd[k] = torch.frombuffer(mm, dtype=dtype, count=count, offset=data_start + start).reshape(info["shape"])
+
+    if device is not None and device.type != "cpu":
+        #read the file in parallel and move every tensor to the device as soon as it is read
+        keys = list(sd.keys())
+        def to_device(shard):
+            for k in shard:
+                sd[k] = sd[k].to(device)
+
+        threads = max(1, min(threads, len(keys)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(to_device, [keys[i::threads] for i in range(threads)]))
+    return sd
 
 def load_torch_file(ckpt, safe_load=False, device=None):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        sd = None
+        if not args.disable_mmap and sys.byteorder == "little":
+            try:
+                sd = load_safetensors_mmap(ckpt, device=device, threads=min(8, os.cpu_count() or 1))
+            except (KeyError, ValueError, OSError) as e:
+                print("Could not memory map {}, loading it normally: {}".format(ckpt, e))
+        if sd is None:
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
             if not 'weights_only' in torch.load.__code__.co_varnames:
@@ -34,6 +99,185 @@ def save_torch_file(sd, ckpt, metadata=None):
     else:
         safetensors.torch.save_file(sd, ckpt)
 
+def file_fingerprint(path, sample_size=1024*1024):
+    #cheap content hash of a model file: the size and the first and last sample_size bytes
+    m = hashlib.sha256()
+    size = os.path.getsize(path)
+    m.update(str(size).encode())
+    with open(path, "rb") as f:
+        m.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            m.update(f.read(sample_size))
+    return m.hexdigest()
+
+def file_stat_key(path):
+    #identifies a file version without reading it, it changes when the file is replaced or modified
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def read_safetensors_header(path):
+    with open(path, "rb") as f:
+        length_of_header = struct.unpack('<Q', f.read(8))[0]
+        return json.loads(f.read(length_of_header))
+
+class KeyTrie:
+    #trie over the "." separated parts of state dict keys so prefix lookups don't scan every key
+    def __init__(self, keys=()):
+        self.root = {}
+        self.count = 0
+        for k in keys:
+            self.add(k)
+
+    def add(self, key):
+        node = self.root
+        for part in key.split("."):
+            node = node.setdefault(part, {})
+        if None not in node: #None marks the end of a key
+            node[None] = key
+            self.count += 1
+
+    def prefix_nodes(self, prefix):
+        #the last part of the prefix can be incomplete: "input_blocks.1" also matches "input_blocks.10"
+        parts = prefix.split(".")
+        node = self.root
+        for part in parts[:-1]:
+            node = node.get(part)
+            if node is None:
+                return []
+        return [child for name, child in node.items() if name is not None and name.startswith(parts[-1])]
+
+    def has_prefix(self, prefix):
+        return len(self.prefix_nodes(prefix)) > 0
+
+    def keys_with_prefix(self, prefix):
+        out = []
+        stack = self.prefix_nodes(prefix)
+        while len(stack) > 0:
+            node = stack.pop()
+            for name, child in node.items():
+                if name is None:
+                    out.append(child)
+                else:
+                    stack.append(child)
+        return sorted(out)
+
+    def __contains__(self, key):
+        node = self.root
+        for part in key.split("."):
+            node = node.get(part)
+            if node is None:
+                return False
+        return None in node
+
+    def __iter__(self):
+        return iter(self.keys_with_prefix(""))
+
+    def __len__(self):
+        return self.count
+
+class TensorMetadata:
+    def __init__(self, shape, dtype):
+        self.shape = torch.Size(shape)
+        self.dtype_name = dtype
+        self.dtype = SAFETENSORS_DTYPES.get(dtype, None)
+
+    def nelement(self):
+        return self.shape.numel()
+
+class ModelMetadata:
+    #the keys, shapes and dtypes of a safetensors file, read from its header without touching the tensor data
+    #it can be used in place of the state dict by the model detection code
+    def __init__(self, tensors):
+        self.tensors = {k: TensorMetadata(v["shape"], v["dtype"]) for k, v in tensors.items() if k != "__metadata__"}
+        self.key_trie = KeyTrie(self.tensors.keys())
+
+    def keys(self):
+        return self.tensors.keys()
+
+    def __getitem__(self, key):
+        return self.tensors[key]
+
+    def __contains__(self, key):
+        return key in self.tensors
+
+    def __iter__(self):
+        return iter(self.tensors)
+
+    def __len__(self):
+        return len(self.tensors)
+
+#path -> (mtime_ns, size, ModelMetadata)
+model_metadata_cache = {}
+model_metadata_mutex = threading.Lock()
+
+def load_model_metadata(path):
+    #returns None for files that aren't safetensors, those have to be loaded to know their keys
+    if not path.lower().endswith(".safetensors"):
+        return None
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with model_metadata_mutex:
+        cached = model_metadata_cache.get(path, None)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    tensors = None
+    index_path = None
+    if args.model_index_directory is not None:
+        #keyed on the path, size and mtime so a lookup doesn't read the file
+        key = hashlib.sha256(json.dumps([path, stat.st_size, stat.st_mtime_ns]).encode()).hexdigest()
+        index_path = os.path.join(args.model_index_directory, "{}.json".format(key))
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                tensors = json.load(f)
+        except (OSError, ValueError):
+            tensors = None
+
+    if tensors is None:
+        try:
+            header = read_safetensors_header(path)
+        except (OSError, ValueError, struct.error) as e:
+            print("Could not read the safetensors header of {}: {}".format(path, e))
+            return None
+        tensors = {k: {"shape": v["shape"], "dtype": v["dtype"]} for k, v in header.items() if k != "__metadata__"}
+        if index_path is not None:
+            try:
+                os.makedirs(args.model_index_directory, exist_ok=True)
+                temp_path = "{}.{}.tmp".format(index_path, threading.get_ident())
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(tensors, f)
+                os.replace(temp_path, index_path)
+            except OSError as e:
+                print("Could not save the model index of {}: {}".format(path, e))
+
+    try:
+        out = ModelMetadata(tensors)
+    except (KeyError, TypeError, AttributeError) as e:
+        print("Invalid model index for {}: {}".format(path, e))
+        return None
+    with model_metadata_mutex:
+        model_metadata_cache[path] = (stat.st_mtime_ns, stat.st_size, out)
+    return out
+
+def hash_update(m, x):
+    #feeds nested lists/tuples/dicts of tensors and plain values into the hashlib object m
+    if isinstance(x, torch.Tensor):
+        m.update("tensor:{}:{}".format(x.dtype, tuple(x.shape)).encode())
+        m.update(x.detach().cpu().contiguous().flatten().view(torch.uint8).numpy().tobytes())
+    elif isinstance(x, (list, tuple)):
+        m.update("list:{}".format(len(x)).encode())
+        for y in x:
+            hash_update(m, y)
+    elif isinstance(x, dict):
+        m.update("dict:{}".format(len(x)).encode())
+        for k in sorted(x, key=str):
+            hash_update(m, k)
+            hash_update(m, x[k])
+    else:
+        m.update("{}:{}".format(type(x).__name__, x).encode())
+
 def calculate_parameters(sd, prefix=""):
     params = 0
     for k in sd.keys():
@@ -60,6 +304,23 @@ def state_dict_prefix_replace(state_dict, replace_prefix, filter_keys=False):
     return out
 
 
+def split_state_dict(state_dict, component_prefixes):
+    #routes every key to the component with the longest matching prefix in a single pass over the keys
+    #the prefix is removed from the key, the keys that match no component end up under None
+    #the tensors are moved and not copied so state_dict is empty afterwards
+    prefixes = sorted([(p, c) for c in component_prefixes for p in component_prefixes[c]], key=lambda a: len(a[0]), reverse=True)
+    out = {c: {} for c in component_prefixes}
+    out[None] = {}
+    for k, w in state_dict.items():
+        for p, c in prefixes:
+            if k.startswith(p):
+                out[c][k[len(p):]] = w
+                break
+        else:
+            out[None][k] = w
+    state_dict.clear()
+    return out
+
 def transformers_convert(sd, prefix_from, prefix_to, number):
     keys_to_replace = {
         "{}positional_embedding": "{}embeddings.position_embedding.weight",
@@ -404,31 +665,66 @@ def common_upscale(samples, width, height, upscale_method, crop):
 def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     return math.ceil((height / (tile_y - overlap))) * math.ceil((width / (tile_x - overlap)))
 
+def feather_mask(height, width, feather, device):
+    #same as multiplying the edge rows and columns of a ones tensor by (t + 1) / feather one at a time
+    def ramp(length):
+        t = torch.arange(length, device=device, dtype=torch.float32)
+        r = torch.clamp((t + 1) / feather, max=1.0) if feather > 0 else torch.ones_like(t)
+        return r * r.flip(0)
+    return (ramp(height).unsqueeze(1) * ramp(width).unsqueeze(0)).unsqueeze(0)
+
 @torch.inference_mode()
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, tile_batch = 1):
     output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
-    for b in range(samples.shape[0]):
-        s = samples[b:b+1]
-        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        out_div = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        for y in range(0, s.shape[2], tile_y - overlap):
-            for x in range(0, s.shape[3], tile_x - overlap):
-                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
-
-                ps = function(s_in).to(output_device)
-                mask = torch.ones_like(ps)
-                feather = round(overlap * upscale_amount)
-                for t in range(feather):
-                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
-                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
-                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
-                if pbar is not None:
-                    pbar.update(1)
-
-        output[b:b+1] = out/out_div
+    out_div = torch.zeros((1, 1, output.shape[2], output.shape[3]), device=output_device)
+    output.zero_()
+    feather = round(overlap * upscale_amount)
+
+    #tiles of the same shape (the ones that are not cut by the image borders) are run through the function together
+    groups = {}
+    for y in range(0, samples.shape[2], tile_y - overlap):
+        for x in range(0, samples.shape[3], tile_x - overlap):
+            shape = (min(tile_y, samples.shape[2] - y), min(tile_x, samples.shape[3] - x))
+            groups.setdefault(shape, []).append((y, x))
+
+    chunks = []
+    for positions in groups.values():
+        for b in range(samples.shape[0]):
+            for i in range(0, len(positions), max(1, tile_batch)):
+                chunks.append((b, positions[i:i + max(1, tile_batch)]))
+
+    def chunk_input(chunk, device=None):
+        b, positions = chunk
+        s_in = torch.cat([samples[b:b+1,:,y:y+tile_y,x:x+tile_x] for y, x in positions])
+        if device is not None:
+            s_in = s_in.to(device, non_blocking=True)
+        return s_in
+
+    masks = {}
+    s_in = chunk_input(chunks[0]) if len(chunks) > 0 else None
+    for c in range(len(chunks)):
+        b, positions = chunks[c]
+        ps = function(s_in)
+        #prepare the next tiles on the device the function runs on while it computes this batch
+        if c + 1 < len(chunks):
+            s_in = chunk_input(chunks[c + 1], ps.device)
+        ps = ps.to(output_device)
+
+        mask_shape = (ps.shape[2], ps.shape[3])
+        if mask_shape not in masks:
+            masks[mask_shape] = feather_mask(ps.shape[2], ps.shape[3], feather, output_device)
+        mask = masks[mask_shape]
+
+        for i, (y, x) in enumerate(positions):
+            oy = round(y * upscale_amount)
+            ox = round(x * upscale_amount)
+            output[b:b+1,:,oy:oy+ps.shape[2],ox:ox+ps.shape[3]] += ps[i:i+1] * mask
+            if b == 0:
+                out_div[:,:,oy:oy+ps.shape[2],ox:ox+ps.shape[3]] += mask
+            if pbar is not None:
+                pbar.update(1)
+
+    output /= out_div
     return output
 
 PROGRESS_BAR_ENABLED = True
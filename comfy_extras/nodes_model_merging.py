@@ -81,10 +81,12 @@ class CLIPMergeSimple:
     def merge(self, clip1, clip2, ratio):
         m = clip1.clone()
         kp = clip2.get_key_patches()
+        #the weights of clip2 are identified by its files so the cached conditioning doesn't hash them
+        source = clip2.fingerprint()
         for k in kp:
             if k.endswith(".position_ids") or k.endswith(".logit_scale"):
                 continue
-            m.add_patches({k: kp[k]}, 1.0 - ratio, ratio)
+            m.add_patches({k: kp[k]}, 1.0 - ratio, ratio, source=None if source is None else [source, k])
         return (m, )
 
 class ModelMergeBlocks:
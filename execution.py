@@ -5,12 +5,332 @@ import threading
 import heapq
 import traceback
 import inspect
+import time
+import json
+import math
+import hashlib
+import collections
 from typing import List, Literal, NamedTuple, Optional
 
 import torch
 import nodes
 
 import comfy.model_management
+import comfy.model_patcher
+from comfy.cli_args import args
+
+# Queued prompts that run the same graph and only differ in these literal inputs can be
+# merged into one execution, see merge_prompts().
+COALESCE_INPUTS = ["image", "seed", "noise_seed", "result_key"]
+
+# Nodes that process every sample of a batch on its own. In a merged prompt they run once on the samples of
+# all the prompts concatenated, the inputs in the set can differ between the prompts. The other nodes that
+# depend on a coalesced input run once per prompt.
+BATCHED_NODES = {
+    "KSampler": {"seed"},
+    "KSamplerAdvanced": {"noise_seed"},
+    "VAEEncode": set(),
+    "VAEDecode": set(),
+    "VAEEncodeTiled": set(),
+    "VAEDecodeTiled": set(),
+    "ControlNetApply": set(),
+    "ControlNetApplyAdvanced": set(),
+    "ImageScale": set(),
+    "ImageScaleBy": set(),
+    "ImageInvert": set(),
+}
+BATCH_TYPES = ["IMAGE", "MASK", "LATENT", "CONDITIONING"]
+
+# the clients and prompt ids of the prompts executed by the current prompt worker thread and
+# the nodes that submitted background writes to nodes.image_writer
+execution_context = threading.local()
+
+def current_clients():
+    return getattr(execution_context, "clients", [])
+
+def current_node():
+    return getattr(execution_context, "node_id", None)
+
+def send_to_clients(server, event, data):
+    """Sends an event about the running prompts to each of their clients with its own prompt_id."""
+    for client_id, prompt_id in current_clients():
+        if "prompt_id" in data:
+            server.send_sync(event, dict(data, prompt_id=prompt_id), client_id)
+        else:
+            server.send_sync(event, data, client_id)
+
+class CoalescedInput(tuple):
+    """A literal input of a merged prompt, holds one value for each of the merged prompts."""
+    pass
+
+class CoalescedSeed(int):
+    """The seed of a batched sampler. batch_seeds has the (seed, batch size) of each merged prompt."""
+    def __new__(cls, seeds, sizes):
+        out = super().__new__(cls, seeds[0])
+        out.batch_seeds = list(zip(seeds, sizes))
+        return out
+
+class CoalescedPrompt(dict):
+    """A prompt built by merge_prompts(). Nodes in `varying` depend on inputs that differ between the merged prompts.
+
+    While executing, batch_sizes has the per prompt batch sizes of the varying nodes that ran once on all the
+    prompts and per_prompt the ones that ran once per prompt, node_uis has their ui split by prompt."""
+    def __init__(self, prompt, prompts, varying, prompt_ids, clients):
+        super().__init__(prompt)
+        self.prompts = prompts
+        self.prompt_ids = prompt_ids
+        self.varying = varying
+        self.clients = clients
+        self.batch_sizes = {}
+        self.per_prompt = set()
+        self.node_uis = {}
+
+def coalesce_signature(item):
+    prompt = item[2]
+    nodes_signature = []
+    for unique_id in sorted(prompt):
+        class_type = prompt[unique_id]['class_type']
+        class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+        # list nodes change the number of times the nodes after them run so their outputs can't be split
+        if getattr(class_def, "INPUT_IS_LIST", False) or any(getattr(class_def, "OUTPUT_IS_LIST", [])):
+            return None
+
+        inputs = []
+        for x in sorted(prompt[unique_id]['inputs']):
+            input_data = prompt[unique_id]['inputs'][x]
+            if isinstance(input_data, list):
+                inputs.append([x, input_data])
+            elif x in COALESCE_INPUTS:
+                inputs.append([x])
+            else:
+                inputs.append([x, input_data])
+        nodes_signature.append([unique_id, class_type, inputs])
+    return json.dumps([nodes_signature, sorted(item[4]), item[3].get("extra_pnginfo", None)], sort_keys=True, default=str)
+
+def merge_prompts(items):
+    """Merges queue items with the same coalesce_signature() into one CoalescedPrompt."""
+    prompts = [x[2] for x in items]
+    merged = copy.deepcopy(prompts[0])
+    varying = set()
+    for unique_id in merged:
+        inputs = merged[unique_id]['inputs']
+        for x in inputs:
+            if isinstance(inputs[x], list):
+                continue
+            values = [p[unique_id]['inputs'][x] for p in prompts]
+            if any(v != values[0] for v in values):
+                inputs[x] = CoalescedInput(values)
+                varying.add(unique_id)
+
+    # everything that depends on a coalesced input also differs between the prompts
+    changed = True
+    while changed:
+        changed = False
+        for unique_id in merged:
+            if unique_id in varying:
+                continue
+            for input_data in merged[unique_id]['inputs'].values():
+                if isinstance(input_data, list) and input_data[0] in varying:
+                    varying.add(unique_id)
+                    changed = True
+                    break
+    clients = [(x[3]["client_id"], x[1]) for x in items if x[3].get("client_id", None) is not None]
+    return CoalescedPrompt(merged, prompts, varying, [x[1] for x in items], clients)
+
+def split_coalesced_outputs_ui(outputs_ui, prompt):
+    count = len(prompt.prompts)
+    out = [{} for i in range(count)]
+    for unique_id, output_ui in outputs_ui.items():
+        for i in range(count):
+            if unique_id in prompt.node_uis:
+                if len(prompt.node_uis[unique_id][i]) > 0:
+                    out[i][unique_id] = prompt.node_uis[unique_id][i]
+            else:
+                out[i][unique_id] = output_ui
+    return out
+
+def batch_size(value, value_type):
+    if value_type in ("IMAGE", "MASK"):
+        return value.shape[0]
+    if value_type == "LATENT":
+        return value["samples"].shape[0]
+    return None
+
+def stack_values(values, value_type):
+    """Concatenates the IMAGE, MASK or LATENT values of the merged prompts in one batch, None if they don't fit together."""
+    if value_type in ("IMAGE", "MASK"):
+        if any(v.shape[1:] != values[0].shape[1:] for v in values):
+            return None
+        return torch.cat(values)
+
+    if value_type == "LATENT":
+        samples = [v["samples"] for v in values]
+        if any(s.shape[1:] != samples[0].shape[1:] or v.keys() != values[0].keys() for s, v in zip(samples, values)):
+            return None
+        out = {}
+        for k in values[0]:
+            if k == "samples":
+                out[k] = torch.cat(samples)
+            elif k == "noise_mask":
+                masks = [v[k] for v in values]
+                if any(m.shape[0] != s.shape[0] or m.shape[1:] != masks[0].shape[1:] for m, s in zip(masks, samples)):
+                    return None
+                out[k] = torch.cat(masks)
+            elif k == "batch_index":
+                out[k] = [i for v in values for i in v[k]]
+            elif all(v[k] is values[0][k] for v in values):
+                out[k] = values[0][k]
+            else:
+                return None
+        return out
+    return None
+
+def slice_control(control, start, end, total, sliced):
+    if control is None:
+        return None
+    if id(control) not in sliced:
+        c = control.copy()
+        hint = control.cond_hint_original
+        if hint is not None and hint.shape[0] == total:
+            c.cond_hint_original = hint[start:end]
+        c.set_previous_controlnet(slice_control(control.previous_controlnet, start, end, total, sliced))
+        sliced[id(control)] = c
+    return sliced[id(control)]
+
+def slice_value(value, value_type, start, end, total):
+    """The samples start:end of a value computed on the concatenated batches of the merged prompts."""
+    if value_type in ("IMAGE", "MASK"):
+        return value[start:end]
+
+    if value_type == "LATENT":
+        out = value.copy()
+        out["samples"] = value["samples"][start:end]
+        if "noise_mask" in value and value["noise_mask"].shape[0] == total:
+            out["noise_mask"] = value["noise_mask"][start:end]
+        if "batch_index" in value:
+            out["batch_index"] = value["batch_index"][start:end]
+        return out
+
+    if value_type == "CONDITIONING":
+        # controlnets shared by several conds (positive and negative) stay shared
+        sliced = {}
+        out = []
+        for t in value:
+            d = t[1].copy()
+            if "control" in d:
+                d["control"] = slice_control(d["control"], start, end, total, sliced)
+            out.append([t[0], d])
+        return out
+    return value
+
+def input_source_type(prompt, input_data):
+    class_type = prompt[input_data[0]]['class_type']
+    return nodes.NODE_CLASS_MAPPINGS[class_type].RETURN_TYPES[input_data[1]]
+
+def batched_input_data(class_type, class_def, inputs, prompt, input_data_all):
+    """The inputs to run a varying node once on the samples of all the merged prompts and the per prompt
+    batch sizes of its outputs, or None if it has to run once per prompt."""
+    if class_type not in BATCHED_NODES or "hidden" in class_def.INPUT_TYPES():
+        return None
+
+    count = len(prompt.prompts)
+    data = dict(input_data_all)
+    sizes = None
+    shared = []
+    for x, input_data in inputs.items():
+        if isinstance(input_data, CoalescedInput):
+            if x not in BATCHED_NODES[class_type]:
+                return None
+            continue
+        if not isinstance(input_data, list):
+            continue
+
+        value_type = input_source_type(prompt, input_data)
+        if input_data[0] in prompt.batch_sizes:
+            value_sizes = prompt.batch_sizes[input_data[0]]
+        elif input_data[0] in prompt.per_prompt:
+            if value_type not in BATCH_TYPES or value_type == "CONDITIONING":
+                return None
+            value = stack_values(data[x], value_type)
+            if value is None:
+                return None
+            value_sizes = [batch_size(v, value_type) for v in data[x]]
+            data[x] = [value]
+        else:
+            # conditioning shared by all the prompts is broadcast to the batch by the sampler
+            if value_type in ("IMAGE", "MASK", "LATENT"):
+                shared.append((x, value_type))
+            continue
+
+        if sizes is None:
+            sizes = value_sizes
+        elif sizes != value_sizes:
+            # the samples of the prompts wouldn't line up (e.g. one controlnet hint for a batch of latents)
+            return None
+
+    for x, value_type in shared:
+        value = data[x][0]
+        value_size = batch_size(value, value_type)
+        if sizes is None:
+            sizes = [value_size] * count
+        elif sizes != [value_size] * count:
+            return None
+        data[x] = [stack_values([value] * count, value_type)]
+
+    if sizes is None:
+        return None
+    for x, input_data in inputs.items():
+        if isinstance(input_data, CoalescedInput):
+            data[x] = [CoalescedSeed(list(input_data), sizes)]
+    return data, sizes
+
+def execute_coalesced_node(obj, class_type, class_def, unique_id, inputs, prompt, input_data_all):
+    """Runs a node of a merged prompt that depends on the inputs that differ between the prompts."""
+    count = len(prompt.prompts)
+    batched = batched_input_data(class_type, class_def, inputs, prompt, input_data_all)
+    if batched is not None:
+        data, sizes = batched
+        output_data, output_ui = get_output_data(obj, data)
+        prompt.batch_sizes[unique_id] = sizes
+        uis = [{} for i in range(count)]
+        for k, v in output_ui.items():
+            start = 0
+            for i in range(count):
+                if len(v) == sum(sizes):
+                    uis[i][k] = v[start:start + sizes[i]]
+                else:
+                    uis[i][k] = v
+                start += sizes[i]
+        prompt.node_uis[unique_id] = uis
+        return output_data, output_ui
+
+    data = dict(input_data_all)
+    for x, input_data in inputs.items():
+        if isinstance(input_data, list) and input_data[0] in prompt.batch_sizes:
+            sizes = prompt.batch_sizes[input_data[0]]
+            value_type = input_source_type(prompt, input_data)
+            start = 0
+            values = []
+            for size in sizes:
+                values.append(slice_value(data[x][0], value_type, start, start + size, sum(sizes)))
+                start += size
+            data[x] = values
+
+    outputs = []
+    uis = []
+    for i in range(count):
+        output_data, output_ui = get_output_data(obj, {k: [v[i if len(v) > i else -1]] for k, v in data.items()})
+        outputs.append(output_data)
+        uis.append(output_ui)
+    prompt.per_prompt.add(unique_id)
+    prompt.node_uis[unique_id] = uis
+
+    output_data = [[o[slot][0] for o in outputs] for slot in range(len(outputs[0]))]
+    output_ui = {}
+    for ui in uis:
+        for k, v in ui.items():
+            output_ui.setdefault(k, []).extend(v)
+    return output_data, output_ui
 
 def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_data={}):
     valid_inputs = class_def.INPUT_TYPES()
@@ -27,13 +347,22 @@ def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_da
             input_data_all[x] = obj
         else:
             if ("required" in valid_inputs and x in valid_inputs["required"]) or ("optional" in valid_inputs and x in valid_inputs["optional"]):
-                input_data_all[x] = [input_data]
+                if isinstance(input_data, CoalescedInput):
+                    input_data_all[x] = list(input_data)
+                else:
+                    input_data_all[x] = [input_data]
 
     if "hidden" in valid_inputs:
         h = valid_inputs["hidden"]
         for x in h:
             if h[x] == "PROMPT":
-                input_data_all[x] = [prompt]
+                if isinstance(prompt, CoalescedPrompt):
+                    if unique_id in prompt.varying:
+                        input_data_all[x] = list(prompt.prompts)
+                    else:
+                        input_data_all[x] = [prompt.prompts[0]]
+                else:
+                    input_data_all[x] = [prompt]
             if h[x] == "EXTRA_PNGINFO":
                 if "extra_pnginfo" in extra_data:
                     input_data_all[x] = [extra_data['extra_pnginfo']]
@@ -117,7 +446,136 @@ def format_value(x):
     else:
         return str(x)
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage):
+def output_size(o, seen=None, depth=0):
+    """Bytes held by a node output. Models count with all their weights, once per output
+    even when several patchers or objects (CLIP, VAE, controlnets) share them."""
+    if seen is None:
+        seen = set()
+    if isinstance(o, comfy.model_patcher.ModelPatcher):
+        if id(o.model) in seen:
+            return 0
+        seen.add(id(o.model))
+        return o.model_size()
+    if isinstance(o, torch.nn.Module):
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+        return comfy.model_management.module_size(o)
+    if isinstance(o, torch.Tensor):
+        return o.nelement() * o.element_size()
+    elif isinstance(o, (list, tuple)):
+        return sum(output_size(x, seen, depth) for x in o)
+    elif isinstance(o, dict):
+        return sum(output_size(x, seen, depth) for x in o.values())
+    elif depth == 0 and hasattr(o, "__dict__") and not isinstance(o, type):
+        # objects holding models like CLIP or VAE
+        return sum(output_size(x, seen, depth + 1) for x in vars(o).values())
+    return 0
+
+class NodeOutputCache:
+    """LRU cache of node outputs keyed by get_node_signature(), shared by all the prompt workers.
+
+    Unlike PromptExecutor.outputs it doesn't depend on node ids so results are reused across
+    prompts and different workflows. Tensors and the weights of the models in the outputs count
+    towards max_bytes: a cached model stays in RAM even after comfy.model_management unloaded it."""
+    def __init__(self, max_entries, max_bytes):
+        self.mutex = threading.RLock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.pinned = set()
+        self.total_bytes = 0
+
+    def get(self, signature):
+        with self.mutex:
+            if signature not in self.cache:
+                return None
+            self.cache.move_to_end(signature)
+            return self.cache[signature][0]
+
+    def set(self, signature, output_data, pin=False):
+        #pinned entries (see main.warmup) are never evicted and don't count towards the limits
+        size = output_size(output_data)
+        with self.mutex:
+            if signature in self.pinned:
+                return
+            if pin:
+                if signature in self.cache:
+                    self.total_bytes -= self.cache.pop(signature)[1]
+                self.pinned.add(signature)
+                self.cache[signature] = (output_data, size)
+                return
+            if self.max_entries <= 0 or size > self.max_bytes:
+                return
+            if signature in self.cache:
+                self.total_bytes -= self.cache.pop(signature)[1]
+            self.cache[signature] = (output_data, size)
+            self.total_bytes += size
+            for k in list(self.cache.keys()):
+                if len(self.cache) - len(self.pinned) <= self.max_entries and self.total_bytes <= self.max_bytes:
+                    break
+                if k not in self.pinned:
+                    self.total_bytes -= self.cache.pop(k)[1]
+
+    def clear(self):
+        with self.mutex:
+            for k in list(self.cache.keys()):
+                if k not in self.pinned:
+                    self.total_bytes -= self.cache.pop(k)[1]
+
+#the cached loader results hold the model weights so the default leaves room for a few checkpoints
+node_cache_ram = args.node_cache_ram if args.node_cache_ram is not None else comfy.model_management.total_ram / 2
+node_output_cache = NodeOutputCache(args.node_cache_size, node_cache_ram * 1024 * 1024)
+
+def get_node_signature(prompt, unique_id, signatures):
+    """Hash of the class, literal inputs and upstream signatures of a node or None if its outputs can't be cached."""
+    if unique_id in signatures:
+        return signatures[unique_id]
+    signatures[unique_id] = None
+    # the outputs of varying nodes are batched or split by prompt, see execute_coalesced_node()
+    if isinstance(prompt, CoalescedPrompt) and unique_id in prompt.varying:
+        return None
+
+    inputs = prompt[unique_id]['inputs']
+    class_type = prompt[unique_id]['class_type']
+    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+    if hasattr(class_def, 'OUTPUT_NODE') and class_def.OUTPUT_NODE == True:
+        return None
+
+    hidden = class_def.INPUT_TYPES().get("hidden", {})
+    if "PROMPT" in hidden.values() or "EXTRA_PNGINFO" in hidden.values():
+        return None
+
+    is_changed = None
+    if hasattr(class_def, 'IS_CHANGED'):
+        if 'is_changed' not in prompt[unique_id]:
+            return None
+        is_changed = prompt[unique_id]['is_changed']
+        # nodes return NaN from IS_CHANGED when they have to run every time
+        if any(isinstance(x, float) and math.isnan(x) for x in is_changed):
+            return None
+
+    node_signature = [class_type, is_changed]
+    if "UNIQUE_ID" in hidden.values():
+        node_signature.append(unique_id)
+    for x in sorted(inputs):
+        input_data = inputs[x]
+        if isinstance(input_data, list):
+            input_signature = get_node_signature(prompt, input_data[0], signatures)
+            if input_signature is None:
+                return None
+            node_signature.append([x, input_signature, input_data[1]])
+        else:
+            node_signature.append([x, input_data])
+
+    try:
+        signature = hashlib.sha256(json.dumps(node_signature, sort_keys=True).encode()).hexdigest()
+    except TypeError:
+        return None
+    signatures[unique_id] = signature
+    return signature
+
+def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage, signatures=None):
     unique_id = current_item
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
@@ -125,6 +583,16 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
     if unique_id in outputs:
         return (True, None, None)
 
+    signature = None
+    if signatures is not None:
+        signature = get_node_signature(prompt, unique_id, signatures)
+        if signature is not None:
+            cached_output = node_output_cache.get(signature)
+            if cached_output is not None:
+                outputs[unique_id] = cached_output
+                executed.add(unique_id)
+                return (True, None, None)
+
     for x in inputs:
         input_data = inputs[x]
 
@@ -132,7 +600,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             input_unique_id = input_data[0]
             output_index = input_data[1]
             if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage)
+                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage, signatures)
                 if result[0] is not True:
                     # Another node failed further upstream
                     return result
@@ -140,21 +608,39 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
     input_data_all = None
     try:
         input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
+        execution_context.node_id = unique_id
         if server.client_id is not None:
             server.last_node_id = unique_id
-            server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
+        send_to_clients(server, "executing", { "node": unique_id, "prompt_id": prompt_id })
 
         obj = object_storage.get((unique_id, class_type), None)
         if obj is None:
             obj = class_def()
             object_storage[(unique_id, class_type)] = obj
 
-        output_data, output_ui = get_output_data(obj, input_data_all)
+        coalesced = isinstance(prompt, CoalescedPrompt) and unique_id in prompt.varying
+        def run():
+            if coalesced:
+                return execute_coalesced_node(obj, class_type, class_def, unique_id, inputs, prompt, input_data_all)
+            return get_output_data(obj, input_data_all)
+
+        writes = nodes.image_writer.pending()
+        if getattr(class_def, "CPU_ONLY", False):
+            output_data, output_ui = run()
+        else:
+            with comfy.model_management.device_mutex:
+                output_data, output_ui = run()
+        if nodes.image_writer.pending() > writes:
+            execution_context.written_nodes[unique_id] = (writes, nodes.image_writer.pending())
         outputs[unique_id] = output_data
+        if signature is not None:
+            node_output_cache.set(signature, output_data)
         if len(output_ui) > 0:
             outputs_ui[unique_id] = output_ui
-            if server.client_id is not None:
-                server.send_sync("executed", { "node": unique_id, "output": output_ui, "prompt_id": prompt_id }, server.client_id)
+            # the ui of coalesced nodes is split and sent to each client once the prompt is done,
+            # nodes that write their files in the background are only reported once the files exist
+            if not coalesced and unique_id not in execution_context.written_nodes:
+                send_to_clients(server, "executed", { "node": unique_id, "output": output_ui, "prompt_id": prompt_id })
     except comfy.model_management.InterruptProcessingException as iex:
         logging.info("Processing interrupted")
 
@@ -276,11 +762,19 @@ class PromptExecutor:
         self.status_messages = []
         self.success = True
         self.old_prompt = {}
+        self.coalesced = False
+        self.written_nodes = {}
+        self.interrupted = []
 
     def add_message(self, event, data, broadcast: bool):
         self.status_messages.append((event, data))
-        if self.server.client_id is not None or broadcast:
-            self.server.send_sync(event, data, self.server.client_id)
+        if len(current_clients()) > 0:
+            # a failed merged prompt is run again one prompt at a time, its clients only see those errors.
+            # interrupts are sent to the clients of the interrupted prompts once they are done
+            if event not in ("execution_error", "execution_interrupted") or not self.coalesced:
+                send_to_clients(self.server, event, data)
+        elif broadcast:
+            self.server.send_sync(event, data, None)
 
     def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
         node_id = error["node_id"]
@@ -324,13 +818,25 @@ class PromptExecutor:
             del d
 
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
-        nodes.interrupt_processing(False)
 
         if "client_id" in extra_data:
             self.server.client_id = extra_data["client_id"]
         else:
             self.server.client_id = None
 
+        self.coalesced = isinstance(prompt, CoalescedPrompt)
+        comfy.model_management.set_running_prompts(prompt.prompt_ids if self.coalesced else [prompt_id])
+        if self.coalesced:
+            execution_context.clients = prompt.clients
+        elif self.server.client_id is not None:
+            execution_context.clients = [(self.server.client_id, prompt_id)]
+        else:
+            execution_context.clients = []
+        execution_context.node_id = None
+        # node id -> range of the image_writer writes it submitted
+        self.written_nodes = {}
+        execution_context.written_nodes = self.written_nodes
+
         self.status_messages = []
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
 
@@ -355,6 +861,9 @@ class PromptExecutor:
                 d = self.object_storage.pop(o)
                 del d
 
+            if self.coalesced:
+                for x in prompt.varying:
+                    self.outputs.pop(x, None)
             for x in prompt:
                 recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
 
@@ -364,11 +873,13 @@ class PromptExecutor:
                     d = self.outputs_ui.pop(x)
                     del d
 
-            comfy.model_management.cleanup_models()
+            with comfy.model_management.device_mutex:
+                comfy.model_management.cleanup_models()
             self.add_message("execution_cached",
                           { "nodes": list(current_outputs) , "prompt_id": prompt_id},
                           broadcast=False)
             executed = set()
+            signatures = {}
             output_node_id = None
             to_execute = []
 
@@ -383,7 +894,7 @@ class PromptExecutor:
                 # This call shouldn't raise anything if there's an error deep in
                 # the actual SD code, instead it will report the node where the
                 # error was raised
-                self.success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
+                self.success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage, signatures)
                 if self.success is not True:
                     self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
                     break
@@ -391,8 +902,12 @@ class PromptExecutor:
             for x in executed:
                 self.old_prompt[x] = copy.deepcopy(prompt[x])
             self.server.last_node_id = None
+            execution_context.node_id = None
+            self.interrupted = comfy.model_management.interrupted_prompt_ids()
+            comfy.model_management.set_running_prompts([])
             if comfy.model_management.DISABLE_SMART_MEMORY:
-                comfy.model_management.unload_all_models()
+                with comfy.model_management.device_mutex:
+                    comfy.model_management.unload_all_models()
 
 
 
@@ -704,6 +1219,28 @@ def validate_prompt(prompt):
     return (True, None, list(good_outputs), node_errors)
 
 MAXIMUM_HISTORY_SIZE = 10000
+# number of queued prompts looked at to predict which models are needed next when memory has to be freed
+UPCOMING_PROMPTS = 32
+
+# Prompts are taken from the queue by priority class first. Inside a class, clients are served
+# round robin (start time fair queueing) so a burst from one client can't starve the others.
+PRIORITY_CLASSES = ["interactive", "batch", "background"]
+DEFAULT_PRIORITY = "interactive"
+WAIT_TIME_SAMPLES = 1000
+
+def get_priority(item):
+    return item[3].get("priority", DEFAULT_PRIORITY)
+
+def validate_priority(priority):
+    if priority in PRIORITY_CLASSES:
+        return (True, None)
+    error = {
+        "type": "invalid_priority",
+        "message": "Invalid priority class",
+        "details": f"{priority} not in {PRIORITY_CLASSES}",
+        "extra_info": {}
+    }
+    return (False, error)
 
 class PromptQueue:
     def __init__(self, server):
@@ -712,30 +1249,106 @@ class PromptQueue:
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
         self.queue = []
+        self.queue_counter = 0
+        self.virtual_time = {c: 0 for c in PRIORITY_CLASSES}
+        self.client_tags = {}
+        self.client_pending = {}
+        self.coalesce_signatures = {}
+        self.wait_times = {c: collections.deque(maxlen=WAIT_TIME_SAMPLES) for c in PRIORITY_CLASSES}
+        self.wait_counts = {c: 0 for c in PRIORITY_CLASSES}
         self.currently_running = {}
         self.history = {}
         self.flags = {}
+        self.free_memory_requests = 0
         server.prompt_queue = self
+        comfy.model_management.set_upcoming_inputs_callback(self.get_upcoming_inputs)
 
+    # queue entries are (class rank, fair queueing tag, number, insertion counter, enqueue time, item)
     def put(self, item):
+        signature = None
+        if args.coalesce_prompts > 1:
+            signature = coalesce_signature(item)
         with self.mutex:
-            heapq.heappush(self.queue, item)
+            if signature is not None:
+                self.coalesce_signatures[item[1]] = signature
+            priority = get_priority(item)
+            client = (priority, item[3].get("client_id", None))
+            if item[0] < 0:
+                # "front" prompts skip the fair queueing order of their class
+                tag = 0
+            else:
+                tag = max(self.virtual_time[priority], self.client_tags.get(client, 0)) + 1
+                self.client_tags[client] = tag
+                self.client_pending[client] = self.client_pending.get(client, 0) + 1
+            heapq.heappush(self.queue, (PRIORITY_CLASSES.index(priority), tag, item[0], self.queue_counter, time.perf_counter(), item))
+            self.queue_counter += 1
+            self.server.prompt_status.update(item[1], state="queued", priority=priority)
             self.server.queue_updated()
             self.not_empty.notify()
 
+    def _pop_entry(self):
+        return self._entry_dequeued(heapq.heappop(self.queue))
+
+    def _entry_dequeued(self, entry):
+        priority = PRIORITY_CLASSES[entry[0]]
+        self.virtual_time[priority] = max(self.virtual_time[priority], entry[1])
+        wait_time = time.perf_counter() - entry[4]
+        self.wait_times[priority].append(wait_time)
+        self.wait_counts[priority] += 1
+        self._entry_removed(entry)
+        return entry[-1]
+
+    def _entry_removed(self, entry):
+        if entry[1] == 0:
+            return
+        item = entry[-1]
+        client = (PRIORITY_CLASSES[entry[0]], item[3].get("client_id", None))
+        self.client_pending[client] -= 1
+        if self.client_pending[client] == 0:
+            # a client without queued prompts starts again at the virtual time of its class
+            self.client_pending.pop(client)
+            self.client_tags.pop(client, None)
+        elif self.client_tags[client] == entry[1]:
+            # its last prompt was deleted, the next one is queued right after the ones left
+            self.client_tags[client] = max(x[1] for x in self.queue if x[0] == entry[0] and x[-1][3].get("client_id", None) == client[1])
+
     def get(self, timeout=None):
         with self.not_empty:
             while len(self.queue) == 0:
                 self.not_empty.wait(timeout=timeout)
                 if timeout is not None and len(self.queue) == 0:
                     return None
-            item = heapq.heappop(self.queue)
+            item = self._pop_entry()
             i = self.task_counter
             self.currently_running[i] = copy.deepcopy(item)
             self.task_counter += 1
             self.server.queue_updated()
             return (item, i)
 
+    def get_coalesced(self, item, max_items):
+        """Takes up to max_items queued prompts of the same priority class that can be merged with item out of the queue."""
+        with self.mutex:
+            signature = self.coalesce_signatures.get(item[1], None)
+            if signature is None:
+                return []
+            rank = PRIORITY_CLASSES.index(get_priority(item))
+            entries = [x for x in sorted(self.queue) if x[0] == rank and self.coalesce_signatures.get(x[-1][1], None) == signature][:max_items]
+            if len(entries) == 0:
+                return []
+
+            out = []
+            for entry in entries:
+                self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            for entry in entries:
+                item = self._entry_dequeued(entry)
+                i = self.task_counter
+                self.currently_running[i] = copy.deepcopy(item)
+                self.task_counter += 1
+                out.append((item, i))
+            self.server.queue_updated()
+            return out
+
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
         completed: bool
@@ -745,6 +1358,7 @@ class PromptQueue:
                   status: Optional['PromptQueue.ExecutionStatus']):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
+            self.coalesce_signatures.pop(prompt[1], None)
             if len(self.history) > MAXIMUM_HISTORY_SIZE:
                 self.history.pop(next(iter(self.history)))
 
@@ -757,6 +1371,7 @@ class PromptQueue:
                 "outputs": copy.deepcopy(outputs),
                 'status': status_dict,
             }
+            self.server.prompt_status.update(prompt[1], state=status_dict["status_str"] if status_dict is not None else "done", node=None)
             self.server.queue_updated()
             # this prompt 1 is prompt id
             # outputs  filename is image file name
@@ -771,25 +1386,67 @@ class PromptQueue:
             out = []
             for x in self.currently_running.values():
                 out += [x]
-            return (out, copy.deepcopy(self.queue))
+            return (out, copy.deepcopy([x[-1] for x in sorted(self.queue)]))
+
+    def get_upcoming_inputs(self, max_items=UPCOMING_PROMPTS):
+        #the string inputs of the running prompts and the next queued ones, used to predict which models are needed soon
+        with self.mutex:
+            prompts = [x[2] for x in self.currently_running.values()] + [x[-1][2] for x in heapq.nsmallest(max_items, self.queue)]
+        out = []
+        for prompt in prompts:
+            values = set()
+            for node in prompt.values():
+                for v in node.get("inputs", {}).values():
+                    if isinstance(v, str):
+                        values.add(v)
+            out.append(values)
+        return out
 
     def get_tasks_remaining(self):
         with self.mutex:
             return len(self.queue) + len(self.currently_running)
 
+    def get_queue_metrics(self):
+        with self.mutex:
+            out = {}
+            for i, priority in enumerate(PRIORITY_CLASSES):
+                samples = sorted(self.wait_times[priority])
+                metrics = {
+                    "pending": len([x for x in self.queue if x[0] == i]),
+                    "dequeued": self.wait_counts[priority],
+                }
+                if len(samples) > 0:
+                    metrics["wait_avg"] = sum(samples) / len(samples)
+                    metrics["wait_p50"] = samples[int(0.50 * (len(samples) - 1))]
+                    metrics["wait_p95"] = samples[int(0.95 * (len(samples) - 1))]
+                    metrics["wait_max"] = samples[-1]
+                out[priority] = metrics
+            return out
+
     def wipe_queue(self):
         with self.mutex:
+            for x in self.queue:
+                self.server.prompt_status.update(x[-1][1], state="deleted")
+                self.coalesce_signatures.pop(x[-1][1], None)
+                self.server.prompt_deleted_update_server_extension(x[-1][1])
             self.queue = []
+            self.client_tags = {}
+            self.client_pending = {}
             self.server.queue_updated()
 
     def delete_queue_item(self, function):
         with self.mutex:
             for x in range(len(self.queue)):
-                if function(self.queue[x]):
+                if function(self.queue[x][-1]):
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
-                        self.queue.pop(x)
+                        entry = self.queue.pop(x)
+                        self._entry_removed(entry)
+                        prompt_id = entry[-1][1]
+                        self.server.prompt_status.update(prompt_id, state="deleted")
+                        self.coalesce_signatures.pop(prompt_id, None)
+                        self.server.prompt_deleted_update_server_extension(prompt_id)
                         heapq.heapify(self.queue)
                     self.server.queue_updated()
                     return True
@@ -825,7 +1482,10 @@ class PromptQueue:
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
-            self.not_empty.notify()
+            if name == "free_memory" and data:
+                self.free_memory_requests += 1
+            # wake all the workers, each one resets its executor on free_memory
+            self.not_empty.notify_all()
 
     def get_flags(self, reset=True):
         with self.mutex:
@@ -1,5 +1,6 @@
 import os
 import time
+import threading
 
 supported_pt_extensions = set(['.ckpt', '.pt', '.bin', '.pth', '.safetensors'])
 
@@ -222,7 +223,11 @@ def get_filename_list(folder_name):
         filename_list_cache[folder_name] = out
     return list(out[0])
 
-def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
+#(next free counter, needs listing) for each (folder, filename prefix), so the files that are still being written are accounted for
+save_image_counters = {}
+save_image_counters_mutex = threading.Lock()
+
+def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0, batch_size=None):
     def map_filename(filename):
         prefix_len = len(os.path.basename(filename_prefix))
         prefix = filename[:prefix_len + 1]
@@ -252,11 +257,26 @@ def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height
         print(err)
         raise Exception(err)
 
-    try:
-        counter = max(filter(lambda a: a[1][:-1] == filename and a[1][-1] == "_", map(map_filename, os.listdir(full_output_folder))))[0] + 1
-    except ValueError:
-        counter = 1
-    except FileNotFoundError:
-        os.makedirs(full_output_folder, exist_ok=True)
-        counter = 1
+    counter_key = (os.path.abspath(full_output_folder), filename)
+    with save_image_counters_mutex:
+        #the folder is listed again after callers that don't say how many files they save
+        entry = save_image_counters.get(counter_key, None)
+        if entry is None or entry[1]:
+            try:
+                counter = max(filter(lambda a: a[1][:-1] == filename and a[1][-1] == "_", map(map_filename, os.listdir(full_output_folder))))[0] + 1
+            except ValueError:
+                counter = 1
+            except FileNotFoundError:
+                os.makedirs(full_output_folder, exist_ok=True)
+                counter = 1
+            if entry is not None:
+                counter = max(counter, entry[0])
+        else:
+            counter = entry[0]
+            os.makedirs(full_output_folder, exist_ok=True)
+
+        if batch_size is None:
+            save_image_counters[counter_key] = (counter + 1, True)
+        else:
+            save_image_counters[counter_key] = (counter + batch_size, False)
     return full_output_folder, filename, counter, subfolder, filename_prefix
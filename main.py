@@ -5,6 +5,7 @@ import os
 import importlib.util
 import folder_paths
 import time
+import traceback
 
 def execute_prestartup_script():
     def execute_script(script_path):
@@ -51,7 +52,9 @@ import asyncio
 import itertools
 import shutil
 import threading
+import json
 import gc
+import logging
 
 from comfy.cli_args import args
 
@@ -75,9 +78,12 @@ import yaml
 
 import execution
 import server
+import server_extension
 from server import BinaryEventTypes
+import nodes
 from nodes import init_custom_nodes
 import comfy.model_management
+import comfy.model_patcher
 
 def cuda_malloc_warning():
     device = comfy.model_management.get_torch_device()
@@ -90,8 +96,85 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             print("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
+def execute_prompts(e, q, server, queue_items):
+    #returns the merged prompts that have to be executed again one at a time
+    item = queue_items[0][0]
+    prompt_id = item[1]
+    server.last_prompt_id = prompt_id
+    if len(queue_items) > 1:
+        prompt = execution.merge_prompts([x[0] for x in queue_items])
+    else:
+        prompt = item[2]
+
+    nodes.image_writer.start_batch()
+    e.execute(prompt, prompt_id, item[3], item[4])
+
+    coalesced = len(queue_items) > 1
+    retry = []
+    if coalesced:
+        outputs_ui = execution.split_coalesced_outputs_ui(e.outputs_ui, prompt)
+        if not e.success:
+            # a failure or an interrupt of some of the prompts shouldn't stop the others
+            retry = [x for x in queue_items if x[0][1] not in e.interrupted]
+            outputs_ui = [ui for x, ui in zip(queue_items, outputs_ui) if x[0][1] in e.interrupted]
+            queue_items = [x for x in queue_items if x[0][1] in e.interrupted]
+    else:
+        outputs_ui = [dict(e.outputs_ui)]
+
+    #the prompts are marked as done once their images are written, the next prompt can start before that
+    def prompts_done(errors, queue_items=queue_items, outputs_ui=outputs_ui, prompt=prompt, prompt_id=prompt_id, status_messages=e.status_messages, success=e.success, written_nodes=e.written_nodes):
+        failed_nodes = {}
+        for index, ex in errors:
+            for node_id, (start, end) in written_nodes.items():
+                if start <= index < end and node_id not in failed_nodes:
+                    failed_nodes[node_id] = ex
+        if len(failed_nodes) > 0:
+            success = False
+
+        for (item, item_id), item_outputs_ui in zip(queue_items, outputs_ui):
+            item_client_id = item[3].get("client_id", None)
+            messages = [(event, dict(data, prompt_id=item[1]) if "prompt_id" in data else data) for event, data in status_messages]
+            if coalesced and item_client_id is not None:
+                for event, data in messages:
+                    if event == "execution_interrupted":
+                        server.send_sync(event, data, item_client_id)
+            for node_id, ex in failed_nodes.items():
+                mes = {
+                    "prompt_id": item[1],
+                    "node_id": node_id,
+                    "node_type": prompt[node_id]["class_type"],
+                    "executed": [],
+                    "exception_message": str(ex),
+                    "exception_type": execution.full_type_name(type(ex)),
+                    "traceback": traceback.format_tb(ex.__traceback__),
+                    "current_inputs": {},
+                    "current_outputs": {},
+                }
+                messages.append(("execution_error", mes))
+                if item_client_id is not None:
+                    server.send_sync("execution_error", mes, item_client_id)
+
+            if item_client_id is not None:
+                for node_id, output_ui in item_outputs_ui.items():
+                    varying = coalesced and node_id in prompt.varying
+                    if (varying or node_id in written_nodes) and node_id not in failed_nodes:
+                        server.send_sync("executed", { "node": node_id, "output": output_ui, "prompt_id": item[1] }, item_client_id)
+
+            q.task_done(item_id,
+                        item_outputs_ui,
+                        status=execution.PromptQueue.ExecutionStatus(
+                            status_str='success' if success else 'error',
+                            completed=success,
+                            messages=messages))
+            if item_client_id is not None:
+                server.progress = {'status':'executing',"node": None, "prompt_id": item[1]}
+                server.send_sync("executing", { "node": None, "prompt_id": item[1] }, item_client_id)
+    nodes.image_writer.end_batch(prompts_done)
+    return retry
+
 def prompt_worker(q, server):
     e = execution.PromptExecutor(server)
+    free_memory_requests = q.free_memory_requests
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -103,22 +186,23 @@ def prompt_worker(q, server):
 
         queue_item = q.get(timeout=timeout)
         if queue_item is not None:
-            item, item_id = queue_item
-            execution_start_time = time.perf_counter()
-            prompt_id = item[1]
-            server.last_prompt_id = prompt_id
+            queue_items = [queue_item]
+            if args.coalesce_prompts > 1:
+                queue_items += q.get_coalesced(queue_item[0], args.coalesce_prompts - 1)
 
-            e.execute(item[2], prompt_id, item[3], item[4])
+            execution_start_time = time.perf_counter()
+            if len(queue_items) > 1:
+                logging.info("Coalesced {} prompts into one execution".format(len(queue_items)))
+                for x in queue_items[1:]:
+                    server.prompt_status.update(x[0][1], state="executing", coalesced_with=queue_item[0][1])
+                retry = execute_prompts(e, q, server, queue_items)
+                if len(retry) > 0:
+                    logging.info("Coalesced execution failed, running {} prompts one at a time".format(len(retry)))
+                for x in retry:
+                    execute_prompts(e, q, server, [x])
+            else:
+                execute_prompts(e, q, server, queue_items)
             need_gc = True
-            q.task_done(item_id,
-                        e.outputs_ui,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server.client_id is not None:
-                server.progress = {'status':'executing',"node": None, "prompt_id": prompt_id}
-                server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
 
             current_time = time.perf_counter()
             execution_time = current_time - execution_start_time
@@ -128,11 +212,20 @@ def prompt_worker(q, server):
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
-            comfy.model_management.unload_all_models()
+            with comfy.model_management.device_mutex:
+                comfy.model_management.unload_all_models()
             need_gc = True
             last_gc_collect = 0
 
         if free_memory:
+            #the flags are taken by one worker, the shared caches are cleared once
+            with comfy.model_management.device_mutex:
+                execution.node_output_cache.clear()
+                comfy.model_patcher.patched_weights_cache.clear()
+
+        if q.free_memory_requests != free_memory_requests:
+            #every worker drops the outputs of its own executor
+            free_memory_requests = q.free_memory_requests
             e.reset()
             need_gc = True
             last_gc_collect = 0
@@ -141,10 +234,116 @@ def prompt_worker(q, server):
             current_time = time.perf_counter()
             if (current_time - last_gc_collect) > gc_collect_interval:
                 gc.collect()
-                comfy.model_management.soft_empty_cache()
+                with comfy.model_management.device_mutex:
+                    comfy.model_management.soft_empty_cache()
                 last_gc_collect = current_time
                 need_gc = False
 
+WARMUP_LOADERS = {
+    "checkpoints": ("CheckpointLoaderSimple", "ckpt_name"),
+    "vae": ("VAELoader", "vae_name"),
+    "controlnet": ("ControlNetLoader", "control_net_name"),
+    "upscale_models": ("UpscaleModelLoader", "model_name"),
+    "clip_vision": ("CLIPVisionLoader", "clip_name"),
+}
+
+def find_model_patchers(obj, depth=0):
+    #the loaders return ModelPatchers directly or objects (CLIP, VAE, ControlNet) holding one
+    if isinstance(obj, comfy.model_patcher.ModelPatcher):
+        return [obj]
+    if isinstance(obj, (list, tuple)):
+        return [p for x in obj for p in find_model_patchers(x, depth)]
+    if isinstance(obj, dict):
+        return [p for x in obj.values() for p in find_model_patchers(x, depth)]
+    if depth == 0 and hasattr(obj, "__dict__"):
+        return [p for x in vars(obj).values() for p in find_model_patchers(x, depth + 1)]
+    return []
+
+def load_warmup_prompts(config_path):
+    with open(config_path, 'r') as stream:
+        config = yaml.safe_load(stream)
+
+    prompts = []
+    for workflow_path in config.get("workflows", []):
+        with open(workflow_path, 'r') as f:
+            prompts.append((workflow_path, json.load(f)))
+
+    #model files are (folder, name), each one is loaded on its own with the matching loader node
+    models = []
+    for folder, names in config.get("models", {}).items():
+        if folder not in WARMUP_LOADERS:
+            logging.warning("Warmup: no loader for model folder {}".format(folder))
+            continue
+        models += [(folder, name) for name in names]
+    return prompts, models, config.get("pin", True)
+
+def pin_outputs(prompt, outputs):
+    #the outputs stay in the shared node cache so later prompts get the same pinned models
+    signatures = {}
+    for node_id in outputs:
+        signature = execution.get_node_signature(prompt, node_id, signatures)
+        if signature is not None:
+            execution.node_output_cache.set(signature, outputs[node_id], pin=True)
+        for patcher in find_model_patchers(outputs[node_id]):
+            comfy.model_management.pin_model(patcher)
+
+def warmup_model(folder, name, pin):
+    #loaders aren't output nodes so a prompt with only a loader wouldn't validate, the node is run directly
+    class_type, input_name = WARMUP_LOADERS[folder]
+    if name not in folder_paths.get_filename_list(folder):
+        logging.warning("Warmup: model not found {}/{}".format(folder, name))
+        return False
+    prompt = {"1": {"class_type": class_type, "inputs": {input_name: name}}}
+    obj = nodes.NODE_CLASS_MAPPINGS[class_type]()
+    try:
+        output_data, _ = execution.get_output_data(obj, {input_name: [name]})
+    except Exception as e:
+        logging.warning("Warmup: failed to load {}/{}: {}".format(folder, name, e))
+        return False
+    if pin:
+        pin_outputs(prompt, {"1": output_data})
+    return True
+
+def warmup(server, config_path):
+    try:
+        prompts, models, pin = load_warmup_prompts(config_path)
+    except Exception as e:
+        logging.warning("Failed to load warmup config {}: {}".format(config_path, e))
+        return
+
+    for folder, name in models:
+        start_time = time.perf_counter()
+        if warmup_model(folder, name, pin):
+            logging.info("Warmup: {}/{} loaded in {:.2f} seconds".format(folder, name, time.perf_counter() - start_time))
+
+    e = execution.PromptExecutor(server)
+    for i, (name, prompt) in enumerate(prompts):
+        valid = execution.validate_prompt(prompt)
+        if not valid[0]:
+            logging.warning("Warmup: invalid prompt {}: {}".format(name, valid[1]))
+            continue
+
+        execution_start_time = time.perf_counter()
+        e.execute(prompt, "warmup-{}".format(i), {}, valid[2])
+        if not e.success:
+            logging.warning("Warmup: failed to execute {}".format(name))
+            continue
+
+        if pin:
+            pin_outputs(prompt, e.outputs)
+        logging.info("Warmup: {} done in {:.2f} seconds".format(name, time.perf_counter() - execution_start_time))
+
+    logging.info("Warmup finished, {} models pinned".format(len(comfy.model_management.pinned_models)))
+
+def start_prompt_workers(q, server, warmup_config=None):
+    #the workers only start once the warmup models are loaded and pinned, prompts sent before that wait in the queue
+    if warmup_config is not None:
+        warmup(server, warmup_config)
+    for i in range(max(1, args.prompt_workers)):
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+    server.ready = True
+
+
 async def run(server, address='', port=8188, verbose=True, call_on_start=None):
     await asyncio.gather(server.start(address, port, verbose, call_on_start), server.publish_loop())
 
@@ -152,11 +351,13 @@ async def run(server, address='', port=8188, verbose=True, call_on_start=None):
 def hijack_progress(server):
     def hook(value, total, preview_image):
         comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id}
-        server.progress = progress
-        server.send_sync("progress", progress, server.client_id)
-        if preview_image is not None:
-            server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
+        server.progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": execution.current_node()}
+        #merged prompts send the progress to the clients of all of them
+        for client_id, prompt_id in execution.current_clients():
+            progress = {"value": value, "max": total, "prompt_id": prompt_id, "node": execution.current_node()}
+            server.send_sync("progress", progress, client_id)
+            if preview_image is not None:
+                server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, client_id)
     comfy.utils.set_progress_bar_global_hook(hook)
 
 
@@ -194,6 +395,9 @@ if __name__ == "__main__":
         folder_paths.set_temp_directory(temp_dir)
     cleanup_temp()
 
+    if args.model_index_directory is None:
+        args.model_index_directory = os.path.join(folder_paths.user_directory, "model_index")
+
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
@@ -214,7 +418,14 @@ if __name__ == "__main__":
     server.add_routes()
     hijack_progress(server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+    #encode the thumbnails of the server extension before the first request
+    def build_thumbnails():
+        try:
+            extension = server_extension.ServerExtension()
+            extension.build_thumbnail_bundle(server_extension.parsed_file_cache.load(os.path.join('input', 'styles', 'styles_config.json'), server_extension.parse_styles))
+        except Exception as e:
+            print("Failed to build the thumbnail bundle:", e)
+    threading.Thread(target=build_thumbnails, daemon=True).start()
 
     if args.output_directory:
         output_dir = os.path.abspath(args.output_directory)
@@ -231,6 +442,9 @@ if __name__ == "__main__":
         print(f"Setting input directory to: {input_dir}")
         folder_paths.set_input_directory(input_dir)
 
+    server.ready = False
+    threading.Thread(target=start_prompt_workers, daemon=True, args=(q, server, args.warmup_config)).start()
+
     if args.quick_test_for_ci:
         exit(0)
 
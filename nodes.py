@@ -5,12 +5,17 @@ import sys
 import json
 import hashlib
 import traceback
+import logging
 import math
 import time
 import random
+import collections
+import threading
+import concurrent.futures
 
 from PIL import Image, ImageOps, ImageSequence
 from PIL.PngImagePlugin import PngInfo
+from io import BytesIO
 import numpy as np
 import safetensors.torch
 
@@ -37,8 +42,8 @@ import latent_preview
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
 
-def interrupt_processing(value=True):
-    comfy.model_management.interrupt_current_processing(value)
+def interrupt_processing(value=True, prompt_ids=None):
+    comfy.model_management.interrupt_current_processing(value, prompt_ids)
 
 MAX_RESOLUTION=8192
 
@@ -645,7 +650,7 @@ class LoraLoader:
             lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
             self.loaded_lora = (lora_path, lora)
 
-        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
+        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip, lora_path)
         return (model_lora, clip_lora)
 
 class LoraLoaderModelOnly(LoraLoader):
@@ -1334,7 +1339,18 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+        batch_seeds = getattr(seed, "batch_seeds", None)
+        if batch_seeds is not None:
+            #coalesced prompts sampled in one batch, the samples of each prompt get the noise of its own seed
+            noise = []
+            start = 0
+            for s, size in batch_seeds:
+                inds = batch_inds[start:start + size] if batch_inds is not None else None
+                noise.append(comfy.sample.prepare_noise(latent_image[start:start + size], s, inds))
+                start += size
+            noise = torch.cat(noise)
+        else:
+            noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
 
     noise_mask = None
     if "noise_mask" in latent:
@@ -1408,6 +1424,66 @@ class KSamplerAdvanced:
             disable_noise = True
         return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
 
+class ImageWriter:
+    #encodes and writes images in a thread pool, end_batch runs a callback once everything saved since start_batch is on disk
+    def __init__(self, threads):
+        self.executor = None
+        if threads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image_writer")
+        self.local = threading.local()
+
+    def start_batch(self):
+        self.local.futures = []
+
+    def submit(self, function, *args, **kwargs):
+        futures = getattr(self.local, "futures", None)
+        if self.executor is None or futures is None:
+            function(*args, **kwargs)
+        else:
+            futures.append(self.executor.submit(function, *args, **kwargs))
+
+    def pending(self):
+        #number of writes submitted since start_batch, the index of the next one
+        futures = getattr(self.local, "futures", None)
+        return 0 if futures is None else len(futures)
+
+    def end_batch(self, callback):
+        #callback gets the (index, exception) of the writes that failed
+        futures = getattr(self.local, "futures", None)
+        self.local.futures = None
+        if not futures:
+            callback([])
+            return
+
+        remaining = [len(futures)]
+        errors = []
+        mutex = threading.Lock()
+        def done(future):
+            if future.exception() is not None:
+                logging.error("Error saving image: {}".format(future.exception()))
+            with mutex:
+                if future.exception() is not None:
+                    errors.append((futures.index(future), future.exception()))
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                callback(sorted(errors, key=lambda x: x[0]))
+            except Exception:
+                logging.error(traceback.format_exc())
+        for future in futures:
+            future.add_done_callback(done)
+
+image_writer = ImageWriter(args.image_writer_threads)
+
+def write_image(img, path, image_format, metadata, compress_level):
+    if image_format == "png":
+        img.save(path, pnginfo=metadata, compress_level=compress_level)
+    elif image_format == "webp":
+        img.save(path, quality=90, method=4)
+    else:
+        img.save(path, quality=95)
+
 class SaveImage:
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
@@ -1420,6 +1496,7 @@ class SaveImage:
         return {"required": 
                     {"images": ("IMAGE", ),
                      "filename_prefix": ("STRING", {"default": "ComfyUI"})},
+                "optional": {"format": (["png", "webp", "jpeg"], )},
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
                 }
 
@@ -1427,18 +1504,21 @@ class SaveImage:
     FUNCTION = "save_images"
 
     OUTPUT_NODE = True
+    CPU_ONLY = True
 
     CATEGORY = "image"
 
-    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+    write_async = True
+
+    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None, format="png"):
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0], batch_size=len(images))
         results = list()
         for image in images:
             i = 255. * image.cpu().numpy()
             img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
             metadata = None
-            if not args.disable_metadata:
+            if not args.disable_metadata and format == "png":
                 metadata = PngInfo()
                 if prompt is not None:
                     metadata.add_text("prompt", json.dumps(prompt))
@@ -1446,8 +1526,11 @@ class SaveImage:
                     for x in extra_pnginfo:
                         metadata.add_text(x, json.dumps(extra_pnginfo[x]))
 
-            file = f"{filename}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
+            file = f"{filename}_{counter:05}_.{format}"
+            if self.write_async:
+                image_writer.submit(write_image, img, os.path.join(full_output_folder, file), format, metadata, self.compress_level)
+            else:
+                write_image(img, os.path.join(full_output_folder, file), format, metadata, self.compress_level)
             results.append({
                 "filename": file,
                 "subfolder": subfolder,
@@ -1458,6 +1541,9 @@ class SaveImage:
         return { "ui": { "images": results } }
 
 class PreviewImage(SaveImage):
+    #the frontend loads previews as soon as the node is executed
+    write_async = False
+
     def __init__(self):
         self.output_dir = folder_paths.get_temp_directory()
         self.type = "temp"
@@ -1471,6 +1557,210 @@ class PreviewImage(SaveImage):
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
                 }
 
+def memory_result_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(map(memory_result_size, value))
+    if isinstance(value, dict):
+        return sum(map(memory_result_size, value.values()))
+    return 0
+
+class MemoryResultStore:
+    #images handed between the server extension and the graph without going through the input and output folders.
+    #pinned entries (uploads of prompts that aren't done) are kept until unpinned or popped and don't count towards
+    #max_bytes, the others are dropped after ttl seconds or oldest first once they use more than max_bytes
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.pinned_bytes = 0
+        self.mutex = threading.Lock()
+
+    def purge_expired(self):
+        now = time.monotonic()
+        for key in list(self.entries.keys()):
+            expiry, value, size = self.entries[key]
+            if expiry is None:
+                continue
+            if expiry > now and self.total_bytes <= self.max_bytes:
+                break
+            self.entries.pop(key)
+            self.total_bytes -= size
+
+    def put(self, key, value, pin=False):
+        with self.mutex:
+            self.remove(key)
+            size = memory_result_size(value)
+            self.entries[key] = (None if pin else time.monotonic() + self.ttl, value, size)
+            if pin:
+                self.pinned_bytes += size
+            else:
+                self.total_bytes += size
+            self.purge_expired()
+
+    def unpin(self, key):
+        #the ttl of a pinned entry starts now
+        with self.mutex:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] is None:
+                self.entries[key] = (time.monotonic() + self.ttl, entry[1], entry[2])
+                self.entries.move_to_end(key)
+                self.pinned_bytes -= entry[2]
+                self.total_bytes += entry[2]
+            self.purge_expired()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry[0] is None:
+                self.pinned_bytes -= entry[2]
+            else:
+                self.total_bytes -= entry[2]
+        return entry
+
+    def get(self, key):
+        with self.mutex:
+            self.purge_expired()
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            return entry[1]
+
+    def pop(self, key):
+        with self.mutex:
+            self.purge_expired()
+            entry = self.remove(key)
+            if entry is None:
+                return None
+            return entry[1]
+
+memory_results = MemoryResultStore(args.memory_result_ttl, args.memory_result_ram * 1024 * 1024)
+
+def encode_image(img, image_format="png", compress_level=4):
+    buffer = BytesIO()
+    if image_format == "png":
+        img.save(buffer, format="png", compress_level=compress_level)
+    else:
+        img.save(buffer, format=image_format, quality=90)
+    return buffer.getvalue()
+
+class SaveImageMemory:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"images": ("IMAGE", ),
+                     "result_key": ("STRING", {"default": ""})},
+                "optional": {"format": (["png", "webp", "jpeg"], )},
+                }
+
+    RETURN_TYPES = ()
+    FUNCTION = "save_images"
+
+    OUTPUT_NODE = True
+    CPU_ONLY = True
+
+    CATEGORY = "image"
+
+    def save_images(self, images, result_key, format="png"):
+        imgs = []
+        for image in images:
+            i = 255. * image.cpu().numpy()
+            imgs.append(Image.fromarray(np.clip(i, 0, 255).astype(np.uint8)))
+
+        def store():
+            memory_results.put(result_key, {"images": [encode_image(img, format) for img in imgs], "format": format})
+        image_writer.submit(store)
+        return { "ui": { "memory_images": [{"result_key": result_key, "count": len(imgs), "format": format}] } }
+
+class LoadedImageCache:
+    #decoded images and content hashes of loaded files, an entry is only used while the file mtime and size are unchanged
+    def __init__(self, max_bytes, max_hashes=1024):
+        self.max_bytes = max_bytes
+        self.max_hashes = max_hashes
+        self.images = collections.OrderedDict()
+        self.hashes = collections.OrderedDict()
+        self.total_bytes = 0
+        self.mutex = threading.Lock()
+
+    def file_key(self, image_path):
+        st = os.stat(image_path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def get_hash(self, image_path):
+        file_key = self.file_key(image_path)
+        with self.mutex:
+            entry = self.hashes.get(image_path, None)
+            if entry is not None and entry[0] == file_key:
+                self.hashes.move_to_end(image_path)
+                return entry[1]
+
+        m = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            m.update(f.read())
+        h = m.digest().hex()
+        with self.mutex:
+            self.hashes[image_path] = (file_key, h)
+            self.hashes.move_to_end(image_path)
+            while len(self.hashes) > self.max_hashes:
+                self.hashes.popitem(last=False)
+        return h
+
+    def get_image(self, image_path):
+        file_key = self.file_key(image_path)
+        with self.mutex:
+            entry = self.images.get(image_path, None)
+            if entry is None:
+                return None
+            if entry[0] != file_key:
+                self.total_bytes -= self.images.pop(image_path)[2]
+                return None
+            self.images.move_to_end(image_path)
+            return entry[1]
+
+    def set_image(self, image_path, output):
+        size = sum(x.nelement() * x.element_size() for x in output)
+        if size > self.max_bytes:
+            return
+        file_key = self.file_key(image_path)
+        with self.mutex:
+            if image_path in self.images:
+                self.total_bytes -= self.images.pop(image_path)[2]
+            self.images[image_path] = (file_key, output, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.images.popitem(last=False)[1][2]
+
+loaded_image_cache = LoadedImageCache(args.image_cache_ram * 1024 * 1024)
+
+def load_image_frames(img):
+    output_images = []
+    output_masks = []
+    for i in ImageSequence.Iterator(img):
+        i = ImageOps.exif_transpose(i)
+        if i.mode == 'I':
+            i = i.point(lambda i: i * (1 / 255))
+        image = i.convert("RGB")
+        image = np.array(image).astype(np.float32) / 255.0
+        image = torch.from_numpy(image)[None,]
+        if 'A' in i.getbands():
+            mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
+            mask = 1. - torch.from_numpy(mask)
+        else:
+            mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
+        output_images.append(image)
+        output_masks.append(mask.unsqueeze(0))
+
+    if len(output_images) > 1:
+        output_image = torch.cat(output_images, dim=0)
+        output_mask = torch.cat(output_masks, dim=0)
+    else:
+        output_image = output_images[0]
+        output_mask = output_masks[0]
+
+    return (output_image, output_mask)
+
 class LoadImage:
     @classmethod
     def INPUT_TYPES(s):
@@ -1484,42 +1774,23 @@ class LoadImage:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    CPU_ONLY = True
+
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
-        img = Image.open(image_path)
-        output_images = []
-        output_masks = []
-        for i in ImageSequence.Iterator(img):
-            i = ImageOps.exif_transpose(i)
-            if i.mode == 'I':
-                i = i.point(lambda i: i * (1 / 255))
-            image = i.convert("RGB")
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None,]
-            if 'A' in i.getbands():
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
-            else:
-                mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
-            output_images.append(image)
-            output_masks.append(mask.unsqueeze(0))
+        cached = loaded_image_cache.get_image(image_path)
+        if cached is not None:
+            return cached
 
-        if len(output_images) > 1:
-            output_image = torch.cat(output_images, dim=0)
-            output_mask = torch.cat(output_masks, dim=0)
-        else:
-            output_image = output_images[0]
-            output_mask = output_masks[0]
-
-        return (output_image, output_mask)
+        img = Image.open(image_path)
+        output = load_image_frames(img)
+        loaded_image_cache.set_image(image_path, output)
+        return output
 
     @classmethod
     def IS_CHANGED(s, image):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return loaded_image_cache.get_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1528,6 +1799,37 @@ class LoadImage:
 
         return True
 
+class LoadImageMemory:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"image": ("STRING", {"default": ""})},
+                }
+
+    CATEGORY = "image"
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "load_image"
+    CPU_ONLY = True
+
+    def load_image(self, image):
+        entry = memory_results.get(image)
+        if entry is None:
+            raise Exception("Image not found in memory or expired: {}".format(image))
+        img = Image.open(BytesIO(entry["data"]))
+        return load_image_frames(img)
+
+    @classmethod
+    def IS_CHANGED(s, image):
+        #every key is only used once, don't keep the result in the node cache
+        return float("NaN")
+
+    @classmethod
+    def VALIDATE_INPUTS(s, image):
+        if memory_results.get(image) is None:
+            return "Image not found in memory: {}".format(image)
+        return True
+
 class LoadImageMask:
     _color_channels = ["alpha", "red", "green", "blue"]
     @classmethod
@@ -1543,6 +1845,8 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    CPU_ONLY = True
+
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = Image.open(image_path)
@@ -1565,10 +1869,7 @@ class LoadImageMask:
     @classmethod
     def IS_CHANGED(s, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return loaded_image_cache.get_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1760,8 +2061,10 @@ NODE_CLASS_MAPPINGS = {
     "LatentFromBatch": LatentFromBatch,
     "RepeatLatentBatch": RepeatLatentBatch,
     "SaveImage": SaveImage,
+    "SaveImageMemory": SaveImageMemory,
     "PreviewImage": PreviewImage,
     "LoadImage": LoadImage,
+    "LoadImageMemory": LoadImageMemory,
     "LoadImageMask": LoadImageMask,
     "ImageScale": ImageScale,
     "ImageScaleBy": ImageScaleBy,
@@ -1859,8 +2162,10 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "RepeatLatentBatch": "Repeat Latent Batch",
     # Image
     "SaveImage": "Save Image",
+    "SaveImageMemory": "Save Image (Memory)",
     "PreviewImage": "Preview Image",
     "LoadImage": "Load Image",
+    "LoadImageMemory": "Load Image (Memory)",
     "LoadImageMask": "Load Image (as Mask)",
     "ImageScale": "Upscale Image",
     "ImageScaleBy": "Upscale Image By",
@@ -12,10 +12,14 @@ import urllib
 import json
 import glob
 import struct
+import threading
+import shutil
+import time
+import collections
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
-from server_extension import ServerExtension
+from server_extension import ServerExtension, read_multipart
 
 try:
     import aiohttp
@@ -37,6 +41,46 @@ from app.user_manager import UserManager
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
     UNENCODED_PREVIEW_IMAGE = 2
+    #4 bytes prompt_id length, the prompt_id and the encoded image
+    RESULT_IMAGE = 3
+
+class PromptStatusTable:
+    #last known state of every recent prompt, filled from the queue and the messages sent to the clients
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.table = collections.OrderedDict()
+        self.mutex = threading.Lock()
+
+    def update(self, prompt_id, **kwargs):
+        with self.mutex:
+            entry = self.table.pop(prompt_id, None)
+            if entry is None:
+                entry = {"prompt_id": prompt_id, "state": None, "node": None, "value": 0, "max": 0}
+            entry.update(kwargs)
+            entry["updated"] = time.time()
+            self.table[prompt_id] = entry
+            while len(self.table) > self.max_size:
+                self.table.popitem(last=False)
+
+    def update_from_event(self, event, data):
+        prompt_id = data["prompt_id"]
+        if event == "execution_start":
+            self.update(prompt_id, state="executing")
+        elif event == "executing" and data.get("node", None) is not None:
+            self.update(prompt_id, node=data["node"], value=0, max=0)
+        elif event == "progress":
+            self.update(prompt_id, value=data["value"], max=data["max"])
+        elif event == "execution_error":
+            self.update(prompt_id, state="error", error=data.get("exception_message", None))
+        elif event == "execution_interrupted":
+            self.update(prompt_id, state="interrupted")
+
+    def get(self, prompt_id):
+        with self.mutex:
+            entry = self.table.get(prompt_id, None)
+            if entry is None:
+                return None
+            return dict(entry)
 
 async def send_socket_catch_exception(function, message):
     try:
@@ -44,6 +88,77 @@ async def send_socket_catch_exception(function, message):
     except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError) as err:
         print("send error:", err)
 
+WS_OUTBOX_SIZE = 256
+#a socket whose outbox stays full for this many seconds is disconnected
+WS_STALL_TIMEOUT = 30.0
+#only the latest pending message of these events is sent
+COALESCED_EVENTS = {"progress": "progress", "status": "status", BinaryEventTypes.PREVIEW_IMAGE: "preview"}
+#the pending messages that can be dropped when an outbox is full
+WS_DROPPABLE = ["progress", "preview"]
+
+class SocketOutbox:
+    #messages waiting to be sent to one websocket, each socket is sent to by its own task so a slow client doesn't hold up the others
+    def __init__(self, ws, counters, max_size=WS_OUTBOX_SIZE):
+        self.ws = ws
+        self.counters = counters
+        self.max_size = max_size
+        self.messages = collections.deque()
+        self.event = asyncio.Event()
+        self.full_since = None
+        self.closing = False
+
+    def put(self, message, coalesce_key=None):
+        if self.closing:
+            return
+        if coalesce_key is not None:
+            for i in range(len(self.messages)):
+                if self.messages[i][0] == coalesce_key:
+                    del self.messages[i]
+                    self.counters["coalesced"] += 1
+                    break
+
+        if len(self.messages) >= self.max_size:
+            # only progress and previews can be dropped, the client catches up with the next one
+            for i in range(len(self.messages)):
+                if self.messages[i][0] in WS_DROPPABLE:
+                    del self.messages[i]
+                    self.counters["dropped"] += 1
+                    break
+            else:
+                if coalesce_key in WS_DROPPABLE:
+                    self.counters["dropped"] += 1
+                    return
+                # dropping results or the end of a prompt would leave the client waiting, it has to reconnect instead
+                self.close()
+                return
+            if self.full_since is None:
+                self.full_since = time.monotonic()
+            elif time.monotonic() - self.full_since > WS_STALL_TIMEOUT:
+                self.close()
+                return
+        else:
+            self.full_since = None
+
+        self.messages.append((coalesce_key, message))
+        self.event.set()
+
+    def close(self):
+        self.closing = True
+        self.messages.clear()
+        self.counters["disconnected"] += 1
+        asyncio.ensure_future(self.ws.close())
+
+    async def run(self):
+        while not self.ws.closed:
+            await self.event.wait()
+            self.event.clear()
+            while len(self.messages) > 0 and not self.ws.closed:
+                coalesce_key, message = self.messages.popleft()
+                if isinstance(message, str):
+                    await send_socket_catch_exception(self.ws.send_str, message)
+                else:
+                    await send_socket_catch_exception(self.ws.send_bytes, message)
+
 @web.middleware
 async def cache_control(request: web.Request, handler):
     response: web.Response = await handler(request)
@@ -69,11 +184,27 @@ def create_cors_middleware(allowed_origin: str):
     return cors_middleware
 
 class PromptServer():
-    
+    # client_id, last_node_id and last_prompt_id describe the prompt being executed. Each prompt worker
+    # thread sees its own values, other threads (the event loop) see the ones that were set last.
+    def _get_execution_value(self, name):
+        return getattr(self._execution_context, name, self._last_execution_values.get(name))
+
+    def _set_execution_value(self, name, value):
+        setattr(self._execution_context, name, value)
+        self._last_execution_values[name] = value
+
+    client_id = property(lambda self: self._get_execution_value("client_id"),
+                         lambda self, value: self._set_execution_value("client_id", value))
+    last_node_id = property(lambda self: self._get_execution_value("last_node_id"),
+                            lambda self, value: self._set_execution_value("last_node_id", value))
+    last_prompt_id = property(lambda self: self._get_execution_value("last_prompt_id"),
+                              lambda self, value: self._set_execution_value("last_prompt_id", value))
 
     def __init__(self, loop):
         PromptServer.instance = self
-        
+        self._execution_context = threading.local()
+        self._last_execution_values = {}
+
         mimetypes.init()
         mimetypes.types_map['.js'] = 'application/javascript; charset=utf-8'
 
@@ -83,6 +214,8 @@ class PromptServer():
         self.loop = loop
         self.messages = asyncio.Queue()
         self.number = 0
+        self.ready = True
+        self.prompt_status = PromptStatusTable()
 
         middlewares = [cache_control]
         if args.enable_cors_header:
@@ -91,6 +224,8 @@ class PromptServer():
         max_upload_size = round(args.max_upload_size * 1024 * 1024)
         self.app = web.Application(client_max_size=max_upload_size, middlewares=middlewares)
         self.sockets = dict()
+        self.outboxes = dict()
+        self.ws_counters = {"dropped": 0, "coalesced": 0, "disconnected": 0}
         self.web_root = os.path.join(os.path.dirname(
             os.path.realpath(__file__)), "web")
         routes = web.RouteTableDef()
@@ -108,9 +243,14 @@ class PromptServer():
         @routes.get("/thumbnails")
         async def thumbnails(request):
             server_extension = ServerExtension()
-            thumbnails_json = await server_extension.thumbnails(request)
-            return web.json_response(thumbnails_json)
+            return await server_extension.thumbnails(request)
             return await server_extension.thumbnails(request,self) 
+
+        @routes.get("/thumbnails/{name}")
+        async def thumbnail_image(request):
+            server_extension = ServerExtension()
+            return await server_extension.thumbnail_image(request)
+
         @routes.get('/ws')
         async def websocket_handler(request):
             ws = web.WebSocketResponse()
@@ -123,10 +263,13 @@ class PromptServer():
                 sid = uuid.uuid4().hex
 
             self.sockets[sid] = ws
+            outbox = SocketOutbox(ws, self.ws_counters)
+            self.outboxes[sid] = outbox
+            sender = asyncio.ensure_future(outbox.run())
 
             try:
-                # Send initial state to the new client
-                await self.send("status", { "status": self.get_queue_info(), 'sid': sid }, sid)
+                # Send initial state to the new client, not coalesced since it is the only status with the sid
+                outbox.put(json.dumps({"type": "status", "data": { "status": self.get_queue_info(), 'sid': sid }}))
                 # On reconnect if we are the currently executing client send the current node
                 if self.client_id == sid and self.last_node_id is not None:
                     await self.send("executing", { "node": self.last_node_id }, sid)
@@ -135,12 +278,35 @@ class PromptServer():
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         print('ws connection closed with exception %s' % ws.exception())
             finally:
-                self.sockets.pop(sid, None)
+                if self.sockets.get(sid, None) is ws:
+                    self.sockets.pop(sid, None)
+                    self.outboxes.pop(sid, None)
+                sender.cancel()
             return ws
+
+        @routes.get("/ws/metrics")
+        async def get_ws_metrics(request):
+            metrics = dict(self.ws_counters)
+            metrics["sockets"] = len(self.outboxes)
+            metrics["pending"] = sum(len(x.messages) for x in self.outboxes.values())
+            return web.json_response(metrics)
         
         @routes.get("/prompt_status/{prompt_id}")
         async def get_prompt_status(request):
             prompt_id = request.match_info.get("prompt_id", None)
+            prompt_status = self.prompt_status.get(prompt_id)
+            if prompt_status is not None:
+                # same status and node as before the state table: 200 with the progress while running,
+                # "executing" with no node once done and 400 while it isn't running yet
+                if prompt_status["state"] == "executing":
+                    prompt_status["status"] = 200
+                elif prompt_status["state"] in (None, "queued", "deleted"):
+                    prompt_status["status"] = 400
+                    prompt_status["error"] = "prompt_id not found"
+                else:
+                    prompt_status["status"] = "executing"
+                    prompt_status["node"] = None
+                return web.json_response(prompt_status)
             if prompt_id == self.progress["prompt_id"]:
                 progress = self.progress
                 if "status" not in self.progress:
@@ -230,8 +396,43 @@ class PromptServer():
 
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            # the image is streamed to a file in the temp directory since the fields saying where it goes can come after it
+            loop = asyncio.get_running_loop()
+            temp_dir = folder_paths.get_temp_directory()
+            os.makedirs(temp_dir, exist_ok=True)
+            temp_path = os.path.join(temp_dir, "upload_" + uuid.uuid4().hex)
+            f = await loop.run_in_executor(None, open, temp_path, "wb")
+            try:
+                try:
+                    post, filename, error = await read_multipart(request, "image", f)
+                finally:
+                    await loop.run_in_executor(None, f.close)
+                if error is not None:
+                    return web.json_response({"error": error}, status=400)
+                if not filename:
+                    return web.Response(status=400)
+
+                upload_dir, image_upload_type = get_dir_by_type(post.get("type"))
+                subfolder = post.get("subfolder", "")
+                full_output_folder = os.path.join(upload_dir, os.path.normpath(subfolder))
+                filepath = os.path.abspath(os.path.join(full_output_folder, filename))
+
+                if os.path.commonpath((upload_dir, filepath)) != upload_dir:
+                    return web.Response(status=400)
+
+                os.makedirs(full_output_folder, exist_ok=True)
+
+                overwrite = post.get("overwrite")
+                if not (overwrite == "true" or overwrite == "1") and os.path.exists(filepath):
+                    split = os.path.splitext(filename)
+                    filename = f"{split[0]}_{uuid.uuid4().hex[:8]}{split[1]}"
+                    filepath = os.path.join(full_output_folder, filename)
+
+                await loop.run_in_executor(None, shutil.move, temp_path, filepath)
+                return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
 
         @routes.post("/remove")
         async def remove_image(request):
@@ -377,6 +578,10 @@ class PromptServer():
 
             return web.Response(status=404)
 
+        @routes.get("/view_extention/metrics")
+        async def view_extention_metrics(request):
+            return web.json_response(ServerExtension.prompts.get_metrics())
+
         @routes.get("/view_extention")
         async def view_extention(request):
             serverextention = ServerExtension()
@@ -521,6 +726,11 @@ class PromptServer():
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                if "priority" in json_data:
+                    extra_data["priority"] = json_data["priority"]
+                valid_priority = execution.validate_priority(extra_data.get("priority", execution.DEFAULT_PRIORITY))
+                if not valid_priority[0]:
+                    return web.json_response({"error": valid_priority[1], "node_errors": []}, status=400)
                 if valid[0]:
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
@@ -534,6 +744,17 @@ class PromptServer():
             else:
                 return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
 
+        @routes.get("/queue/metrics")
+        async def get_queue_metrics(request):
+            return web.json_response(self.prompt_queue.get_queue_metrics())
+
+        @routes.get("/health")
+        async def get_health(request):
+            health = {"ready": self.ready,
+                      "queue_remaining": self.prompt_queue.get_tasks_remaining(),
+                      "pinned_models": len(comfy.model_management.pinned_models)}
+            return web.json_response(health, status=200 if self.ready else 503)
+
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
@@ -550,7 +771,16 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            # with a prompt_id only that prompt is stopped, otherwise every running one
+            prompt_id = request.rel_url.query.get("prompt_id", None)
+            if request.can_read_body:
+                try:
+                    json_data = await request.json()
+                except ValueError:
+                    json_data = None
+                if isinstance(json_data, dict):
+                    prompt_id = json_data.get("prompt_id", prompt_id)
+            nodes.interrupt_processing(prompt_ids=None if prompt_id is None else [prompt_id])
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -638,27 +868,27 @@ class PromptServer():
         preview_bytes = bytesIO.getvalue()
         await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
-    async def send_bytes(self, event, data, sid=None):
-        message = self.encode_bytes(event, data)
-
+    def enqueue(self, message, sid=None, coalesce_key=None):
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
+            outboxes = list(self.outboxes.values())
+        elif sid in self.outboxes:
+            outboxes = [self.outboxes[sid]]
+        else:
+            outboxes = []
+        for outbox in outboxes:
+            outbox.put(message, coalesce_key)
 
-    async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
+    async def send_bytes(self, event, data, sid=None):
+        message = bytes(self.encode_bytes(event, data))
+        self.enqueue(message, sid, COALESCED_EVENTS.get(event, None))
 
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+    async def send_json(self, event, data, sid=None):
+        message = json.dumps({"type": event, "data": data})
+        self.enqueue(message, sid, COALESCED_EVENTS.get(event, None))
 
     def send_sync(self, event, data, sid=None):
+        if isinstance(data, dict) and data.get("prompt_id", None) is not None:
+            self.prompt_status.update_from_event(event, data)
         self.loop.call_soon_threadsafe(
             self.messages.put_nowait, (event, data, sid))
 
@@ -704,20 +934,30 @@ class PromptServer():
             # } 
         file_name = ""    
         for key,value in outputs.items():
-            for image in value["images"]:
+            # results of SaveImageMemory are read from nodes.memory_results instead
+            for image in value.get("images", []):
+                    if image.get("type") != "output":
+                        continue
                     file_name = image["filename"]
                     print("filename",file_name)
                     break
                     
-        full_file_path = os.path.join(folder_paths.get_output_directory(), file_name)
-        print("full path", full_file_path)
-            
-                        
-        server_extension = ServerExtension()
-        for prompt in server_extension.prompt_list:
-            if prompt.prompt_id == prompt_id:
-                prompt.output_image = full_file_path
-                break 
+        full_file_path = None
+        if file_name != "":
+            full_file_path = os.path.join(folder_paths.get_output_directory(), file_name)
+            print("full path", full_file_path)
+
+        ServerExtension().task_done(prompt_id, full_file_path, status, self)
+
+    def prompt_deleted_update_server_extension(self, prompt_id):
+        ServerExtension().prompt_deleted(prompt_id)
+
+    def send_result_image(self, prompt_id, image_data, sid):
+        prompt_id = prompt_id.encode('utf-8')
+        message = bytearray(struct.pack(">I", len(prompt_id)))
+        message.extend(prompt_id)
+        message.extend(image_data)
+        self.send_sync(BinaryEventTypes.RESULT_IMAGE, message, sid)
 
 # class StyleVO:
         
@@ -8,10 +8,17 @@ import random
 import folder_paths
 import execution
 import uuid
-import urllib
+import urllib.parse
 import json
 import glob
 import struct
+import time
+import hashlib
+import copy
+import inspect
+import threading
+import collections
+import logging
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
@@ -36,6 +43,199 @@ STYLE_DIGITAL_PAINTING = 'digital_painting'
 STYLE_SCENE_SWAP = 'scene_swap'
 STYLE_FACE_SWAP = 'face_swap'
 
+def read_base64(path):
+    with open(path, 'rb') as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+def file_etag(path, variant=None):
+    st = os.stat(path)
+    etag = "{:x}-{:x}".format(st.st_mtime_ns, st.st_size)
+    if variant is not None:
+        etag += "-" + variant
+    return '"{}"'.format(etag)
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("If-None-Match", None)
+    if if_none_match is None:
+        return False
+    tags = [x.strip() for x in if_none_match.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def bytes_response(request, data, content_type, headers):
+    # answers a single "Range: bytes=a-b" with 206, like web.FileResponse does for files on disk
+    headers = dict(headers, **{"Accept-Ranges": "bytes"})
+    try:
+        rng = request.http_range
+    except ValueError:
+        rng = slice(len(data), None)
+    if rng.start is None and rng.stop is None:
+        return web.Response(body=data, content_type=content_type, headers=headers)
+    start, stop, _ = rng.indices(len(data))
+    if start >= stop:
+        headers["Content-Range"] = "bytes */{}".format(len(data))
+        return web.Response(status=416, headers=headers)
+    headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, len(data))
+    return web.Response(status=206, body=data[start:stop], content_type=content_type, headers=headers)
+
+def parse_preview(query):
+    #same format as the preview parameter of /view: "webp;90" or "jpeg;80"
+    if "preview" not in query:
+        return None
+    preview_info = query["preview"].split(';')
+    image_format = preview_info[0]
+    if image_format not in ['webp', 'jpeg']:
+        image_format = 'webp'
+    quality = 90
+    if preview_info[-1].isdigit():
+        quality = int(preview_info[-1])
+    return image_format, quality
+
+def transcode_image(path, image_format, quality):
+    with Image.open(path) as img:
+        if image_format == 'jpeg':
+            img = img.convert("RGB")
+        buffer = BytesIO()
+        img.save(buffer, format=image_format, quality=quality)
+        return buffer.getvalue()
+
+class ParsedFileCache:
+    #parsed contents of config files, a file is parsed again when its mtime or size changes
+    def __init__(self):
+        self.entries = {}
+        self.mutex = threading.Lock()
+
+    def load(self, path, parse):
+        st = os.stat(path)
+        file_key = (st.st_mtime_ns, st.st_size)
+        with self.mutex:
+            entry = self.entries.get(path, None)
+            if entry is not None and entry[0] == file_key:
+                return entry[1]
+        with open(path) as f:
+            value = parse(f)
+        with self.mutex:
+            self.entries[path] = (file_key, value)
+        return value
+
+parsed_file_cache = ParsedFileCache()
+
+def parse_styles(f)->list:
+    style_list_json = json.load(f)
+    group_vo_list = []
+    for group_data in style_list_json:
+        group_name = group_data["name"]
+        group_style = group_data["style"]
+        group_vo = GroupStyleVO(group_name,group_style)
+        for style in group_data["items"]:
+            name = style["name"]
+            thumbnail = style["thumbnail"]
+            image = style["image"]
+            workflow = style["workflow"]
+            style_vo = StyleVO(name, thumbnail, image,workflow,style=group_style)
+            group_vo.items.append(style_vo)
+        group_vo_list.append(group_vo)
+    return group_vo_list
+
+def parse_workflow(f):
+    # validated maps a style name to the outputs of the template once it passed a full validation with that style
+    return {"prompt": json.load(f), "validated": {}}
+
+def validate_injected_inputs(prompt, injected):
+    # only the inputs set by the request are checked when the rest of the template was already validated
+    for node_id, x in injected:
+        class_type = prompt[node_id]["class_type"]
+        obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
+        val = prompt[node_id]["inputs"][x]
+        if hasattr(obj_class, "VALIDATE_INPUTS") and x in inspect.getfullargspec(obj_class.VALIDATE_INPUTS).args:
+            r = obj_class.VALIDATE_INPUTS(**{x: val})
+            if r is not True:
+                return {"type": "custom_validation_failed", "message": "Custom validation failed for node", "details": f"{x} - {r}", "extra_info": {"node_id": node_id, "input_name": x}}
+            continue
+        info = obj_class.INPUT_TYPES()["required"].get(x, None)
+        if info is not None and info[0] == "INT" and len(info) > 1:
+            if not isinstance(val, int) or val < info[1].get("min", val) or val > info[1].get("max", val):
+                return {"type": "value_not_valid", "message": "Value not valid", "details": f"{x}: {val}", "extra_info": {"node_id": node_id, "input_name": x}}
+    return None
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+IMAGE_SIGNATURES = [b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*"]
+
+def is_image_header(data):
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return True
+    return any(data.startswith(x) for x in IMAGE_SIGNATURES)
+
+async def read_multipart(request, file_field, file_obj, blocking=True):
+    # the file field is copied to file_obj chunk by chunk, in a worker thread when blocking is set
+    # it is rejected as soon as the first chunk isn't an image or the size goes over --max-upload-size
+    # returns (the other fields, the uploaded filename, error)
+    max_size = round(args.max_upload_size * 1024 * 1024)
+    loop = asyncio.get_running_loop()
+    reader = await request.multipart()
+    fields = {}
+    filename = None
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        if part.name != file_field or not part.filename:
+            fields[part.name] = await part.text()
+            continue
+
+        filename = part.filename
+        size = 0
+        while True:
+            chunk = await part.read_chunk(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if size == 0 and not is_image_header(chunk):
+                return fields, filename, "Unsupported image format"
+            size += len(chunk)
+            if size > max_size:
+                return fields, filename, "Upload too large"
+            if blocking:
+                await loop.run_in_executor(None, file_obj.write, chunk)
+            else:
+                file_obj.write(chunk)
+        if size == 0:
+            return fields, filename, "Empty upload"
+    return fields, filename, None
+
+def workflow_resolution(prompt):
+    # the largest EmptyLatentImage side, None if the workflow doesn't make one
+    sizes = [max(node["inputs"]["width"], node["inputs"]["height"]) for node in prompt.values()
+             if node["class_type"] == "EmptyLatentImage" and not isinstance(node["inputs"].get("width"), list) and not isinstance(node["inputs"].get("height"), list)]
+    if len(sizes) == 0:
+        return None
+    return max(sizes)
+
+def downscale_image(data, max_side):
+    with Image.open(BytesIO(data)) as img:
+        if max(img.size) <= max_side:
+            return data
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = BytesIO()
+        if img.mode in ("RGB", "L"):
+            img.save(buffer, format='jpeg', quality=95)
+        else:
+            img.save(buffer, format='png', compress_level=1)
+        return buffer.getvalue()
+
+THUMBNAIL_SIZE = 256
+
+def thumbnail_webp(path):
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        buffer = BytesIO()
+        img.save(buffer, format='webp', quality=80)
+        return buffer.getvalue()
+
 class StyleVO:
         
         name = ""
@@ -64,11 +264,85 @@ class PromptVO:
     prompt_id = ""
     input_image = None
     output_image = None
+    created = 0.0
+    done = None
+    client_id = None
+    push = False
     def __init__(self, prompt_id):
         self.prompt_id = prompt_id
+        self.created = time.monotonic()
+
+def remove_file(path):
+    if path is not None and os.path.isfile(path):
+        os.remove(path)
+
+class PromptRegistry:
+    #the prompts sent to /digital-painting by prompt_id, the results that aren't fetched within ttl seconds are dropped with their files
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.prompts = collections.OrderedDict()
+        self.mutex = threading.Lock()
+        self.expired = 0
+        self.fetched = 0
+
+    def add(self, promptvo):
+        self.purge()
+        with self.mutex:
+            self.prompts[promptvo.prompt_id] = promptvo
+
+    def purge(self):
+        for p in self.purge_expired():
+            remove_file(p.input_image)
+            remove_file(p.output_image)
+
+    def get(self, prompt_id):
+        with self.mutex:
+            return self.prompts.get(prompt_id, None)
+
+    def pop(self, prompt_id):
+        with self.mutex:
+            promptvo = self.prompts.pop(prompt_id, None)
+            if promptvo is not None:
+                self.fetched += 1
+            return promptvo
+
+    def set_done(self, prompt_id, output_image=None):
+        with self.mutex:
+            promptvo = self.prompts.get(prompt_id, None)
+            if promptvo is None:
+                return
+            promptvo.output_image = output_image
+            promptvo.done = time.monotonic()
+            self.prompts.move_to_end(prompt_id)
+        self.purge()
+
+    def purge_expired(self):
+        #only prompts that are done expire, the ones still in the queue are kept however long they wait
+        now = time.monotonic()
+        expired = []
+        with self.mutex:
+            for prompt_id, promptvo in list(self.prompts.items()):
+                if promptvo.done is not None and promptvo.done + self.ttl < now:
+                    expired.append(self.prompts.pop(prompt_id))
+            self.expired += len(expired)
+        return expired
+
+    def get_metrics(self):
+        with self.mutex:
+            done = sum(1 for p in self.prompts.values() if p.done is not None)
+            oldest = min((p.created for p in self.prompts.values()), default=None)
+            return {"size": len(self.prompts),
+                    "pending": len(self.prompts) - done,
+                    "done": done,
+                    "fetched": self.fetched,
+                    "expired": self.expired,
+                    "oldest_age": None if oldest is None else time.monotonic() - oldest,
+                    "memory_results": len(nodes.memory_results.entries)}
 
 class ServerExtension:
-    prompt_list:list[PromptVO] = []
+    prompts = PromptRegistry(args.memory_result_ttl)
+    thumbnail_bundles = {}
+    thumbnail_mutex = threading.Lock()
     group_style_list:list[GroupStyleVO] = []
 
     _instance = None
@@ -79,49 +353,94 @@ class ServerExtension:
         return cls._instance
 
     async def load_styles_json(self)->list[GroupStyleVO]:
-        with open(os.path.join('input','styles', 'styles_config.json')) as f:
-            style_list_json = json.load(f)
-            print(style_list_json)
-            group_vo_list = []
-            for group_data in style_list_json:
-                group_name = group_data["name"]
-                group_style = group_data["style"]
-                group_vo = GroupStyleVO(group_name,group_style)
-                for style in group_data["items"]:
-                    name = style["name"]
-                    thumbnail = style["thumbnail"]
-                    image = style["image"]
-                    workflow = style["workflow"]
-                    style_vo = StyleVO(name, thumbnail, image,workflow,style=group_style)
-                    group_vo.items.append(style_vo)
-                group_vo_list.append(group_vo)
-            return group_vo_list
-
-            
+        return parsed_file_cache.load(os.path.join('input','styles', 'styles_config.json'), parse_styles)
 
     async def thumbnails(self, request):
             self.group_style_list = await self.load_styles_json()
+            # with ?binary the items link to /thumbnails/{name} instead of embedding the image
+            binary = "binary" in request.rel_url.query
+            bundle = self.thumbnail_bundles.get(binary, None)
+            if bundle is None or bundle[0] is not self.group_style_list:
+                loop = asyncio.get_running_loop()
+                bundle = await loop.run_in_executor(None, self.build_thumbnail_bundle, self.group_style_list, binary)
+
+            headers = {"ETag": bundle[2], "Cache-Control": "public, max-age=60"}
+            if etag_matches(request, bundle[2]):
+                return web.Response(status=304, headers=headers)
+            return web.Response(body=bundle[1], content_type='application/json', headers=headers)
+
+    def build_thumbnail_bundle(self, group_style_list, binary=False):
+        # the json is built once per styles config, the embedded thumbnails are resized and encoded as webp
+        with self.thumbnail_mutex:
+            bundle = self.thumbnail_bundles.get(binary, None)
+            if bundle is not None and bundle[0] is group_style_list:
+                return bundle
+
             image_data_list = []
-            for group_style in self.group_style_list:
+            for group_style in group_style_list:
                 group = {}
                 group["name"] = group_style.name
                 group["style"] = group_style.style
                 items = []
                 for style in group_style.items:
-                        print(style.name)
                         #folder_paths.get_input_directory()
                         file_path =  os.path.join('input',style.thumbnail)
-                        with open(file_path, 'rb') as image_file:
-                            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                            items.append({
-                        'filename': style.name,
-                        'data': image_data,
-                        'style': style.style,
-                    })
+                        item = {
+                            'filename': style.name,
+                            'style': style.style,
+                        }
+                        if binary:
+                            item['url'] = '/thumbnails/' + urllib.parse.quote(style.name)
+                        else:
+                            item['data'] = base64.b64encode(thumbnail_webp(file_path)).decode('utf-8')
+                            item['mime'] = 'image/webp'
+                        items.append(item)
                 group["items"] = items            
                 image_data_list.append(group)
-            return {'thumbnails': image_data_list}
-            # return web.json_response({'thumbnails': image_data_list})
+
+            body = json.dumps({'thumbnails': image_data_list}).encode('utf-8')
+            bundle = (group_style_list, body, '"{}"'.format(hashlib.sha256(body).hexdigest()[:32]))
+            self.thumbnail_bundles[binary] = bundle
+            logging.debug("Built thumbnail bundle: {} bytes".format(len(body)))
+            return bundle
+
+    async def thumbnail_image(self, request):
+        if len(self.group_style_list) == 0:
+            self.group_style_list = await self.load_styles_json()
+        name = request.match_info.get("name", None)
+        for group in self.group_style_list:
+            for style in group.items:
+                if style.name == name:
+                    file_path = os.path.join('input', style.thumbnail)
+                    if os.path.isfile(file_path):
+                        return await self.image_response(request, file_path, os.path.basename(file_path))
+        return web.Response(status=404)
+
+    async def image_response(self, request, path, filename, in_memory=False):
+        # streams the file with ETag/Range support or transcodes it when ?preview=webp;90 or jpeg;90 is set
+        # with in_memory the file is read before returning so the caller can remove it
+        preview = parse_preview(request.rel_url.query)
+        if preview is None:
+            etag = file_etag(path)
+        else:
+            etag = file_etag(path, "{}-{}".format(*preview))
+            filename = os.path.splitext(filename)[0] + "." + preview[0]
+        headers = {"ETag": etag, "Content-Disposition": f"filename=\"{filename}\""}
+
+        if etag_matches(request, etag):
+            response = web.Response(status=304, headers=headers)
+        elif preview is not None:
+            loop = asyncio.get_running_loop()
+            body = await loop.run_in_executor(None, transcode_image, path, preview[0], preview[1])
+            response = bytes_response(request, body, f'image/{preview[0]}', headers)
+        elif in_memory:
+            loop = asyncio.get_running_loop()
+            body = await loop.run_in_executor(None, read_file, path)
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            response = bytes_response(request, body, content_type, headers)
+        else:
+            response = web.FileResponse(path, headers=headers)
+        return response
 
     def get_default_style(self):
         return self.group_style_list[0].items[0]
@@ -141,18 +460,37 @@ class ServerExtension:
         self.group_style_list = await self.load_styles_json()
         prompt_id = str(uuid.uuid4())
         print("got digital painting")
-        post = await request.post()
+        image_data = BytesIO()
+        post, image_filename, upload_error = await read_multipart(request, "image", image_data, blocking=False)
+        if upload_error is not None:
+            return web.json_response({"error": upload_error}, status=400)
         client_id = post.get("client_id")
         ref_name = post.get("ref_name")
-        image = post.get("image")
+        priority = post.get("priority", execution.DEFAULT_PRIORITY)
+        valid_priority = execution.validate_priority(priority)
+        if not valid_priority[0]:
+            return web.json_response({"error": valid_priority[1], "node_errors": []}, status=400)
         styleVO:StyleVO = self.get_style_by_name(ref_name)
 
         print("selected workflow_api :",styleVO.workflow)
         # img = {'image': post.get("image")}
         # image = post.get("image")
-        image_name,image_path = await self.image_upload_in_input_director(image)
-        if image_name is None:
+        # the upload and the result stay in memory, see LoadImageMemory and SaveImageMemory
+        if image_filename is None:
             return web.json_response({"error":"Image Upload Failed"},status=400)
+        template = parsed_file_cache.load(os.path.join('input',styleVO.workflow), parse_workflow)
+        image_data = image_data.getvalue()
+        max_side = workflow_resolution(template["prompt"])
+        if args.downscale_uploads and max_side is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                image_data = await loop.run_in_executor(None, downscale_image, image_data, max_side)
+            except Exception as e:
+                return web.json_response({"error": "Invalid image: {}".format(e)}, status=400)
+        image_name = prompt_id + "/input"
+        image_path = None
+        # the upload is kept until the prompt is done or deleted from the queue however long it waits
+        nodes.memory_results.put(image_name, {"data": image_data, "filename": image_filename}, pin=True)
         
         # input_filepath = upload_resp['filepath']
 
@@ -165,32 +503,52 @@ class ServerExtension:
 
         if image_name is not None:
             
-            prompt = json.load(open(os.path.join('input',styleVO.workflow)))
+            prompt = copy.deepcopy(template["prompt"])
             print("style name :",styleVO.style)
             if styleVO.style == STYLE_FACE_SWAP:
                 print("inside face swap prompt update")
                 prompt["2"]["inputs"]["image"] = styleVO.image #'styles/'+ styleVO.name
                 prompt["3"]["inputs"]["image"] =  image_name
+                injected = [("3", "image")]
             elif styleVO.style == STYLE_DIGITAL_PAINTING:
                 print('inside digiital painting prompt update')
                 prompt["12"]["inputs"]["image"] = image_name #'styles/'+ styleVO.name
                 prompt['30']['inputs']['image'] = image_name
                 prompt["3"]["inputs"]["seed"] = random.randint(1, 1125899906842600)
+                injected = [("12", "image"), ("30", "image"), ("3", "seed")]
             else:
                 print('inside swap scene prompt update')
                 prompt["12"]["inputs"]["image"] = styleVO.image #'styles/'+ styleVO.name
                 prompt['30']['inputs']['image'] = image_name
                 prompt["3"]["inputs"]["seed"] = random.randint(1, 1125899906842600)
+                injected = [("30", "image"), ("3", "seed")]
             
+            for node_id, node in prompt.items():
+                if node["class_type"] == "LoadImage" and node["inputs"].get("image") == image_name:
+                    node["class_type"] = "LoadImageMemory"
+                elif node["class_type"] == "SaveImage":
+                    node["class_type"] = "SaveImageMemory"
+                    node["inputs"]["result_key"] = prompt_id
+                    injected.append((node_id, "result_key"))
+
             number = prompt_server.number
             prompt_server.number += 1
             #print('prompt ',prompt)
-            valid = execution.validate_prompt(prompt)
-            extra_data ={"client_id": client_id}
+            outputs = template["validated"].get(styleVO.name, None)
+            if outputs is not None:
+                error = validate_injected_inputs(prompt, injected)
+                valid = (error is None, error, list(outputs), {})
+            else:
+                valid = execution.validate_prompt(prompt)
+                if valid[0]:
+                    template["validated"][styleVO.name] = valid[2]
+            extra_data ={"client_id": client_id, "priority": priority}
             if valid[0]:
                 promptvo = PromptVO(prompt_id)
                 promptvo.input_image = image_path
-                self.prompt_list.append(promptvo)
+                promptvo.client_id = client_id
+                promptvo.push = post.get("push", "") in ("1", "true")
+                self.prompts.add(promptvo)
                 outputs_to_execute = valid[2]
                 # IMPORTANT
                 # prompt queue in prompt server is a queue of tuples
@@ -200,6 +558,7 @@ class ServerExtension:
                 response["node_errors"] = valid[3]
                 return web.json_response(response)
             else:
+                nodes.memory_results.pop(image_name)
                 print("invalid prompt:", valid[1])
                 response_json = {"error": valid[1], "node_errors": valid[3]}
                 response_status = 400
@@ -210,73 +569,99 @@ class ServerExtension:
             return web.json_response(response_json, status=response_status)
             return web.json_response({"error": "no client_id", "node_errors": []}, status=400)
     
-    async def image_upload_in_input_director(self,image):
-        # image = img["image"]
-        # image = image_data
-
-        # image_upload_type = img["type"]
-        upload_dir = folder_paths.get_input_directory()
-        image_upload_type = "input"
-        # upload_dir, image_upload_type = self.get_dir_by_type(image_upload_type)
-
-        if image and image.file:
-            filename = image.filename
-            if not filename:
-                return 400
-
-            # subfolder = img["subfolder"]
-            # full_output_folder = os.path.join(upload_dir, os.path.normpath(subfolder))
-            full_output_folder = os.path.join(upload_dir)
-            filepath = os.path.abspath(os.path.join(full_output_folder, filename))
-
-            if os.path.commonpath((upload_dir, filepath)) != upload_dir:
-                return 400
-
-            if not os.path.exists(full_output_folder):
-                os.makedirs(full_output_folder)
-
-            #  to avoid overwriting the fie
-            split = os.path.splitext(filename)
-            i = 1
-            while os.path.exists(filepath):
-                filename = f"{split[0]} ({i}){split[1]}"
-                filepath = os.path.join(full_output_folder, filename)
-                i += 1
-
-            with open(filepath, "wb") as f:
-                f.write(image.file.read())
-            print('image uploaded at',filepath)
-            return filename,filepath
-            return {"name" : filename, "type": image_upload_type,'filepath':filepath}
-        
-        else:
-            return None,None
-            return 400
-
     async def view_extention_image(self,request):
         print("view extension api called");
         prompt_id = request.rel_url.query["prompt_id"]
-        for prompt in self.prompt_list:
-            if prompt.prompt_id == prompt_id:
-                os.remove(prompt.input_image)
-                print('Removed input image',prompt.input_image)
-                if os.path.isfile(prompt.output_image):
-                    with open(prompt.output_image, 'rb') as image_file:
-                        image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                        response_data = {
-                            'filename': prompt.prompt_id,
-                            'data': image_data
-                        }
-                    os.remove(prompt.output_image)
-                    
-                    print('Removed output image',prompt.output_image)
-                    # end
-                    self.prompt_list.remove(prompt)
-                    print('Done : view extension image response filename and data')
-                    return web.json_response(response_data)
-                break
+        # with ?binary or ?preview the image is sent as is instead of base64 in json
+        binary = "binary" in request.rel_url.query or "preview" in request.rel_url.query
+        prompt = self.prompts.get(prompt_id)
+        if prompt is None:
+            return web.Response(status=404)
+
+        result = nodes.memory_results.get(prompt_id)
+        if result is not None:
+            response = await self.memory_image_response(request, prompt_id, result, binary)
+            if response.status == 200:
+                # a 304 or a range keeps the result for a later full download
+                nodes.memory_results.pop(prompt_id)
+                nodes.memory_results.pop(prompt_id + "/input")
+                self.prompts.pop(prompt_id)
+            return response
+
+        output_image = prompt.output_image
+        if output_image is not None and os.path.isfile(output_image):
+            if binary:
+                filename = prompt.prompt_id + os.path.splitext(output_image)[1]
+                # a full download is read into memory so the files can be removed before it is sent
+                full = "Range" not in request.headers
+                response = await self.image_response(request, output_image, filename, in_memory=full)
+                if not full or response.status != 200:
+                    # keep the image for the remaining ranges or a later full download
+                    return response
+            else:
+                loop = asyncio.get_running_loop()
+                response_data = {
+                    'filename': prompt.prompt_id,
+                    'data': await loop.run_in_executor(None, read_base64, output_image)
+                }
+                response = web.json_response(response_data)
+
+            # only the request that takes the prompt out of the registry removes the files
+            if self.prompts.pop(prompt_id) is not None:
+                remove_file(prompt.input_image)
+                remove_file(output_image)
+            print('Done : view extension image response filename and data')
+            return response
         return web.Response(status=404)
-       
+
+    def task_done(self, prompt_id, output_image, status, prompt_server):
+        self.prompts.set_done(prompt_id, output_image)
+        nodes.memory_results.pop(prompt_id + "/input")
+        prompt = self.prompts.get(prompt_id)
+        if prompt is None or prompt.client_id is None:
+            return
+
+        # with push the result is sent over /ws to the client that submitted the prompt so it doesn't have to poll
+        pushed = False
+        success = status is not None and status.get("status_str", None) == "success"
+        if prompt.push and success and prompt.client_id in prompt_server.sockets:
+            result = nodes.memory_results.pop(prompt_id)
+            if result is not None:
+                nodes.memory_results.pop(prompt_id + "/input")
+                self.prompts.pop(prompt_id)
+                prompt_server.send_result_image(prompt_id, result["images"][0], prompt.client_id)
+                pushed = True
+        prompt_server.send_sync("extension_result", {"prompt_id": prompt_id, "status": "success" if success else "error", "pushed": pushed}, prompt.client_id)
+
+    def prompt_deleted(self, prompt_id):
+        #the prompt was removed from the queue before it ran, it expires like a result that isn't fetched
+        self.prompts.set_done(prompt_id)
+        nodes.memory_results.pop(prompt_id + "/input")
+
+    async def memory_image_response(self, request, prompt_id, result, binary):
+        data = result["images"][0]
+        if not binary:
+            loop = asyncio.get_running_loop()
+            image_data = await loop.run_in_executor(None, lambda: base64.b64encode(data).decode('utf-8'))
+            return web.json_response({'filename': prompt_id, 'data': image_data})
+
+        image_format = result["format"]
+        preview = parse_preview(request.rel_url.query)
+        if preview is not None and preview[0] != image_format:
+            variant = "{}-{}".format(*preview)
+            image_format = preview[0]
+        else:
+            variant = image_format
+        # the result doesn't change while it is stored so the tag only depends on the prompt and the encoding
+        etag = '"{}"'.format(hashlib.sha256("{}-{}".format(prompt_id, variant).encode()).hexdigest()[:32])
+        headers = {"ETag": etag, "Content-Disposition": f"filename=\"{prompt_id}.{image_format}\""}
+        if etag_matches(request, etag):
+            return web.Response(status=304, headers=headers)
+
+        if image_format != result["format"]:
+            loop = asyncio.get_running_loop()
+            data = await loop.run_in_executor(None, lambda: transcode_image(BytesIO(data), preview[0], preview[1]))
+        return bytes_response(request, data, f'image/{image_format}', headers)
 
     def get_dir_by_type(self,dir_type):
         if dir_type is None:
@@ -0,0 +1,81 @@
+"""
+Compares the latency and the weight memory of the int8 weight-only ops in comfy.ops
+with fp32 and bf16 weights on the CPU, using linear and conv layers with the shapes of the SD1.x/SDXL unet.
+
+    python tests/benchmark_quantized_ops.py --threads 8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import torch
+import comfy.ops
+
+#(in_features, out_features, tokens) for the linears and (channels, height, width) for the 3x3 convs
+LINEARS = [(320, 320, 4096), (320, 2560, 4096), (1280, 320, 4096), (640, 640, 1024), (1280, 1280, 256), (1280, 10240, 256), (5120, 1280, 256)]
+CONVS = [(320, 64, 64), (640, 32, 32), (1280, 16, 16)]
+
+VARIANTS = [
+    ("fp32", comfy.ops.disable_weight_init, torch.float32, torch.float32),
+    ("bf16", comfy.ops.disable_weight_init, torch.bfloat16, torch.bfloat16),
+    ("int8 fp32 compute", comfy.ops.int8_weights, torch.float32, torch.float32),
+    ("int8 bf16 compute", comfy.ops.int8_weights, torch.bfloat16, torch.bfloat16),
+]
+
+def build_layers(operations, dtype):
+    layers = [operations.Linear(i, o, dtype=dtype) for (i, o, _) in LINEARS]
+    layers += [operations.Conv2d(c, c, 3, padding=1, dtype=dtype) for (c, _, _) in CONVS]
+    return layers
+
+def build_inputs(dtype, batch):
+    inputs = [torch.randn(batch, t, i, dtype=dtype) for (i, _, t) in LINEARS]
+    inputs += [torch.randn(batch, c, h, w, dtype=dtype) for (c, h, w) in CONVS]
+    return inputs
+
+def weight_bytes(layers):
+    return sum(t.nelement() * t.element_size() for layer in layers for t in layer.state_dict().values())
+
+@torch.no_grad()
+def run(layers, inputs):
+    return [layer(x) for layer, x in zip(layers, inputs)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    reference = build_layers(comfy.ops.manual_cast, torch.float32)
+    for layer in reference:
+        torch.nn.init.normal_(layer.weight, std=0.02)
+        torch.nn.init.zeros_(layer.bias)
+    reference_inputs = build_inputs(torch.float32, args.batch)
+    reference_outputs = run(reference, reference_inputs)
+
+    print("{:<20} {:>12} {:>12} {:>12}".format("weights", "memory MB", "latency ms", "max rel err"))
+    for name, operations, dtype, compute_dtype in VARIANTS:
+        layers = build_layers(operations, dtype)
+        for layer, ref in zip(layers, reference):
+            layer.load_state_dict(ref.state_dict())
+        inputs = [x.to(compute_dtype) for x in reference_inputs]
+        run(layers, inputs)
+
+        times = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            outputs = run(layers, inputs)
+            times.append(time.perf_counter() - start)
+        times.sort()
+
+        error = max(((o.float() - r).abs().max() / r.abs().max()).item() for o, r in zip(outputs, reference_outputs))
+        print("{:<20} {:>12.1f} {:>12.2f} {:>12.4f}".format(name, weight_bytes(layers) / (1024 * 1024), times[len(times) // 2] * 1000, error))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import nodes
+import execution
+
+def sampler_prompt(seed=1, image="a.png", steps=20, cfg=8.0):
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "2": {"class_type": "LoadImage", "inputs": {"image": image}},
+        "3": {"class_type": "VAEEncode", "inputs": {"pixels": ["2", 0], "vae": ["1", 2]}},
+        "4": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["1", 1]}},
+        "5": {"class_type": "KSampler", "inputs": {"model": ["1", 0], "positive": ["4", 0], "negative": ["4", 0], "latent_image": ["3", 0],
+                                                   "seed": seed, "steps": steps, "cfg": cfg, "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0}},
+        "6": {"class_type": "VAEDecode", "inputs": {"samples": ["5", 0], "vae": ["1", 2]}},
+        "7": {"class_type": "SaveImage", "inputs": {"images": ["6", 0], "filename_prefix": "out"}},
+    }
+
+def item(number, prompt, client_id=None):
+    extra_data = {} if client_id is None else {"client_id": client_id}
+    return (number, "prompt-{}".format(number), prompt, extra_data, ["7"])
+
+def signature(prompt):
+    return execution.coalesce_signature(item(0, prompt))
+
+def test_seed_and_image_differences_merge():
+    assert signature(sampler_prompt(seed=1)) == signature(sampler_prompt(seed=2))
+    assert signature(sampler_prompt(image="a.png")) == signature(sampler_prompt(image="b.png", seed=5))
+
+@pytest.mark.parametrize("other", [sampler_prompt(steps=30), sampler_prompt(cfg=7.0)])
+def test_other_differences_dont_merge(other):
+    assert signature(sampler_prompt()) != signature(other)
+
+def test_merged_prompt_varies_downstream_only():
+    items = [item(1, sampler_prompt(seed=1), "a"), item(2, sampler_prompt(seed=2), "b")]
+    prompt = execution.merge_prompts(items)
+    assert prompt.varying == {"5", "6", "7"}
+    assert list(prompt["5"]["inputs"]["seed"]) == [1, 2]
+    assert prompt.prompt_ids == ["prompt-1", "prompt-2"]
+    assert prompt.clients == [("a", "prompt-1"), ("b", "prompt-2")]
+
+    items = [item(1, sampler_prompt(image="a.png")), item(2, sampler_prompt(image="b.png"))]
+    assert execution.merge_prompts(items).varying == {"2", "3", "5", "6", "7"}
+
+class ValueNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"seed": ("INT", {"default": 0})}}
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    def run(self, seed):
+        if seed == 13:
+            raise ValueError("unlucky seed")
+        return (seed,)
+
+class OutputNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT",)}}
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    def run(self, value):
+        return {"ui": {"values": [value]}}
+
+class Server:
+    client_id = None
+    last_node_id = None
+    last_prompt_id = None
+    progress = None
+    def send_sync(self, event, data, sid=None):
+        pass
+
+class Queue:
+    def __init__(self):
+        self.done = {}
+    def task_done(self, item_id, outputs, status):
+        self.done[item_id] = (outputs, status.status_str)
+
+def test_failure_doesnt_fail_other_prompts(monkeypatch):
+    pytest.importorskip("aiohttp")
+    import main
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "ValueNode", ValueNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "OutputNode", OutputNode)
+
+    def value_prompt(seed):
+        return {"1": {"class_type": "ValueNode", "inputs": {"seed": seed}},
+                "2": {"class_type": "OutputNode", "inputs": {"value": ["1", 0]}}}
+    queue_items = [((i, "prompt-{}".format(i), value_prompt(seed), {}, ["2"]), i) for i, seed in enumerate([1, 13, 3])]
+    assert len(set(signature(x[0][2]) for x in queue_items)) == 1
+
+    e = execution.PromptExecutor(Server())
+    q = Queue()
+    retry = main.execute_prompts(e, q, Server(), queue_items)
+    # the merged execution failed, nothing is reported yet and every prompt runs again on its own
+    assert not e.success
+    assert q.done == {}
+    assert retry == queue_items
+    for x in retry:
+        main.execute_prompts(e, q, Server(), [x])
+    assert q.done == {
+        0: ({"2": {"values": [1]}}, "success"),
+        1: ({}, "error"),
+        2: ({"2": {"values": [3]}}, "success"),
+    }
@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import nodes
+import execution
+
+class Server:
+    client_id = None
+    last_node_id = None
+    def send_sync(self, event, data, sid=None):
+        pass
+
+class LoaderNode:
+    calls = 0
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"name": ("STRING", {"default": ""})}}
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "load"
+
+    def load(self, name):
+        LoaderNode.calls += 1
+        return (torch.nn.Linear(256, 256),)
+
+class OutputNode:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",)}}
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    def run(self, model):
+        return {}
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "LoaderNode", LoaderNode)
+    monkeypatch.setitem(nodes.NODE_CLASS_MAPPINGS, "OutputNode", OutputNode)
+    monkeypatch.setattr(LoaderNode, "calls", 0)
+    cache = execution.NodeOutputCache(16, 64 * 1024 * 1024)
+    monkeypatch.setattr(execution, "node_output_cache", cache)
+    return cache
+
+def prompt(loader_id, output_id, name):
+    return {
+        loader_id: {"class_type": "LoaderNode", "inputs": {"name": name}},
+        output_id: {"class_type": "OutputNode", "inputs": {"model": [loader_id, 0]}},
+    }
+
+def test_loader_result_reused_across_prompts(cache):
+    # different workflows and executors, the loader only runs once for the same inputs
+    first = execution.PromptExecutor(Server())
+    first.execute(prompt("1", "2", "a.safetensors"), "first", {}, ["2"])
+    assert first.success
+    second = execution.PromptExecutor(Server())
+    second.execute(prompt("7", "9", "a.safetensors"), "second", {}, ["9"])
+    assert second.success
+    assert LoaderNode.calls == 1
+    assert second.outputs["7"][0][0] is first.outputs["1"][0][0]
+
+    second.execute(prompt("7", "9", "b.safetensors"), "third", {}, ["9"])
+    assert LoaderNode.calls == 2
+
+def test_model_weights_count(cache):
+    execution.PromptExecutor(Server()).execute(prompt("1", "2", "a.safetensors"), "first", {}, ["2"])
+    # the weights and the bias of the linear layer
+    assert cache.total_bytes >= (256 * 256 + 256) * 4
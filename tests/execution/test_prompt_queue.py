@@ -0,0 +1,87 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import execution
+
+class PromptStatus:
+    def __init__(self):
+        self.states = {}
+    def update(self, prompt_id, **kwargs):
+        self.states.setdefault(prompt_id, {}).update(kwargs)
+
+class Server:
+    def __init__(self):
+        self.prompt_status = PromptStatus()
+        self.deleted = []
+    def queue_updated(self):
+        pass
+    def prompt_deleted_update_server_extension(self, prompt_id):
+        self.deleted.append(prompt_id)
+    def task_done_update_server_extension(self, prompt_id, outputs, status):
+        pass
+
+@pytest.fixture
+def queue():
+    return execution.PromptQueue(Server())
+
+number = 0
+def put(queue, client_id, priority=None):
+    global number
+    number += 1
+    extra_data = {"client_id": client_id}
+    if priority is not None:
+        extra_data["priority"] = priority
+    prompt_id = "{}-{}".format(client_id, number)
+    queue.put((number, prompt_id, {}, extra_data, []))
+    return prompt_id
+
+def drain(queue):
+    out = []
+    while len(queue.queue) > 0:
+        item, i = queue.get()
+        queue.task_done(i, {}, None)
+        out.append(item[1])
+    return out
+
+def test_clients_are_served_alternately(queue):
+    a = [put(queue, "a") for _ in range(3)]
+    b = [put(queue, "b") for _ in range(2)]
+    a.append(put(queue, "a"))
+    b.append(put(queue, "b"))
+    assert drain(queue) == [a[0], b[0], a[1], b[1], a[2], b[2], a[3]]
+
+def test_late_client_is_not_starved(queue):
+    a = [put(queue, "a") for _ in range(4)]
+    item, i = queue.get()
+    assert item[1] == a[0]
+    # a client that submits later starts at the current virtual time, not behind the whole backlog
+    b = put(queue, "b")
+    assert drain(queue)[:2] == [a[1], b]
+
+def test_priority_class_goes_first(queue):
+    batch = [put(queue, "a", "batch") for _ in range(2)]
+    background = put(queue, "b", "background")
+    interactive = put(queue, "c", "interactive")
+    assert drain(queue) == [interactive] + batch + [background]
+
+def test_delete_keeps_client_tags(queue):
+    a = [put(queue, "a") for _ in range(3)]
+    b = put(queue, "b")
+    assert queue.delete_queue_item(lambda x: x[1] == a[2])
+    assert a[2] in queue.server.deleted
+    key = ("interactive", "a")
+    assert queue.client_pending[key] == 2
+    # the next prompt of a is queued right after its remaining ones
+    assert queue.client_tags[key] == max(x[1] for x in queue.queue if x[-1][3]["client_id"] == "a")
+    c = put(queue, "a")
+    assert drain(queue) == [a[0], b, a[1], c]
+    assert queue.client_pending == {}
+    assert queue.client_tags == {}
+
+def test_delete_last_entry_resets_client(queue):
+    a = put(queue, "a")
+    assert queue.delete_queue_item(lambda x: x[1] == a)
+    assert queue.client_pending == {}
+    assert queue.client_tags == {}
+    assert not queue.delete_queue_item(lambda x: x[1] == a)
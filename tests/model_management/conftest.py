@@ -0,0 +1,4 @@
+import comfy.cli_args
+
+# the tests run on machines without a gpu, this has to be set before comfy.model_management is imported
+comfy.cli_args.args.cpu = True
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import comfy.model_management
+
+class Patcher:
+    def __init__(self, name, size, load_time=None):
+        self.model = torch.nn.Linear(1, 1)
+        self.name = name
+        self.size = size
+        self.load_device = torch.device("cpu")
+        if name is not None:
+            comfy.model_management.set_model_source(self, os.path.join("models", "checkpoints", name))
+        if load_time is not None:
+            comfy.model_management.model_load_times[self.model] = load_time
+
+    def model_size(self):
+        return self.size
+
+def loaded(*patchers):
+    #current_loaded_models has the most recently used model first
+    return [comfy.model_management.LoadedModel(p) for p in patchers]
+
+def order(monkeypatch, loaded_models, upcoming):
+    monkeypatch.setattr(comfy.model_management, "upcoming_inputs_callback", lambda: upcoming)
+    return [m.model.name for m in comfy.model_management.eviction_order(loaded_models)]
+
+GB = 1024 * 1024 * 1024
+
+def test_next_model_is_evicted_last(monkeypatch):
+    models = loaded(Patcher("c.safetensors", GB), Patcher(None, GB), Patcher("b.safetensors", GB), Patcher("a.safetensors", GB))
+    # the unused models go least recently used first, then the one without a known file
+    assert order(monkeypatch, models, [{"b.safetensors", "a prompt"}]) == ["a.safetensors", "c.safetensors", None, "b.safetensors"]
+    assert order(monkeypatch, models, []) == ["a.safetensors", "b.safetensors", "c.safetensors", None]
+
+def test_expensive_model_is_kept(monkeypatch):
+    models = loaded(Patcher("slow.safetensors", GB, load_time=10.0), Patcher("fast.safetensors", GB, load_time=1.0))
+    upcoming = [{"slow.safetensors", "fast.safetensors"}]
+    assert order(monkeypatch, models, upcoming) == ["fast.safetensors", "slow.safetensors"]
+
+def test_model_needed_later_goes_first(monkeypatch):
+    models = loaded(Patcher("next.safetensors", GB, load_time=5.0), Patcher("later.safetensors", GB, load_time=5.0))
+    upcoming = [{"next.safetensors"}, {"other.safetensors"}, {"later.safetensors"}]
+    assert order(monkeypatch, models, upcoming) == ["later.safetensors", "next.safetensors"]
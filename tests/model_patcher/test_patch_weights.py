@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import comfy.model_patcher
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.blocks = torch.nn.ModuleList([torch.nn.Linear(64, 32) for i in range(5)])
+        self.out = torch.nn.Linear(32, 8)
+
+def lora(out_features, in_features, rank, alpha):
+    return ("lora", (torch.randn(out_features, rank) * 0.1, torch.randn(rank, in_features) * 0.1, alpha, None))
+
+def patched_model(weight_inplace_update=False):
+    torch.manual_seed(0)
+    model = Model()
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"), weight_inplace_update=weight_inplace_update)
+    keys = ["blocks.{}.weight".format(i) for i in range(5)]
+    # two loras on the same keys, one with alpha and one without
+    patcher.add_patches({k: lora(32, 64, 4, 2.0) for k in keys}, 0.8)
+    patcher.add_patches({k: lora(32, 64, 8, None) for k in keys}, 0.5)
+    patcher.add_patches({"out.weight": lora(8, 32, 4, 1.0)}, 1.0)
+    return patcher, keys
+
+def test_batched_matches_calculate_weight():
+    patcher, keys = patched_model()
+    model_sd = patcher.model_state_dict()
+    batched = patcher.calculate_weights_batched(keys + ["out.weight"], model_sd, torch.device("cpu"))
+    # the out layer has no other key with the same shapes to be batched with
+    assert sorted(batched) == sorted(keys)
+    for k in keys:
+        expected = patcher.calculate_weight(patcher.patches[k], model_sd[k].float().clone(), k)
+        assert (batched[k] - expected).abs().max().item() < 1e-6
+
+        # the lora scale is alpha / rank
+        (s1, (_, (up1, down1, alpha1, _)), _), (s2, (_, (up2, down2, _, _)), _) = patcher.patches[k]
+        reference = model_sd[k] + s1 * alpha1 / down1.shape[0] * torch.mm(up1, down1) + s2 * torch.mm(up2, down2)
+        assert (batched[k] - reference).abs().max().item() < 1e-5
+
+@pytest.mark.parametrize("weight_inplace_update", [False, True])
+def test_patch_unpatch_patch_with_cache(monkeypatch, weight_inplace_update):
+    cache = comfy.model_patcher.PatchedWeightsCache(64 * 1024 * 1024)
+    monkeypatch.setattr(comfy.model_patcher, "patched_weights_cache", cache)
+    patcher, keys = patched_model(weight_inplace_update)
+    original = {k: v.clone() for k, v in patcher.model_state_dict().items()}
+
+    patcher.patch_model()
+    first = {k: v.clone() for k, v in patcher.model_state_dict().items()}
+    assert len(cache.cache) == 1
+    patcher.unpatch_model()
+    for k, v in patcher.model_state_dict().items():
+        assert torch.equal(v, original[k])
+
+    # the second time the weights come from the cache
+    monkeypatch.setattr(patcher, "calculate_weight", lambda *args: pytest.fail("the weights weren't cached"))
+    monkeypatch.setattr(patcher, "calculate_weights_batched", lambda *args: pytest.fail("the weights weren't cached"))
+    patcher.patch_model()
+    for k, v in patcher.model_state_dict().items():
+        assert torch.equal(v, first[k])
+        if k in patcher.patches:
+            assert not torch.equal(v, original[k])
+    patcher.unpatch_model()
+    for k, v in patcher.model_state_dict().items():
+        assert torch.equal(v, original[k])
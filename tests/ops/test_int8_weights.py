@@ -0,0 +1,92 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import comfy.ops
+import comfy.model_patcher
+
+class Model(torch.nn.Module):
+    def __init__(self, operations):
+        super().__init__()
+        self.linear = operations.Linear(64, 32)
+        self.conv = operations.Conv2d(8, 16, 3, padding=1)
+
+def float_state_dict():
+    torch.manual_seed(0)
+    return {
+        "linear.weight": torch.randn(32, 64) * 0.02,
+        "linear.bias": torch.randn(32) * 0.02,
+        "conv.weight": torch.randn(16, 8, 3, 3) * 0.02,
+        "conv.bias": torch.randn(16) * 0.02,
+    }
+
+def int8_model(sd):
+    model = Model(comfy.ops.int8_weights)
+    model.load_state_dict({k: v.clone() for k, v in sd.items()}, strict=False)
+    return model
+
+@pytest.mark.parametrize("shape", [(32, 64), (16, 8, 3, 3)])
+def test_round_trip_error(shape):
+    torch.manual_seed(0)
+    weight = torch.randn(shape) * 0.02
+    q, scale = comfy.ops.quantize_weight(weight)
+    assert q.dtype == torch.int8
+    assert scale.shape == (shape[0],)
+
+    out = comfy.ops.dequantize_weight(q, scale, torch.float32)
+    assert out.shape == weight.shape
+    # rounding to the nearest step is off by at most half a step of the channel
+    error = (out - weight).abs().reshape(shape[0], -1).amax(dim=1)
+    assert torch.all(error <= scale / 2 + 1e-7)
+    # the largest value of each channel is exact
+    row_max = weight.abs().reshape(shape[0], -1).amax(dim=1)
+    assert torch.allclose(out.abs().reshape(shape[0], -1).amax(dim=1), row_max)
+
+def test_load_quantizes_float_weights():
+    sd = float_state_dict()
+    model = int8_model(sd)
+    assert model.linear.weight.dtype == torch.int8
+    assert model.conv.weight.dtype == torch.int8
+
+    x = torch.randn(4, 64)
+    reference = torch.nn.functional.linear(x, sd["linear.weight"], sd["linear.bias"])
+    with torch.no_grad():
+        out = model.linear(x)
+    assert ((out - reference).abs().max() / reference.abs().max()).item() < 0.02
+
+@pytest.mark.parametrize("weight_inplace_update", [False, True])
+def test_lora_patch(weight_inplace_update):
+    sd = float_state_dict()
+    model = int8_model(sd)
+    quantized = model.linear.weight.clone()
+    scale = model.linear.weight_scale.clone()
+
+    up = torch.randn(32, 4) * 0.1
+    down = torch.randn(4, 64) * 0.1
+    patcher = comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"), weight_inplace_update=weight_inplace_update)
+    patched = patcher.add_patches({"linear.weight": ("lora", (up, down, None, None))}, 0.5)
+    assert patched == ["linear.weight"]
+
+    patcher.patch_model()
+    expected = comfy.ops.dequantize_weight(quantized, scale, torch.float32) + 0.5 * torch.mm(up, down)
+    assert model.linear.weight.dtype == scale.dtype
+    assert torch.allclose(model.linear.weight, expected, atol=1e-6)
+
+    x = torch.randn(4, 64)
+    with torch.no_grad():
+        out = model.linear(x)
+    assert torch.allclose(out, torch.nn.functional.linear(x, expected, model.linear.bias), atol=1e-5)
+    # the conv wasn't patched and stays quantized
+    assert model.conv.weight.dtype == torch.int8
+
+    patcher.unpatch_model()
+    assert model.linear.weight.dtype == torch.int8
+    assert torch.equal(model.linear.weight, quantized)
+    assert torch.equal(model.linear.weight_scale, scale)
+
+def test_norm_layers_are_not_cast():
+    # only the quantized layers cast, the norms are used as stored unless the weights need a manual cast
+    assert not comfy.ops.int8_weights.GroupNorm.comfy_cast_weights
+    assert not comfy.ops.int8_weights.LayerNorm.comfy_cast_weights
+    assert comfy.ops.int8_manual_cast.LayerNorm.comfy_cast_weights
+    assert comfy.ops.int8_manual_cast.Linear is comfy.ops.int8_weights.Linear
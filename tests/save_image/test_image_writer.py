@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+
+import nodes
+
+def test_end_batch_waits_for_pending_writes():
+    writer = nodes.ImageWriter(2)
+    release = threading.Event()
+    written = []
+    def write(i):
+        release.wait(5)
+        if i == 2:
+            raise OSError("disk full")
+        written.append(i)
+
+    writer.start_batch()
+    for i in range(4):
+        writer.submit(write, i)
+    assert writer.pending() == 4
+
+    done = threading.Event()
+    results = []
+    def callback(errors):
+        results.append((sorted(written), errors))
+        done.set()
+    writer.end_batch(callback)
+    # end_batch returns right away, the callback runs once the writes are finished
+    assert not done.is_set()
+    assert writer.pending() == 0
+    release.set()
+    assert done.wait(5)
+    assert len(results) == 1
+    assert results[0][0] == [0, 1, 3]
+    assert [(i, str(ex)) for i, ex in results[0][1]] == [(2, "disk full")]
+
+def test_writes_outside_a_batch_are_synchronous():
+    writer = nodes.ImageWriter(2)
+    written = []
+    writer.submit(written.append, 1)
+    assert written == [1]
+
+    writer = nodes.ImageWriter(0)
+    writer.start_batch()
+    writer.submit(written.append, 2)
+    assert written == [1, 2]
+    results = []
+    writer.end_batch(results.append)
+    assert results == [[]]
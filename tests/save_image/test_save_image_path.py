@@ -0,0 +1,54 @@
+import os
+import threading
+
+import folder_paths
+
+def touch(folder, name):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name), "wb"):
+        pass
+
+def test_counter_continues_from_files_on_disk(tmp_path):
+    output_dir = str(tmp_path)
+    touch(output_dir, "img_00003_.png")
+    touch(output_dir, "img_00007_.png")
+    touch(output_dir, "other_00020_.png")
+    full_output_folder, filename, counter, subfolder, _ = folder_paths.get_save_image_path("img", output_dir)
+    assert (full_output_folder, filename, counter, subfolder) == (os.path.join(output_dir, ""), "img", 8, "")
+
+    full_output_folder, _, counter, subfolder, _ = folder_paths.get_save_image_path("sub/img", output_dir)
+    assert (full_output_folder, counter, subfolder) == (os.path.join(output_dir, "sub"), 1, "sub")
+
+def test_counter_sees_files_saved_by_others(tmp_path):
+    output_dir = str(tmp_path)
+    counter = folder_paths.get_save_image_path("img", output_dir)[2]
+    assert counter == 1
+    # without a batch size the folder is listed again on the next call
+    touch(output_dir, "img_00005_.png")
+    assert folder_paths.get_save_image_path("img", output_dir)[2] == 6
+
+def test_batches_reserve_their_counters(tmp_path):
+    output_dir = str(tmp_path)
+    touch(output_dir, "img_00002_.png")
+    first = folder_paths.get_save_image_path("img", output_dir, batch_size=4)[2]
+    # nothing is written yet, the next batch still starts after the reserved counters
+    second = folder_paths.get_save_image_path("img", output_dir, batch_size=2)[2]
+    assert (first, second) == (3, 7)
+
+def test_concurrent_batches_dont_collide(tmp_path):
+    output_dir = str(tmp_path)
+    counters = []
+    mutex = threading.Lock()
+    barrier = threading.Barrier(8)
+    def save():
+        barrier.wait()
+        for i in range(10):
+            counter = folder_paths.get_save_image_path("img", output_dir, batch_size=3)[2]
+            with mutex:
+                counters.extend(range(counter, counter + 3))
+    threads = [threading.Thread(target=save) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(counters) == list(range(1, 8 * 10 * 3 + 1))
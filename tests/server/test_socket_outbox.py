@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("aiohttp")
+
+import server
+
+class WebSocket:
+    def __init__(self):
+        self.closed = False
+    async def close(self):
+        self.closed = True
+
+def counters():
+    return {"dropped": 0, "coalesced": 0, "disconnected": 0}
+
+def message(event, i):
+    return json.dumps({"type": event, "data": {"value": i}})
+
+def pending(outbox):
+    return [json.loads(m)["type"] if isinstance(m, str) else m for k, m in outbox.messages]
+
+def test_progress_is_coalesced():
+    async def run():
+        outbox = server.SocketOutbox(WebSocket(), counters())
+        for i in range(10):
+            outbox.put(message("progress", i), "progress")
+        outbox.put(message("executed", 0))
+        outbox.put(message("progress", 10), "progress")
+        assert pending(outbox) == ["executed", "progress"]
+        assert json.loads(outbox.messages[-1][1])["data"]["value"] == 10
+        assert outbox.counters["coalesced"] == 10
+    asyncio.run(run())
+
+def test_full_outbox_drops_progress_and_keeps_results():
+    async def run():
+        ws = WebSocket()
+        outbox = server.SocketOutbox(ws, counters())
+        outbox.put(message("progress", 0), "progress")
+        outbox.put(b"preview", "preview")
+        for i in range(server.WS_OUTBOX_SIZE - 2):
+            outbox.put(message("executed", i))
+        assert len(outbox.messages) == server.WS_OUTBOX_SIZE
+
+        # past the size the progress and the preview make room for the results
+        outbox.put(message("executed", server.WS_OUTBOX_SIZE - 2))
+        outbox.put(message("executed", server.WS_OUTBOX_SIZE - 1))
+        assert outbox.counters["dropped"] == 2
+        assert pending(outbox) == ["executed"] * server.WS_OUTBOX_SIZE
+        assert [json.loads(m)["data"]["value"] for k, m in outbox.messages] == list(range(server.WS_OUTBOX_SIZE))
+
+        # with only results pending a new progress message is dropped itself
+        outbox.put(message("progress", 1), "progress")
+        assert outbox.counters["dropped"] == 3
+        assert not outbox.closing
+        assert len(outbox.messages) == server.WS_OUTBOX_SIZE
+
+        # a result that doesn't fit disconnects the client instead of being lost
+        outbox.put(message("executed", server.WS_OUTBOX_SIZE))
+        assert outbox.closing
+        assert outbox.counters["disconnected"] == 1
+        await asyncio.sleep(0)
+        assert ws.closed
+    asyncio.run(run())
@@ -0,0 +1,96 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("torch")
+
+import nodes
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+def result(size):
+    return {"images": [b"x" * size], "format": "png"}
+
+def test_results_expire_after_ttl(clock):
+    store = nodes.MemoryResultStore(10, 1000)
+    store.put("a", result(10))
+    clock.now += 5
+    store.put("b", result(10))
+    clock.now += 6
+    assert store.get("a") is None
+    assert store.get("b") == result(10)
+    clock.now += 5
+    assert store.get("b") is None
+    assert store.total_bytes == 0
+
+def test_oldest_results_dropped_over_size(clock):
+    store = nodes.MemoryResultStore(10, 100)
+    for key in "abc":
+        store.put(key, result(40))
+    assert store.get("a") is None
+    assert store.get("b") is not None and store.get("c") is not None
+    assert store.total_bytes == 80
+
+def test_pinned_entries_are_kept_until_unpinned(clock):
+    store = nodes.MemoryResultStore(10, 100)
+    store.put("upload", result(40), pin=True)
+    clock.now += 60
+    store.put("a", result(40))
+    assert store.get("upload") is not None
+    store.unpin("upload")
+    # the ttl starts when it is unpinned
+    clock.now += 5
+    assert store.get("upload") is not None
+    clock.now += 6
+    assert store.get("upload") is None
+    assert store.pinned_bytes == 0
+
+def test_pinned_uploads_dont_evict_new_results(clock):
+    # the uploads of the queued prompts alone are over the limit, the results of the finished ones are still kept
+    store = nodes.MemoryResultStore(10, 100)
+    for i in range(4):
+        store.put("upload{}".format(i), result(40), pin=True)
+    store.put("a", result(40))
+    assert store.get("a") == result(40)
+    assert (store.pinned_bytes, store.total_bytes) == (160, 40)
+
+    assert store.pop("upload0") is not None
+    assert store.pinned_bytes == 120
+    store.put("b", result(40))
+    store.put("c", result(40))
+    assert store.get("a") is None
+    assert store.get("b") is not None and store.get("c") is not None
+
+def test_prompt_registry_expires_done_prompts(clock, tmp_path):
+    pytest.importorskip("aiohttp")
+    import server_extension
+    registry = server_extension.PromptRegistry(10)
+    done = server_extension.PromptVO("done")
+    done.output_image = str(tmp_path / "done.png")
+    open(done.output_image, "wb").close()
+    pending = server_extension.PromptVO("pending")
+    registry.add(done)
+    registry.add(pending)
+    registry.set_done("done", done.output_image)
+
+    clock.now += 5
+    registry.purge()
+    assert registry.get("done") is done
+    clock.now += 6
+    registry.purge()
+    # only prompts that are done expire, their files are removed with them
+    assert registry.get("done") is None
+    assert not os.path.exists(done.output_image)
+    assert registry.get("pending") is pending
+    assert registry.get_metrics()["expired"] == 1
@@ -0,0 +1,51 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import comfy.utils
+
+KEYS = [
+    "model.diffusion_model.input_blocks.1.0.weight",
+    "model.diffusion_model.input_blocks.10.0.weight",
+    "model.diffusion_model.input_blocks.2.1.proj_in.weight",
+    "model.diffusion_model.out.2.weight",
+    "model.diffusion_model_ema.decay",
+    "first_stage_model.encoder.conv_in.weight",
+    "cond_stage_model.transformer.text_model.embeddings.position_ids",
+    "conditioner.embedders.0.transformer.text_model.final_layer_norm.weight",
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+]
+
+PREFIXES = [
+    "",
+    "model.",
+    "model.diffusion_model.",
+    "model.diffusion_model",
+    "model.diffusion_model.input_blocks.1",
+    "model.diffusion_model.input_blocks.1.",
+    "model.diffusion_model.input_blocks.3",
+    "model.diff",
+    "first_stage_model.encoder.conv_in.weight",
+    "first_stage_model.encoder.conv_in.weight.",
+    "alphas",
+    "alphas_cumprod",
+    "cond_stage_model.transformer.text_model.embeddings.position_ids.x",
+    "missing.",
+]
+
+@pytest.mark.parametrize("prefix", PREFIXES)
+def test_prefix_queries_match_startswith(prefix):
+    trie = comfy.utils.KeyTrie(KEYS)
+    expected = sorted(k for k in KEYS if k.startswith(prefix))
+    assert trie.keys_with_prefix(prefix) == expected
+    assert trie.has_prefix(prefix) == (len(expected) > 0)
+
+def test_contains_and_iter():
+    trie = comfy.utils.KeyTrie(KEYS + KEYS[:3])
+    assert trie.count == len(KEYS)
+    assert sorted(trie) == sorted(KEYS)
+    for k in KEYS:
+        assert k in trie
+    assert "model.diffusion_model.input_blocks.1" not in trie
+    assert "alphas" not in trie
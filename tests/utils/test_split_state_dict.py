@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import comfy.utils
+import comfy.clip_vision
+
+def checkpoint(clip_vision_keys):
+    torch.manual_seed(0)
+    keys = [
+        "model.diffusion_model.input_blocks.0.0.weight",
+        "model.diffusion_model.out.2.bias",
+        "first_stage_model.decoder.conv_out.weight",
+        "first_stage_model.encoder.conv_in.bias",
+        "cond_stage_model.transformer.text_model.final_layer_norm.weight",
+        "alphas_cumprod",
+    ] + clip_vision_keys
+    return {k: torch.randn(4, 4) for k in keys}
+
+def filter_prefix(sd, prefix):
+    return {k[len(prefix):]: v for k, v in sd.items() if k.startswith(prefix)}
+
+COMPONENTS = {"unet": ["model.diffusion_model."], "vae": ["first_stage_model."], "clip_vision": ["embedder.model.visual."]}
+
+def test_components_match_prefix_filtering():
+    sd = checkpoint(["embedder.model.visual.ln_post.weight"])
+    original = dict(sd)
+    parts = comfy.utils.split_state_dict(sd, COMPONENTS)
+    assert len(sd) == 0
+    for component, prefixes in COMPONENTS.items():
+        assert parts[component] == filter_prefix(original, prefixes[0])
+    assert sorted(parts[None]) == ["alphas_cumprod", "cond_stage_model.transformer.text_model.final_layer_norm.weight"]
+
+def test_longest_prefix_wins():
+    sd = {"model.a": 1, "model.diffusion_model.b": 2}
+    parts = comfy.utils.split_state_dict(sd, {"unet": ["model.diffusion_model."], "other": ["model."]})
+    assert parts["unet"] == {"b": 2}
+    assert parts["other"] == {"a": 1}
+
+@pytest.mark.parametrize("clip_vision_keys", [
+    # open_clip keys, converted by transformers_convert
+    ["embedder.model.visual.transformer.resblocks.0.attn.in_proj_weight", "embedder.model.visual.transformer.resblocks.0.ln_1.weight",
+     "embedder.model.visual.class_embedding", "embedder.model.visual.ln_post.weight", "embedder.model.visual.proj"],
+    # transformers keys, only the prefix is removed (the elif prefix != "" branch)
+    ["embedder.model.visual.vision_model.encoder.layers.0.layer_norm1.weight", "embedder.model.visual.visual_projection.weight"],
+])
+def test_clip_vision_keys_match(clip_vision_keys):
+    prefix = "embedder.model.visual."
+    sd = checkpoint(clip_vision_keys)
+    # before the split the whole checkpoint was converted with the clip vision prefix
+    old = comfy.clip_vision.convert_to_transformers(dict(sd), prefix)
+    parts = comfy.utils.split_state_dict(dict(sd), COMPONENTS)
+    new = comfy.clip_vision.convert_to_transformers(parts["clip_vision"], "")
+
+    others = set(k for k in sd if not k.startswith(prefix))
+    assert set(old) - others == set(new)
+    for k in new:
+        assert torch.equal(old[k], new[k])
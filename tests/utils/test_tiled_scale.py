@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import comfy.utils
+
+def tiled_scale_loop(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu"):
+    #the tiled_scale that ran the function on one tile at a time
+    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
+    for b in range(samples.shape[0]):
+        s = samples[b:b+1]
+        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
+        out_div = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
+        for y in range(0, s.shape[2], tile_y - overlap):
+            for x in range(0, s.shape[3], tile_x - overlap):
+                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
+
+                ps = function(s_in).to(output_device)
+                mask = torch.ones_like(ps)
+                feather = round(overlap * upscale_amount)
+                for t in range(feather):
+                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
+                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
+                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
+                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
+                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
+                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
+
+        output[b:b+1] = out/out_div
+    return output
+
+def upscale(s):
+    #a function whose output depends on the tile contents, like a model would
+    return torch.nn.functional.interpolate(torch.tanh(s[:, :3] * 2.0 + s[:, 3:].mean(dim=1, keepdim=True)), scale_factor=2, mode="bilinear")
+
+@pytest.mark.parametrize("tile_batch", [1, 3, 16])
+@pytest.mark.parametrize("shape", [(2, 4, 40, 56), (1, 4, 64, 64), (1, 4, 23, 31)])
+def test_batched_matches_loop(tile_batch, shape):
+    torch.manual_seed(0)
+    samples = torch.randn(shape)
+    reference = tiled_scale_loop(samples, upscale, tile_x=16, tile_y=16, overlap=4, upscale_amount=2)
+    output = comfy.utils.tiled_scale(samples, upscale, tile_x=16, tile_y=16, overlap=4, upscale_amount=2, tile_batch=tile_batch)
+    assert output.shape == reference.shape
+    assert (output - reference).abs().max().item() < 1e-5